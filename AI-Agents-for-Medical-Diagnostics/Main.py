@@ -1,64 +1,233 @@
-# Importing the needed modules 
+# Importing the needed modules
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from Utils.Agents import Cardiologist, Psychologist, Pulmonologist, Neurologist, Dermatologist, Endocrinologist, MultidisciplinaryTeam
-from dotenv import load_dotenv
-import json, os
+from Utils.Agents import get_response_cache, set_pool_size
+from Utils.Analytics import get_analytics_store
+from Utils.Checkpoint import CheckpointStore
+from Utils.Hedging import get_hedge_policy
+from Utils.History import get_analysis_history
+from Utils.Metrics import MetricsCollector, get_process_metrics
+from Utils.Orchestrator import FANOUT_MODE, HIERARCHICAL_SYNTHESIS, PANEL_MODE, SINGLE_SYNTHESIS, AnalysisOptions, analysis_key, analyze_report, collect_report_paths, run_batch, write_result
+from Utils.Scheduler import LLMScheduler, get_scheduler, set_scheduler
+from Utils.Tiering import get_model_tiers, set_model_tiers
+import argparse
+import dataclasses
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 # Loading API key from a dotenv file.
 load_dotenv(dotenv_path='apikey.env')
 
-# read the medical report
-with open("Medical Reports/Medical Rerort - Michael Johnson - Panic Attack Disorder.txt", "r") as file:
-    medical_report = file.read()
-
-
-agents = {
-    "Cardiologist": Cardiologist(medical_report),
-    "Psychologist": Psychologist(medical_report),
-    "Pulmonologist": Pulmonologist(medical_report),
-    "Neurologist": Neurologist(medical_report),
-    "Dermatologist": Dermatologist(medical_report),
-    "Endocrinologist": Endocrinologist(medical_report)
-}
-
-# Function to run each agent and get their response
-def get_response(agent_name, agent):
-    response = agent.run()
-    return agent_name, response
-
-# Run the agents concurrently and collect responses
-responses = {}
-with ThreadPoolExecutor() as executor:
-    futures = {executor.submit(get_response, name, agent): name for name, agent in agents.items()}
-    
-    for future in as_completed(futures):
-        agent_name, response = future.result()
-        responses[agent_name] = response
-
-team_agent = MultidisciplinaryTeam(
-    cardiologist_report=responses["Cardiologist"],
-    psychologist_report=responses["Psychologist"],
-    pulmonologist_report=responses["Pulmonologist"],
-    neurologist_report=responses["Neurologist"],
-    dermatologist_report=responses["Dermatologist"],
-    endocrinologist_report=responses["Endocrinologist"]
-)
-
-# Run the MultidisciplinaryTeam agent to generate the final diagnosis
-final_diagnosis = team_agent.run()
-final_diagnosis_text = "### Enhanced Final Diagnosis (6 Specialists):\n\n" + str(final_diagnosis)
-txt_output_path = "results/enhanced_final_diagnosis.txt"
-
-# Ensure the directory exists
-os.makedirs(os.path.dirname(txt_output_path), exist_ok=True)
-
-# Write the final diagnosis to the text file
-with open(txt_output_path, "w") as txt_file:
-    txt_file.write(final_diagnosis_text)
-
-print(f"Enhanced diagnosis with 6 specialists has been saved to {txt_output_path}")
+SAMPLE_REPORT = "Medical Reports/Medical Rerort - Michael Johnson - Panic Attack Disorder.txt"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the multidisciplinary medical diagnosis agents.")
+    parser.add_argument("reports", nargs="?",
+                        help="Directory or glob of reports to analyze in batch mode (e.g. 'Medical Reports/*.txt'). "
+                             "When omitted, the sample report is analyzed.")
+    parser.add_argument("--output-dir", default="Results",
+                        help="Directory that receives one diagnosis file per report in batch mode (default: Results)")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Maximum number of LLM calls in flight across the whole batch (default: 8)")
+    parser.add_argument("--mode", choices=[FANOUT_MODE, PANEL_MODE], default=FANOUT_MODE,
+                        help="'fanout' sends one call per specialist; 'panel' sends the report once and asks "
+                             "for all specialist sections as JSON (default: fanout)")
+    parser.add_argument("--specialist-timeout", type=float,
+                        help="Seconds each specialist call may take before it is treated as missing")
+    parser.add_argument("--deadline", type=float,
+                        help="Seconds to wait for specialists before the team synthesizes whatever has arrived")
+    parser.add_argument("--refresh-late", action="store_true",
+                        help="Re-run the team synthesis when specialists answer after the deadline")
+    parser.add_argument("--triage", action="store_true",
+                        help="Consult only the specialists that local triage rules find relevant to each report")
+    parser.add_argument("--min-specialists", type=int, default=2,
+                        help="With --triage, always consult at least this many of the highest scoring specialists (default: 2)")
+    parser.add_argument("--always-consult", nargs="+", default=[], metavar="ROLE",
+                        help="With --triage, specialists that are consulted for every report")
+    parser.add_argument("--no-slicing", action="store_true",
+                        help="Send every specialist the whole report instead of only the sections relevant to its role")
+    parser.add_argument("--report-token-budget", type=int, default=3000,
+                        help="Maximum report tokens sent to each specialist call (default: 3000)")
+    parser.add_argument("--specialist-output-budget", type=int, default=800,
+                        help="Maximum tokens of each specialist's output passed to the team step (default: 800)")
+    parser.add_argument("--synthesis", choices=[SINGLE_SYNTHESIS, HIERARCHICAL_SYNTHESIS], default=SINGLE_SYNTHESIS,
+                        help="'hierarchical' condenses specialist reports by organ system in parallel before the "
+                             "team synthesis, keeping its prompt small for large panels (default: single)")
+    parser.add_argument("--synthesis-fan-in", type=int, default=4,
+                        help="With --synthesis hierarchical, specialist reports per condensing call (default: 4)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Reuse the specialist and team results checkpointed by an earlier, interrupted run "
+                             "and only run the missing steps")
+    parser.add_argument("--checkpoint-dir", default=".cache/checkpoints",
+                        help="Directory where each completed step is checkpointed (default: .cache/checkpoints)")
+    parser.add_argument("--keep-checkpoints", action="store_true",
+                        help="Keep a report's checkpoint after its diagnosis is written (by default it is removed)")
+    parser.add_argument("--specialist-model",
+                        help="Model for the specialist step (default: LLM_SPECIALIST_MODEL or gpt-4o)")
+    parser.add_argument("--team-model",
+                        help="Model for the team synthesis (default: LLM_TEAM_MODEL or gpt-4o)")
+    parser.add_argument("--cascade-model",
+                        help="Ask this model again when a specialist's answer fails the local quality check "
+                             "(default: LLM_CASCADE_MODEL, or no cascade)")
+    parser.add_argument("--pool-size", type=int,
+                        help="Keep-alive HTTP connections shared by all agents (default: OPENAI_POOL_SIZE or 64)")
+    parser.add_argument("--rpm", type=float,
+                        help="Requests per minute allowed by the provider (default: LLM_REQUESTS_PER_MINUTE or 500)")
+    parser.add_argument("--tpm", type=float,
+                        help="Tokens per minute allowed by the provider (default: LLM_TOKENS_PER_MINUTE or 300000)")
+    parser.add_argument("--max-retries", type=int,
+                        help="Retries per LLM call on rate limits and transient errors (default: LLM_MAX_RETRIES or 5)")
+    parser.add_argument("--metrics-file",
+                        help="Write per-role latency, token and cost metrics here at the end of the run "
+                             "(Prometheus text for .prom/.txt, JSON otherwise)")
+    return parser.parse_args()
+
+
+def print_cache_stats():
+    cache = get_response_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+
+
+def print_history_stats():
+    history = get_analysis_history()
+    if history is not None:
+        print(f"Analysis history: {history.stats()['analyses']} analyses in {history.path}")
+
+
+def print_analytics_stats():
+    store = get_analytics_store()
+    if store is not None:
+        store.flush()
+        stats = store.stats()
+        print(f"Analytics: {stats['rows']} rows of findings in {stats['files']} files under {store.path}")
+
+
+def print_scheduler_stats():
+    stats = get_scheduler().stats()
+    print(f"LLM calls: {stats['calls']} attempts, {stats['retries']} retries, {stats['throttled']} throttled, "
+          f"{stats['failures']} failed, concurrency limit {stats['concurrency_limit']}")
+    policy = get_hedge_policy()
+    if policy is not None:
+        hedges = policy.stats()
+        print(f"Hedged requests: {hedges['hedges']} sent, {hedges['wins']} finished first")
+
+
+def seconds(value):
+    return f"{value:.2f}" if value is not None else "-"
+
+
+def print_metrics(metrics):
+    """Per-role table of the recorded calls, slowest p95 first, so tail latency and spend stand out"""
+    summary = metrics.summary()
+    print(f"{'role':<22} {'calls':>5} {'p50 s':>7} {'p95 s':>7} {'ttft s':>7} {'wait s':>7} {'tokens in/out':>15} {'cost $':>8}")
+    roles = sorted(summary["roles"].items(), key=lambda item: item[1]["latency_p95"] or 0, reverse=True)
+    for role, stats in roles:
+        tokens = f"{stats['prompt_tokens']}/{stats['completion_tokens']}"
+        print(f"{role:<22} {stats['calls']:>5} {seconds(stats['latency_p50']):>7} {seconds(stats['latency_p95']):>7} "
+              f"{seconds(stats['ttft_p50']):>7} {seconds(stats['queue_wait_p95']):>7} {tokens:>15} {stats['cost']:>8.4f}")
+    print(f"Total: {summary['calls']} calls, {summary['errors']} errors, ${summary['cost']:.4f} in {summary['wall_time']:.1f}s")
+
+
+def configure_scheduler(args):
+    if args.rpm is None and args.tpm is None and args.max_retries is None:
+        return
+    current = get_scheduler()
+    set_scheduler(LLMScheduler(
+        requests_per_minute=args.rpm or current.request_bucket.rate * 60,
+        tokens_per_minute=args.tpm or current.token_bucket.rate * 60,
+        max_concurrency=current.max_concurrency,
+        max_retries=args.max_retries if args.max_retries is not None else current.max_retries
+    ))
+
+
+def configure_models(args):
+    overrides = {
+        "specialist_model": args.specialist_model,
+        "team_model": args.team_model,
+        "cascade_model": args.cascade_model
+    }
+    overrides = {name: model for name, model in overrides.items() if model}
+    if overrides:
+        set_model_tiers(dataclasses.replace(get_model_tiers(), **overrides))
+
+
+def main():
+    args = parse_args()
+    if args.pool_size:
+        set_pool_size(args.pool_size)
+    configure_scheduler(args)
+    configure_models(args)
+    options = AnalysisOptions(
+        mode=args.mode,
+        specialist_timeout=args.specialist_timeout,
+        deadline=args.deadline,
+        refresh_on_late=args.refresh_late,
+        triage=args.triage,
+        min_specialists=args.min_specialists,
+        always_consult=tuple(args.always_consult),
+        slice_reports=not args.no_slicing,
+        report_token_budget=args.report_token_budget,
+        specialist_output_token_budget=args.specialist_output_budget,
+        synthesis=args.synthesis,
+        synthesis_fan_in=args.synthesis_fan_in
+    )
+
+    if args.reports:
+        report_paths = collect_report_paths(args.reports)
+        if not report_paths:
+            raise SystemExit(f"No reports found for {args.reports!r}")
+        print(f"Analyzing {len(report_paths)} reports with {args.workers} workers...")
+        written, failed = run_batch(report_paths, output_dir=args.output_dir, max_concurrency=args.workers,
+                            options=options, history=get_analysis_history(),
+                            checkpoints=CheckpointStore(args.checkpoint_dir), resume=args.resume,
+                            keep_checkpoints=args.keep_checkpoints)
+        print(f"Saved {len(written)} diagnoses to {args.output_dir}")
+        if failed:
+            print(f"{len(failed)} reports failed:")
+            for report_path, error in failed.items():
+                print(f"  {report_path}: {error}")
+        print_history_stats()
+        print_analytics_stats()
+        print_cache_stats()
+        print_scheduler_stats()
+        print_metrics(get_process_metrics())
+        if args.metrics_file:
+            get_process_metrics().write(args.metrics_file)
+        return
+
+    # read the medical report
+    with open(SAMPLE_REPORT, "r") as file:
+        medical_report = file.read()
+
+    # Run the specialists concurrently, then the MultidisciplinaryTeam agent to generate the final diagnosis
+    checkpoints = CheckpointStore(args.checkpoint_dir)
+    key = analysis_key(medical_report, options)
+    checkpoint = checkpoints.open(key, args.resume)
+    if checkpoint.responses:
+        print(f"Resuming with {len(checkpoint.responses)} checkpointed specialists")
+    metrics = MetricsCollector()
+    responses, final_diagnosis = analyze_report(medical_report, options=options, metrics=metrics,
+                                                checkpoint=checkpoint)
+    txt_output_path = "results/enhanced_final_diagnosis.txt"
+
+    # Write the final diagnosis to the text file
+    write_result(txt_output_path, final_diagnosis, len(responses))
+
+    print(f"Enhanced diagnosis with {len(responses)} specialists has been saved to {txt_output_path}")
+    history = get_analysis_history()
+    if history is not None and final_diagnosis is not None and checkpoint.saved:
+        analysis_id = history.record(medical_report, responses, final_diagnosis, metrics, options, SAMPLE_REPORT)
+        print(f"Recorded as analysis #{analysis_id} in {history.path}")
+    if final_diagnosis is not None and not args.keep_checkpoints:
+        checkpoints.discard(key)
+    print_cache_stats()
+    print_scheduler_stats()
+    print_metrics(metrics)
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
 
 
+if __name__ == "__main__":
+    main()
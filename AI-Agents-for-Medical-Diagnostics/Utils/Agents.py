@@ -1,136 +1,737 @@
-from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+from Utils.Hedging import get_hedge_policy, hedged_call, hedged_stream
+from Utils.Metrics import HEDGE_CANCELLED, CallMetrics
+from Utils.Preprocessing import count_tokens
+from Utils.Scheduler import get_scheduler
+from Utils.Tiering import PANEL_ROLE, SUMMARY_ROLE, TEAM_ROLE, get_model_tiers
+
+class ResponseCache:
+    """
+    Persistent cache of LLM responses, keyed on a hash of (role, prompt, model, temperature).
+
+    Entries live in a SQLite file so they survive restarts and can be shared by
+    Main.py and the Streamlit app. The cache is bounded to `max_entries` by
+    evicting the least recently used rows, and entries older than
+    `ttl_seconds` are treated as misses and dropped.
+    """
+
+    def __init__(self, path=".cache/agent_responses.sqlite3", max_entries=5000, ttl_seconds=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets other processes read while one writes; NORMAL skips an fsync per commit,
+        # which at worst loses the last few cached responses on power loss
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(role, prompt, model_name, temperature):
+        payload = json.dumps([role, prompt, model_name, temperature], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            # Evict least recently used entries beyond the size bound
+            self._conn.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries
+        }
+
+
+_response_cache = None
+_response_cache_configured = False
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """
+    Return the process-wide response cache, creating it on first use.
+
+    Configured through RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES and
+    RESPONSE_CACHE_TTL; set RESPONSE_CACHE_ENABLED=0 to disable caching.
+    """
+    global _response_cache, _response_cache_configured
+    with _response_cache_lock:
+        if not _response_cache_configured:
+            if os.getenv("RESPONSE_CACHE_ENABLED", "1") != "0":
+                _response_cache = ResponseCache(
+                    path=os.getenv("RESPONSE_CACHE_PATH", ".cache/agent_responses.sqlite3"),
+                    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000")),
+                    ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+                )
+            _response_cache_configured = True
+        return _response_cache
+
+def set_response_cache(cache):
+    """Replace the process-wide response cache; pass None to disable caching"""
+    global _response_cache, _response_cache_configured
+    with _response_cache_lock:
+        _response_cache = cache
+        _response_cache_configured = True
+
+# Upper bound in seconds on a single LLM request, so a hung call cannot stall an analysis
+AGENT_REQUEST_TIMEOUT = float(os.getenv("AGENT_REQUEST_TIMEOUT", "120"))
+
+_pool_size = int(os.getenv("OPENAI_POOL_SIZE", "64"))
+_http_client = None
+_chat_models = {}
+# Async HTTP connections are bound to the event loop that opened them, so
+# async clients and the models using them are pooled per running loop.
+_loop_clients = weakref.WeakKeyDictionary()
+_client_lock = threading.Lock()
+
+def _pool_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=_pool_size,
+        max_keepalive_connections=_pool_size,
+        keepalive_expiry=60.0
+    )
+
+def set_pool_size(pool_size):
+    """
+    Set the number of keep-alive connections shared by all chat models.
+
+    Models created before the change keep their existing pool; later calls to
+    get_chat_model() build new clients with the new size.
+    """
+    global _pool_size, _http_client
+    with _client_lock:
+        _pool_size = pool_size
+        _http_client = None
+        _chat_models.clear()
+        _loop_clients.clear()
+
+_chat_model_factory = None
+
+def set_chat_model_factory(factory):
+    """
+    Build chat models with `factory(model, temperature, **params)` instead of
+    ChatOpenAI, e.g. Utils.Simulation.simulated_model_factory() for offline
+    runs. Pass None to go back to ChatOpenAI.
+    """
+    global _chat_model_factory
+    with _client_lock:
+        _chat_model_factory = factory
+        _chat_models.clear()
+        _loop_clients.clear()
+
+def get_chat_model(model="gpt-4o", temperature=0, **params):
+    """
+    Return the process-wide chat model for these settings, creating it on first use.
+
+    All models share one keep-alive HTTP connection pool (sized by
+    OPENAI_POOL_SIZE or set_pool_size()), so agents no longer pay for their
+    own client setup and TLS handshakes. Set LLM_BACKEND=simulated to use the
+    offline simulated model instead.
+    """
+    global _http_client
+    if _chat_model_factory is None and os.getenv("LLM_BACKEND") == "simulated":
+        from Utils.Simulation import simulated_model_factory
+        set_chat_model_factory(simulated_model_factory())
+    if _chat_model_factory is not None:
+        return _chat_model_factory(model, temperature, **params)
+    # Imported on first use: the OpenAI client stack dominates this module's import time
+    import httpx
+    from langchain_openai import ChatOpenAI
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    key = (model, temperature, tuple(sorted(params.items())))
+    with _client_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=_pool_limits())
+        if loop is None:
+            models = _chat_models
+            async_client = None
+        else:
+            if loop not in _loop_clients:
+                _loop_clients[loop] = (httpx.AsyncClient(limits=_pool_limits()), {})
+            async_client, models = _loop_clients[loop]
+        if key not in models:
+            client_kwargs = {"http_client": _http_client}
+            if async_client is not None:
+                client_kwargs["http_async_client"] = async_client
+            models[key] = ChatOpenAI(model=model, temperature=temperature, **client_kwargs, **params)
+        return models[key]
+
+# Prompt templates for the individual specialist roles
+SPECIALIST_TEMPLATES = {
+    "Cardiologist": """
+        Act like a cardiologist. You will receive a medical report of a patient.
+        Task: Review the patient's cardiac workup, including ECG, blood tests, Holter monitor results, and echocardiogram.
+        Focus: Determine if there are any subtle signs of cardiac issues that could explain the patient's symptoms. Rule out any underlying heart conditions, such as arrhythmias or structural abnormalities, that might be missed on routine testing.
+        Recommendation: Provide guidance on any further cardiac testing or monitoring needed to ensure there are no hidden heart-related concerns. Suggest potential management strategies if a cardiac issue is identified.
+        Please only return the possible causes of the patient's symptoms and the recommended next steps.
+        Medical Report: {medical_report}
+    """,
+    "Psychologist": """
+        Act like a psychologist. You will receive a patient's report.
+        Task: Review the patient's report and provide a psychological assessment.
+        Focus: Identify any potential mental health issues, such as anxiety, depression, or trauma, that may be affecting the patient's well-being.
+        Recommendation: Offer guidance on how to address these mental health concerns, including therapy, counseling, or other interventions.
+        Please only return the possible mental health issues and the recommended next steps.
+        Patient's Report: {medical_report}
+    """,
+    "Pulmonologist": """
+        Act like a pulmonologist. You will receive a patient's report.
+        Task: Review the patient's report and provide a pulmonary assessment.
+        Focus: Identify any potential respiratory issues, such as asthma, COPD, or lung infections, that may be affecting the patient's breathing.
+        Recommendation: Offer guidance on how to address these respiratory concerns, including pulmonary function tests, imaging studies, or other interventions.
+        Please only return the possible respiratory issues and the recommended next steps.
+        Patient's Report: {medical_report}
+    """,
+    "Neurologist": """
+        Act like a neurologist. You will receive a patient's report.
+        Task: Review the patient's report and provide a neurological assessment.
+        Focus: Identify any potential neurological issues, such as headaches, dizziness, cognitive impairment, seizures, or nervous system disorders that may explain the patient's symptoms.
+        Recommendation: Suggest neurological tests such as MRI, CT scans, EEG, or neuropsychological testing. Provide guidance on potential treatments or referrals to neurology subspecialists.
+        Please only return the possible neurological causes and the recommended next steps.
+        Patient's Report: {medical_report}
+    """,
+    "Dermatologist": """
+        Act like a dermatologist. You will receive a patient's report.
+        Task: Review the patient's report and provide a dermatological assessment.
+        Focus: Identify any potential skin conditions, rashes, lesions, or dermatological manifestations of systemic diseases that may be relevant to the patient's symptoms.
+        Recommendation: Suggest dermatological examinations, biopsies, or treatments. Consider how skin conditions might relate to underlying medical conditions.
+        Please only return the possible dermatological issues and the recommended next steps.
+        Patient's Report: {medical_report}
+    """,
+    "Endocrinologist": """
+        Act like an endocrinologist. You will receive a patient's report.
+        Task: Review the patient's report and provide an endocrinological assessment.
+        Focus: Identify any potential hormonal imbalances, metabolic disorders, diabetes, thyroid issues, or endocrine system problems that may explain the patient's symptoms.
+        Recommendation: Suggest hormone level tests, glucose monitoring, thyroid function tests, or other endocrine evaluations. Provide guidance on metabolic management.
+        Please only return the possible endocrine causes and the recommended next steps.
+        Patient's Report: {medical_report}
+    """
+}
+
+def specialist_instructions(role):
+    """A specialist's prompt without its report placeholder line, for embedding in combined prompts"""
+    lines = SPECIALIST_TEMPLATES[role].strip().splitlines()
+    return "\n".join("                " + line.strip() for line in lines if "{medical_report}" not in line)
+
+def parse_panel_response(text, roles):
+    """
+    Split a SpecialistPanel JSON response into `{role: assessment}`.
+
+    Tolerates code fences and surrounding prose; roles missing from the
+    response (or an unparseable response) map to None.
+    """
+    responses = dict.fromkeys(roles)
+    if not text:
+        return responses
+    start, end = text.find("{"), text.rfind("}")
+    try:
+        data = json.loads(text[start:end + 1]) if start != -1 and end > start else {}
+    except json.JSONDecodeError as e:
+        print("Could not parse panel response:", e)
+        return responses
+    by_name = {str(key).strip().lower(): value for key, value in data.items()}
+    for role in roles:
+        value = by_name.get(role.lower())
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, indent=2)
+        responses[role] = value if value else None
+    return responses
+
+# Prompt templates for the roles that combine several specialists. Specialist
+# output is passed in as a template variable, never spliced into the template
+# text, so braces in a response cannot break formatting.
+TEAM_TEMPLATE = """
+                Act like a multidisciplinary team of healthcare professionals.
+                You will receive medical analyses from {specialist_count} different specialists: {specialist_names}.
+                Task: Review all specialist reports, analyze them comprehensively, and come up with a list of 3 most likely health issues for the patient.
+                Consider how different specialist findings might relate to each other and provide a holistic assessment.
+                Return a list of bullet points of 3 possible health issues and for each issue provide the reasoning based on the specialist reports.
+                {missing_note}
+                
+{specialist_sections}
+            """
+
+PANEL_TEMPLATE = """
+                Act like a panel of {panel_size} medical specialists who each review the same patient report independently: {specialist_names}.
+                Each specialist follows their own instructions below and writes their own assessment, without referring to the other specialists.
+                
+{specialist_sections}
+                
+                Return only a JSON object with exactly these keys: {json_keys}.
+                The value for each key is that specialist's complete assessment as a single markdown string.
+                
+                Medical Report: {medical_report}
+            """
+
+SUMMARY_TEMPLATE = """
+                Act like an attending physician preparing a case conference.
+                You will receive medical analyses from {specialist_count} specialists: {specialist_names}.
+                Task: Condense their analyses into a compact summary for each of these organ systems: {organ_systems}.
+                For each organ system, write a heading "### <organ system>" and at most three bullet points each for key findings, possible causes and recommended next steps, naming the specialists they come from.
+                Keep concrete values such as lab results and doses, do not add findings that are not in the analyses, and keep the whole summary under {word_budget} words.
+                
+{specialist_sections}
+            """
+
+# Templates of the combined roles; specialist roles are looked up in SPECIALIST_TEMPLATES
+ROLE_TEMPLATES = {
+    TEAM_ROLE: TEAM_TEMPLATE,
+    PANEL_ROLE: PANEL_TEMPLATE,
+    SUMMARY_ROLE: SUMMARY_TEMPLATE
+}
+
+_compiled_templates = {}
+
+def get_prompt_template(role):
+    """Return the PromptTemplate for `role`, parsed once per process"""
+    template = _compiled_templates.get(role)
+    if template is None:
+        source = ROLE_TEMPLATES.get(role) or SPECIALIST_TEMPLATES.get(role)
+        if source is None:
+            raise ValueError(f"Unknown role: {role}")
+        from langchain_core.prompts import PromptTemplate
+        template = _compiled_templates[role] = PromptTemplate.from_template(source)
+    return template
+
+def define_specialist(role, template):
+    """
+    Register a specialist role from its prompt template and return an Agent
+    class for it, so new roles need no subclass of their own. The template
+    must contain a `{medical_report}` placeholder.
+    """
+    if "{medical_report}" not in template:
+        raise ValueError(f"Template for {role} has no {{medical_report}} placeholder")
+    SPECIALIST_TEMPLATES[role] = template
+    _compiled_templates.pop(role, None)
+    return type(role, (Specialist,), {"role_name": role})
 
 class Agent:
-    def __init__(self, medical_report=None, role=None, extra_info=None):
+    # Set on agents created by escalate(), so their calls are recorded as escalations
+    escalation = False
+
+    def __init__(self, medical_report=None, role=None, extra_info=None, model_name=None):
         self.medical_report = medical_report
         self.role = role
         self.extra_info = extra_info or {}
         # Initialize the prompt based on role and other info
         self.prompt_template = self.create_prompt_template()
-        # Initialize the model
-        self.model = ChatOpenAI(temperature=0, model="gpt-4o")
+        # Initialize the model: the one configured for the role's tier unless given
+        self.model_name = model_name or get_model_tiers().model_for(role)
+        self.temperature = 0
+        self.model = self.create_model()
 
     def create_prompt_template(self):
-        if self.role == "MultidisciplinaryTeam":
-            # Handle the multidisciplinary team case
-            template = f"""
-                Act like a multidisciplinary team of healthcare professionals.
-                You will receive medical analyses from 6 different specialists: Cardiologist, Psychologist, Pulmonologist, Neurologist, Dermatologist, and Endocrinologist.
-                Task: Review all specialist reports, analyze them comprehensively, and come up with a list of 3 most likely health issues for the patient.
-                Consider how different specialist findings might relate to each other and provide a holistic assessment.
-                Return a list of bullet points of 3 possible health issues and for each issue provide the reasoning based on the specialist reports.
-                
-                Cardiologist Report: {self.extra_info.get('cardiologist_report', '')}
-                Psychologist Report: {self.extra_info.get('psychologist_report', '')}
-                Pulmonologist Report: {self.extra_info.get('pulmonologist_report', '')}
-                Neurologist Report: {self.extra_info.get('neurologist_report', '')}
-                Dermatologist Report: {self.extra_info.get('dermatologist_report', '')}
-                Endocrinologist Report: {self.extra_info.get('endocrinologist_report', '')}
-            """
-            return PromptTemplate.from_template(template)
-        else:
-            # Handle individual specialist agents
-            templates = {
-                "Cardiologist": """
-                    Act like a cardiologist. You will receive a medical report of a patient.
-                    Task: Review the patient's cardiac workup, including ECG, blood tests, Holter monitor results, and echocardiogram.
-                    Focus: Determine if there are any subtle signs of cardiac issues that could explain the patient's symptoms. Rule out any underlying heart conditions, such as arrhythmias or structural abnormalities, that might be missed on routine testing.
-                    Recommendation: Provide guidance on any further cardiac testing or monitoring needed to ensure there are no hidden heart-related concerns. Suggest potential management strategies if a cardiac issue is identified.
-                    Please only return the possible causes of the patient's symptoms and the recommended next steps.
-                    Medical Report: {medical_report}
-                """,
-                "Psychologist": """
-                    Act like a psychologist. You will receive a patient's report.
-                    Task: Review the patient's report and provide a psychological assessment.
-                    Focus: Identify any potential mental health issues, such as anxiety, depression, or trauma, that may be affecting the patient's well-being.
-                    Recommendation: Offer guidance on how to address these mental health concerns, including therapy, counseling, or other interventions.
-                    Please only return the possible mental health issues and the recommended next steps.
-                    Patient's Report: {medical_report}
-                """,
-                "Pulmonologist": """
-                    Act like a pulmonologist. You will receive a patient's report.
-                    Task: Review the patient's report and provide a pulmonary assessment.
-                    Focus: Identify any potential respiratory issues, such as asthma, COPD, or lung infections, that may be affecting the patient's breathing.
-                    Recommendation: Offer guidance on how to address these respiratory concerns, including pulmonary function tests, imaging studies, or other interventions.
-                    Please only return the possible respiratory issues and the recommended next steps.
-                    Patient's Report: {medical_report}
-                """,
-                "Neurologist": """
-                    Act like a neurologist. You will receive a patient's report.
-                    Task: Review the patient's report and provide a neurological assessment.
-                    Focus: Identify any potential neurological issues, such as headaches, dizziness, cognitive impairment, seizures, or nervous system disorders that may explain the patient's symptoms.
-                    Recommendation: Suggest neurological tests such as MRI, CT scans, EEG, or neuropsychological testing. Provide guidance on potential treatments or referrals to neurology subspecialists.
-                    Please only return the possible neurological causes and the recommended next steps.
-                    Patient's Report: {medical_report}
-                """,
-                "Dermatologist": """
-                    Act like a dermatologist. You will receive a patient's report.
-                    Task: Review the patient's report and provide a dermatological assessment.
-                    Focus: Identify any potential skin conditions, rashes, lesions, or dermatological manifestations of systemic diseases that may be relevant to the patient's symptoms.
-                    Recommendation: Suggest dermatological examinations, biopsies, or treatments. Consider how skin conditions might relate to underlying medical conditions.
-                    Please only return the possible dermatological issues and the recommended next steps.
-                    Patient's Report: {medical_report}
-                """,
-                "Endocrinologist": """
-                    Act like an endocrinologist. You will receive a patient's report.
-                    Task: Review the patient's report and provide an endocrinological assessment.
-                    Focus: Identify any potential hormonal imbalances, metabolic disorders, diabetes, thyroid issues, or endocrine system problems that may explain the patient's symptoms.
-                    Recommendation: Suggest hormone level tests, glucose monitoring, thyroid function tests, or other endocrine evaluations. Provide guidance on metabolic management.
-                    Please only return the possible endocrine causes and the recommended next steps.
-                    Patient's Report: {medical_report}
-                """
-            }
-            if self.role and self.role in templates:
-                template = templates[self.role]
-                return PromptTemplate.from_template(template)
+        return get_prompt_template(self.role)
+
+    def create_model(self):
+        # Retries are owned by the shared scheduler, so the client must not retry on its own;
+        # stream_usage makes streamed responses report their token usage for the metrics
+        return get_chat_model(self.model_name, temperature=self.temperature,
+                              timeout=AGENT_REQUEST_TIMEOUT, max_retries=0, stream_usage=True)
+
+    def escalate(self, model_name):
+        """A copy of this agent that asks `model_name` instead, e.g. when a smaller model's answer was weak"""
+        agent = copy.copy(self)
+        agent.model_name = model_name
+        agent.model = agent.create_model()
+        agent.escalation = True
+        return agent
+
+    def prompt_inputs(self):
+        """Values for the role's template variables"""
+        if self.role == TEAM_ROLE:
+            consulted = self.extra_info.get("specialist_reports") or {}
+            missing = list(self.extra_info.get("missing_specialists") or [])
+            missing += [role for role, report in consulted.items() if report is None and role not in missing]
+            # Only the reports actually delivered are counted and shown; the missing ones are named in the note
+            reports = {role: report for role, report in consulted.items() if role not in missing}
+            summaries = self.extra_info.get("system_summaries")
+            missing_note = ""
+            if missing:
+                missing_note = (
+                    f"Note: no report was received from the following specialists: {', '.join(missing)}. "
+                    "Base your assessment only on the reports that are available and point out where the missing input limits your confidence."
+                )
+            if summaries:
+                missing_note = "Their reports have been condensed into summaries grouped by organ system. " + missing_note
+                sections = "\n".join(f"                {label}: {summary}" for label, summary in summaries.items())
             else:
-                raise ValueError(f"Unknown role: {self.role}")
-    
+                sections = "\n".join(
+                    f"                {role} Report: {report}" for role, report in reports.items()
+                )
+            return {
+                "specialist_count": len(reports),
+                "specialist_names": ", ".join(reports),
+                "missing_note": missing_note,
+                "specialist_sections": sections
+            }
+        if self.role == SUMMARY_ROLE:
+            reports = self.extra_info["specialist_reports"]
+            systems = self.extra_info["organ_systems"]
+            return {
+                "specialist_count": len(reports),
+                "specialist_names": ", ".join(reports),
+                "organ_systems": ", ".join(dict.fromkeys(systems[role] for role in reports)),
+                "word_budget": self.extra_info["word_budget"],
+                "specialist_sections": "\n".join(
+                    f"                {role} Report ({systems[role]}): {report}" for role, report in reports.items()
+                )
+            }
+        if self.role == PANEL_ROLE:
+            roles = self.extra_info["roles"]
+            return {
+                "panel_size": len(roles),
+                "specialist_names": ", ".join(roles),
+                "specialist_sections": "\n".join(
+                    f"                ### {role}\n{specialist_instructions(role)}" for role in roles
+                ),
+                "json_keys": ", ".join(f'"{role}"' for role in roles),
+                "medical_report": self.medical_report
+            }
+        return {"medical_report": self.medical_report}
+
+    def build_prompt(self):
+        return self.prompt_template.format(**self.prompt_inputs())
+
+    def cache_key(self, prompt):
+        return ResponseCache.make_key(self.role, prompt, self.model_name, self.temperature)
+
+    def cached_response(self, prompt):
+        cache = get_response_cache()
+        return cache.get(self.cache_key(prompt)) if cache is not None else None
+
+    def store_response(self, prompt, content):
+        cache = get_response_cache()
+        if cache is not None:
+            cache.set(self.cache_key(prompt), content)
+
+    # The cache does disk I/O, so async paths use it from a thread rather than blocking every call on the loop
+
+    async def acached_response(self, prompt):
+        return await asyncio.to_thread(self.cached_response, prompt)
+
+    async def astore_response(self, prompt, content):
+        await asyncio.to_thread(self.store_response, prompt, content)
+
+    def start_call(self):
+        return CallMetrics(role=self.role, model=self.model_name, escalation=self.escalation)
+
+    def start_hedge(self, call):
+        """Metrics of a duplicate request for `call`, timed from when the original call was made"""
+        return CallMetrics(role=self.role, model=self.model_name, started_at=call.started_at,
+                           streamed=call.streamed, hedge=True, escalation=self.escalation, _clock=call._clock)
+
+    def finish_call(self, call, prompt, content, usage=None, error=None):
+        """Record a call's tokens, from the reported usage when available, otherwise counted locally"""
+        if usage:
+            prompt_tokens, completion_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+        else:
+            prompt_tokens = count_tokens(prompt, self.model_name)
+            completion_tokens = count_tokens(content, self.model_name)
+        call.finish(prompt_tokens, completion_tokens, error)
+
+    def cached_call(self, call, prompt, cached):
+        call.cached = True
+        self.finish_call(call, prompt, cached)
+        return cached
+
     def run(self):
         print(f"{self.role} is running...")
-        prompt = self.prompt_template.format(medical_report=self.medical_report)
+        call = self.start_call()
+        prompt = self.build_prompt()
+        cached = self.cached_response(prompt)
+        if cached is not None:
+            return self.cached_call(call, prompt, cached)
+        try:
+            response = get_scheduler().call(
+                lambda: self.model.invoke(prompt), count_tokens(prompt, self.model_name),
+                label=self.role, on_admit=call.admitted
+            )
+        except Exception as e:
+            print("Error occurred:", e)
+            self.finish_call(call, prompt, "", error=type(e).__name__)
+            return None
+        self.store_response(prompt, response.content)
+        self.finish_call(call, prompt, response.content, response.usage_metadata)
+        return response.content
+
+    async def arun(self, on_token=None):
+        """
+        Async counterpart of run(), built on the chat model's ainvoke.
+
+        When `on_token` is given the response is streamed instead and
+        `on_token(text)` is called for every chunk as it arrives.
+        """
+        if on_token is not None:
+            chunks = []
+            try:
+                async for text in self.astream():
+                    chunks.append(text)
+                    on_token(text)
+            except Exception as e:
+                print("Error occurred:", e)
+                return None
+            return "".join(chunks)
+
+        print(f"{self.role} is running...")
+        call = self.start_call()
+        prompt = self.build_prompt()
+        cached = await self.acached_response(prompt)
+        if cached is not None:
+            return self.cached_call(call, prompt, cached)
+        attempt, on_lost = self.hedge_attempts(call, lambda attempt_call: self._ainvoke(prompt, attempt_call))
         try:
-            response = self.model.invoke(prompt)
-            return response.content
+            content = await hedged_call(get_hedge_policy(), (self.role, "latency"), attempt, on_lost)
         except Exception as e:
             print("Error occurred:", e)
             return None
+        await self.astore_response(prompt, content)
+        return content
+
+    def hedge_attempts(self, call, run_attempt):
+        """
+        Callbacks for hedged_call/hedged_stream: attempt 0 is recorded in
+        `call`, a hedge in its own CallMetrics, and the attempt that loses
+        the race is recorded as HEDGE_CANCELLED.
+        """
+        calls = [call]
+
+        def attempt(index):
+            if index == len(calls):
+                calls.append(self.start_hedge(call))
+            return run_attempt(calls[index])
+
+        def on_lost(index):
+            calls[index].error = HEDGE_CANCELLED
+        return attempt, on_lost
+
+    async def _ainvoke(self, prompt, call):
+        """One scheduled ainvoke, recorded in `call`"""
+        try:
+            response = await get_scheduler().acall(
+                lambda: self.model.ainvoke(prompt), count_tokens(prompt, self.model_name),
+                label=self.role, on_admit=call.admitted
+            )
+        except BaseException as e:
+            # Cancellation (a missed deadline, or a hedge that lost) is recorded too, then propagated
+            self.finish_call(call, prompt, "", error=call.error or type(e).__name__)
+            raise
+        self.finish_call(call, prompt, response.content, response.usage_metadata)
+        return response.content
+
+    def stream(self):
+        """
+        Yield the response text chunk by chunk as the model produces it.
+
+        A cached response is yielded as a single chunk. Failures before the
+        first chunk are retried by the scheduler; later errors are raised to
+        the caller, since part of the response may already have been consumed.
+        """
+        print(f"{self.role} is streaming...")
+        call = self.start_call()
+        call.streamed = True
+        prompt = self.build_prompt()
+        cached = self.cached_response(prompt)
+        if cached is not None:
+            yield self.cached_call(call, prompt, cached)
+            return
+        chunks = []
+        usage = None
+        scheduled = get_scheduler().stream(
+            lambda: self.model.stream(prompt), count_tokens(prompt, self.model_name),
+            label=self.role, on_admit=call.admitted
+        )
+        try:
+            for chunk in scheduled:
+                usage = chunk.usage_metadata or usage
+                if chunk.content:
+                    call.first_token()
+                    chunks.append(chunk.content)
+                    yield chunk.content
+        except BaseException as e:
+            self.finish_call(call, prompt, "".join(chunks), error=type(e).__name__)
+            raise
+        self.store_response(prompt, "".join(chunks))
+        self.finish_call(call, prompt, "".join(chunks), usage)
+
+    async def astream(self):
+        """
+        Async counterpart of stream(), built on the chat model's astream.
+
+        With a hedge policy, a stream whose first chunk is slow gets a
+        duplicate request, and whichever starts answering first is used.
+        """
+        print(f"{self.role} is streaming...")
+        call = self.start_call()
+        call.streamed = True
+        prompt = self.build_prompt()
+        cached = await self.acached_response(prompt)
+        if cached is not None:
+            yield self.cached_call(call, prompt, cached)
+            return
+        open_stream, on_lost = self.hedge_attempts(call, lambda attempt_call: self._astream(prompt, attempt_call))
+        chunks = []
+        async for text in hedged_stream(get_hedge_policy(), (self.role, "first chunk"), open_stream, on_lost):
+            if text:
+                chunks.append(text)
+                yield text
+        await self.astore_response(prompt, "".join(chunks))
+
+    async def _astream(self, prompt, call):
+        """One scheduled stream, recorded in `call`; yields every chunk's text, even empty ones"""
+        chunks = []
+        usage = None
+        scheduled = get_scheduler().astream(
+            lambda: self.model.astream(prompt), count_tokens(prompt, self.model_name),
+            label=self.role, on_admit=call.admitted
+        )
+        try:
+            async for chunk in scheduled:
+                usage = chunk.usage_metadata or usage
+                if chunk.content:
+                    call.first_token()
+                    chunks.append(chunk.content)
+                yield chunk.content
+        except BaseException as e:
+            self.finish_call(call, prompt, "".join(chunks), error=call.error or type(e).__name__)
+            raise
+        self.finish_call(call, prompt, "".join(chunks), usage)
 
 # Define specialized agent classes
-class Cardiologist(Agent):
-    def __init__(self, medical_report):
-        super().__init__(medical_report, "Cardiologist")
+class Specialist(Agent):
+    """An agent for one specialist role; subclasses (or define_specialist()) set `role_name`"""
+    role_name = None
 
-class Psychologist(Agent):
     def __init__(self, medical_report):
-        super().__init__(medical_report, "Psychologist")
+        super().__init__(medical_report, self.role_name)
 
-class Pulmonologist(Agent):
-    def __init__(self, medical_report):
-        super().__init__(medical_report, "Pulmonologist")
+class Cardiologist(Specialist):
+    role_name = "Cardiologist"
 
-class Neurologist(Agent):
-    def __init__(self, medical_report):
-        super().__init__(medical_report, "Neurologist")
+class Psychologist(Specialist):
+    role_name = "Psychologist"
 
-class Dermatologist(Agent):
-    def __init__(self, medical_report):
-        super().__init__(medical_report, "Dermatologist")
+class Pulmonologist(Specialist):
+    role_name = "Pulmonologist"
 
-class Endocrinologist(Agent):
-    def __init__(self, medical_report):
-        super().__init__(medical_report, "Endocrinologist")
+class Neurologist(Specialist):
+    role_name = "Neurologist"
+
+class Dermatologist(Specialist):
+    role_name = "Dermatologist"
+
+class Endocrinologist(Specialist):
+    role_name = "Endocrinologist"
 
 class MultidisciplinaryTeam(Agent):
-    def __init__(self, cardiologist_report, psychologist_report, pulmonologist_report, 
-                 neurologist_report, dermatologist_report, endocrinologist_report):
+    def __init__(self, specialist_reports=None, missing_specialists=None, system_summaries=None, **role_reports):
+        """
+        `specialist_reports` maps each consulted specialist role to its report
+        (None if it never arrived). Per-role keyword arguments such as
+        `cardiologist_report=...` are still accepted. When `system_summaries`
+        (section label to text, see SystemSummarizer) is given, the team works
+        from those instead of the reports themselves.
+        """
+        specialist_reports = dict(specialist_reports or {})
+        for key, report in role_reports.items():
+            if not key.endswith("_report"):
+                raise TypeError(f"Unexpected argument: {key}")
+            specialist_reports[key[:-len("_report")].capitalize()] = report
         extra_info = {
-            "cardiologist_report": cardiologist_report,
-            "psychologist_report": psychologist_report,
-            "pulmonologist_report": pulmonologist_report,
-            "neurologist_report": neurologist_report,
-            "dermatologist_report": dermatologist_report,
-            "endocrinologist_report": endocrinologist_report
+            "specialist_reports": specialist_reports,
+            "missing_specialists": missing_specialists,
+            "system_summaries": system_summaries
         }
-        super().__init__(role="MultidisciplinaryTeam", extra_info=extra_info)
+        super().__init__(role=TEAM_ROLE, extra_info=extra_info)
+
+class SystemSummarizer(Agent):
+    """
+    Condenses the reports of a few specialists into a compact summary per
+    organ system, the map step of hierarchical team synthesis.
+    `organ_systems` maps each role to its organ system.
+    """
+    def __init__(self, specialist_reports, organ_systems, word_budget=200):
+        extra_info = {
+            "specialist_reports": dict(specialist_reports),
+            "organ_systems": organ_systems,
+            "word_budget": word_budget
+        }
+        super().__init__(role=SUMMARY_ROLE, extra_info=extra_info)
+
+class SpecialistPanel(Agent):
+    """All requested specialists answered by one call that carries the report once, as JSON"""
+    def __init__(self, medical_report, roles):
+        super().__init__(medical_report, PANEL_ROLE, extra_info={"roles": list(roles)})
+
+    def create_model(self):
+        return super().create_model().bind(response_format={"type": "json_object"})
+
+    def parse(self, text):
+        return parse_panel_response(text, self.extra_info["roles"])
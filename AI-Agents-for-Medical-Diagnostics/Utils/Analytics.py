@@ -0,0 +1,272 @@
+import atexit
+import datetime
+import glob
+import importlib.util
+import os
+import threading
+import time
+import uuid
+
+from Utils.Findings import EMERGENT, URGENT, extract_findings
+from Utils.Tiering import TEAM_ROLE
+
+# Columns of the findings dataset, one row per specialist (and one for the team) of each analysis;
+# `date` (UTC, YYYY-MM-DD) is the partition key and lives in the directory names
+FINDINGS_COLUMNS = (
+    ("analysis_id", "int64"),
+    ("created_at", "timestamp"),
+    ("report_hash", "string"),
+    ("source", "string"),
+    ("mode", "string"),
+    ("role", "string"),
+    ("model", "string"),
+    ("answered", "bool"),
+    ("urgency", "string"),
+    ("conditions", "list<string>"),
+    ("tests", "list<string>"),
+    ("words", "int32"),
+    ("latency", "float64"),
+    ("prompt_tokens", "int32"),
+    ("completion_tokens", "int32"),
+    ("cost", "float64"),
+    ("date", "string")
+)
+
+
+def findings_schema():
+    """The Arrow schema of FINDINGS_COLUMNS"""
+    # Imported on first use, like the charting libraries: only analytics need pyarrow
+    import pyarrow as pa
+    types = {
+        "int64": pa.int64(), "int32": pa.int32(), "float64": pa.float64(), "bool": pa.bool_(),
+        "string": pa.string(), "list<string>": pa.list_(pa.string()), "timestamp": pa.timestamp("ms", tz="UTC")
+    }
+    return pa.schema([(name, types[kind]) for name, kind in FINDINGS_COLUMNS])
+
+
+def _day(value):
+    """A partition date from a date, datetime or "YYYY-MM-DD" string"""
+    return value if isinstance(value, str) else value.strftime("%Y-%m-%d")
+
+
+def findings_rows(analysis_id, created_at, report_hash, responses, final_diagnosis, metrics=None, options=None,
+                  source=None):
+    """Dataset rows of one analysis: extract_findings() of each specialist and of the team"""
+    summary = metrics.summary() if metrics is not None else {"roles": {}}
+    models = {call.role: call.model for call in metrics.calls() if not call.error} if metrics is not None else {}
+    timestamp = datetime.datetime.fromtimestamp(created_at, datetime.timezone.utc)
+    outputs = dict(responses)
+    outputs[TEAM_ROLE] = final_diagnosis
+    rows = []
+    for role, text in outputs.items():
+        findings = extract_findings(role, text)
+        stats = summary["roles"].get(role, {})
+        rows.append({
+            "analysis_id": analysis_id,
+            "created_at": timestamp,
+            "report_hash": report_hash,
+            "source": source,
+            "mode": options.mode if options is not None else None,
+            "role": role,
+            "model": models.get(role),
+            "answered": text is not None,
+            "urgency": findings.urgency,
+            "conditions": findings.conditions,
+            "tests": findings.tests,
+            "words": findings.words,
+            "latency": stats.get("latency_max"),
+            "prompt_tokens": stats.get("prompt_tokens"),
+            "completion_tokens": stats.get("completion_tokens"),
+            "cost": stats.get("cost"),
+            "date": _day(timestamp)
+        })
+    return rows
+
+
+class AnalyticsStore:
+    """
+    Columnar copy of analysis results for cohort-level queries, as a Parquet
+    dataset partitioned by date (`<path>/date=YYYY-MM-DD/*.parquet`).
+
+    Rows are buffered and written as one file per date once `flush_rows`
+    rows or `flush_seconds` have accumulated, and at exit, since thousands
+    of tiny files would make every scan slow; compact() merges a day's
+    files into one. Scans include rows that are still buffered. Files are
+    written under a temporary name and renamed, so readers never see a
+    partial file.
+    """
+
+    def __init__(self, path=".cache/analytics", flush_rows=2000, flush_seconds=60):
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.schema = findings_schema()
+        self._buffer = []
+        self._buffered_since = None
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        atexit.register(self.flush)
+
+    def append(self, rows):
+        with self._lock:
+            if not self._buffer:
+                self._buffered_since = time.monotonic()
+            self._buffer.extend(rows)
+            due = (len(self._buffer) >= self.flush_rows
+                   or time.monotonic() - self._buffered_since >= self.flush_seconds)
+        if due:
+            self.flush()
+
+    def append_analysis(self, analysis_id, created_at, report_hash, responses, final_diagnosis, metrics=None,
+                        options=None, source=None):
+        """Extract the findings of one analysis and add them to the dataset"""
+        self.append(findings_rows(analysis_id, created_at, report_hash, responses, final_diagnosis, metrics,
+                                  options, source))
+
+    def _buffered_table(self):
+        import pyarrow as pa
+        with self._lock:
+            return pa.Table.from_pylist(self._buffer, schema=self.schema)
+
+    def _write(self, table, date):
+        import pyarrow.parquet as pq
+        directory = os.path.join(self.path, f"date={date}")
+        os.makedirs(directory, exist_ok=True)
+        name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        # A leading dot hides the file from dataset scans until it is complete
+        temp_path = os.path.join(directory, "." + name)
+        pq.write_table(table.drop_columns(["date"]), temp_path, compression="zstd")
+        os.replace(temp_path, os.path.join(directory, name))
+
+    def flush(self):
+        """Write the buffered rows, one file per date"""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        with self._lock:
+            if not self._buffer:
+                return
+            table = pa.Table.from_pylist(self._buffer, schema=self.schema)
+            for date in pc.unique(table["date"]).to_pylist():
+                self._write(table.filter(pc.equal(table["date"], date)), date)
+            self._buffer = []
+
+    def compact(self, date=None):
+        """
+        Merge the files of one date (every date by default) into a single
+        file. Run it while no other process is writing to the dataset.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.flush()
+        dates = [_day(date)] if date is not None else [
+            os.path.basename(directory)[len("date="):] for directory in glob.glob(os.path.join(self.path, "date=*"))
+        ]
+        with self._lock:
+            for day in dates:
+                files = sorted(glob.glob(os.path.join(self.path, f"date={day}", "*.parquet")))
+                if len(files) < 2:
+                    continue
+                table = pa.concat_tables(pq.read_table(file) for file in files)
+                self._write(table.append_column("date", pa.array([day] * len(table), pa.string())), day)
+                for file in files:
+                    os.remove(file)
+
+    def scan(self, columns=None, since=None, until=None, roles=None, analysis_id=None):
+        """
+        The matching rows as a pyarrow Table, reading only the partitions
+        between `since` and `until` (dates, inclusive) and only `columns`.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        expression = None
+        for condition in (
+            ds.field("date") >= _day(since) if since is not None else None,
+            ds.field("date") <= _day(until) if until is not None else None,
+            ds.field("role").isin(list(roles)) if roles else None,
+            ds.field("analysis_id") == analysis_id if analysis_id is not None else None
+        ):
+            if condition is not None:
+                expression = condition if expression is None else expression & condition
+        dataset = ds.dataset(self.path, schema=self.schema, format="parquet", partitioning="hive")
+        stored = dataset.to_table(columns=columns, filter=expression)
+        buffered = self._buffered_table()
+        if expression is not None:
+            buffered = buffered.filter(expression)
+        if columns is not None:
+            buffered = buffered.select(columns)
+        return pa.concat_tables([stored, buffered])
+
+    def query(self, columns=None, since=None, until=None, roles=None, analysis_id=None):
+        """scan() as a pandas DataFrame"""
+        return self.scan(columns, since, until, roles, analysis_id).to_pandas()
+
+    def stats(self):
+        import pyarrow.dataset as ds
+        files = glob.glob(os.path.join(self.path, "date=*", "*.parquet"))
+        rows = ds.dataset(files, format="parquet").count_rows() if files else 0
+        with self._lock:
+            buffered = len(self._buffer)
+        return {"rows": rows + buffered, "files": len(files), "buffered": buffered}
+
+
+def specialist_summary(table):
+    """
+    Per-role aggregates of a findings table, computed in Arrow: answered
+    outputs, mean conditions and tests named, share of urgent or emergent
+    outputs, mean latency and total cost. Returns a pandas DataFrame.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    answered = table.filter(pc.field("answered"))
+    answered = answered.append_column("condition_count", pc.list_value_length(answered["conditions"]))
+    answered = answered.append_column("test_count", pc.list_value_length(answered["tests"]))
+    answered = answered.append_column("urgent", pc.cast(pc.is_in(answered["urgency"], pa.array([URGENT, EMERGENT])),
+                                                        pa.float64()))
+    grouped = answered.group_by("role").aggregate([
+        ("role", "count"), ("condition_count", "mean"), ("test_count", "mean"), ("urgent", "mean"),
+        ("latency", "mean"), ("cost", "sum")
+    ])
+    frame = grouped.to_pandas().rename(columns={
+        "role_count": "outputs", "condition_count_mean": "conditions", "test_count_mean": "tests",
+        "urgent_mean": "urgent_share", "latency_mean": "latency", "cost_sum": "cost"
+    })
+    return frame.sort_values("outputs", ascending=False, ignore_index=True)
+
+
+def item_counts(table, column="conditions", limit=20):
+    """The most often named conditions (or tests) of a findings table and how often, as a pandas DataFrame"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    counts = pc.value_counts(pc.list_flatten(table[column]))
+    frame = pa.table({column[:-1]: counts.field("values"), "count": counts.field("counts")}).to_pandas()
+    return frame.sort_values("count", ascending=False, ignore_index=True).head(limit)
+
+
+_analytics_store = None
+_analytics_store_configured = False
+_analytics_store_lock = threading.Lock()
+
+def get_analytics_store():
+    """
+    Return the process-wide analytics store, or None when analytics are off.
+
+    Stored at ANALYTICS_PATH; set ANALYTICS_ENABLED=0 to stop exporting.
+    Needs pyarrow, and stays off without it.
+    """
+    global _analytics_store, _analytics_store_configured
+    with _analytics_store_lock:
+        if not _analytics_store_configured:
+            if os.getenv("ANALYTICS_ENABLED", "1") != "0":
+                if importlib.util.find_spec("pyarrow") is None:
+                    print("pyarrow is not installed; analyses are not exported for analytics")
+                else:
+                    _analytics_store = AnalyticsStore(os.getenv("ANALYTICS_PATH", ".cache/analytics"))
+            _analytics_store_configured = True
+        return _analytics_store
+
+def set_analytics_store(store):
+    """Replace the process-wide analytics store; pass None to stop exporting"""
+    global _analytics_store, _analytics_store_configured
+    with _analytics_store_lock:
+        _analytics_store = store
+        _analytics_store_configured = True
@@ -0,0 +1,109 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+TEAM_STEP = "team"
+
+
+def _atomic_write_json(path, data):
+    """Write JSON so that `path` holds either its old content or the complete new one, even after a crash"""
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(data, file, ensure_ascii=False)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _step_file(step):
+    return re.sub(r"[^A-Za-z0-9_-]", "_", step) + ".json"
+
+
+class AnalysisCheckpoint:
+    """
+    Completed steps of one analysis, saved in a directory as they finish.
+
+    Every specialist response and the team's diagnosis is written to its
+    own file with an atomic replace, so an interrupted run leaves only whole
+    steps behind. `responses` holds the specialists restored from disk;
+    failed or timed out specialists are never saved and run again on resume.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.responses = {}
+        self.final_diagnosis = None
+        self.final_roles = None
+        # Steps written by this run; 0 after an analysis means it was entirely restored
+        self.saved = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name), encoding="utf-8") as file:
+                    step = json.load(file)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable checkpoint {name}: {e}")
+                continue
+            if step.get("step") == TEAM_STEP:
+                self.final_diagnosis = step["final_diagnosis"]
+                self.final_roles = step["roles"]
+            else:
+                self.responses[step["step"]] = step["response"]
+
+    def save_response(self, role, response):
+        if response is None:
+            return
+        self.responses[role] = response
+        _atomic_write_json(os.path.join(self.directory, _step_file(role)),
+                           {"step": role, "response": response, "completed_at": time.time()})
+        self.saved += 1
+
+    def save_final(self, final_diagnosis, responses):
+        """Save the team's diagnosis together with the specialists it was synthesized from"""
+        if final_diagnosis is None:
+            return
+        self.final_diagnosis = final_diagnosis
+        self.final_roles = sorted(role for role, response in responses.items() if response is not None)
+        _atomic_write_json(os.path.join(self.directory, _step_file(TEAM_STEP)),
+                           {"step": TEAM_STEP, "final_diagnosis": final_diagnosis, "roles": self.final_roles,
+                            "completed_at": time.time()})
+        self.saved += 1
+
+    def final_for(self, responses):
+        """The saved diagnosis if it was synthesized from exactly these responses, else None"""
+        answered = sorted(role for role, response in responses.items() if response is not None)
+        return self.final_diagnosis if self.final_roles == answered else None
+
+
+class CheckpointStore:
+    """
+    Directory of analysis checkpoints, one subdirectory per analysis key
+    (see Orchestrator.analysis_key), so a resumed run finds the steps of
+    each report no matter the order reports are processed in.
+    """
+
+    def __init__(self, directory=".cache/checkpoints"):
+        self.directory = directory
+
+    def open(self, key, resume=True):
+        """The checkpoint for an analysis; without `resume`, earlier steps are discarded first"""
+        path = os.path.join(self.directory, key)
+        if not resume:
+            shutil.rmtree(path, ignore_errors=True)
+        return AnalysisCheckpoint(path)
+
+    def discard(self, key):
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
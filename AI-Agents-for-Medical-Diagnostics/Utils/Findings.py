@@ -0,0 +1,124 @@
+import re
+from dataclasses import dataclass, field
+
+from Utils.Tiering import TEAM_ROLE
+from Utils.Triage import is_negated
+
+# Urgency levels, least to most urgent
+ROUTINE = "routine"
+URGENT = "urgent"
+EMERGENT = "emergent"
+URGENCY_LEVELS = (ROUTINE, URGENT, EMERGENT)
+
+# Longest condition or test name kept; longer list items are cut at a word boundary
+MAX_ITEM_CHARS = 80
+
+_LIST_ITEM = re.compile(r"^(\s*)(?:[-*•]|\d+[.)])\s+(.*)$")
+_HEADING = re.compile(r"^\s*(?:#{1,6}\s*)?(?:\*\*)?([^*#\n]{3,80}?)(?:\*\*)?\s*:?\s*(?:\*\*)?\s*$")
+_BOLD_LEAD = re.compile(r"^\*\*(.+?)\*\*")
+_NAME_END = re.compile(r"\s*(?::|\s[-–—]\s|\()")
+_STEPS_HEADING = re.compile(r"next step|recommend|plan|management|work-?up|follow-?up|test|evaluation|monitoring")
+_CAUSES_HEADING = re.compile(r"cause|issue|condition|diagnos|differential|concern|problem|disorder|consideration")
+_TEST_TERMS = re.compile(
+    r"\b(test|testing|tests|monitor|monitoring|holter|ecg|ekg|electrocardiogram|echocardiogram|echo|mri|ct|scan"
+    r"|x-ray|imaging|ultrasound|biopsy|panel|levels?|screening|eeg|emg|spirometry|function|culture|cbc|tsh"
+    r"|a1c|hba1c|study|studies|assay|count|angiograph\w*|polysomnograph\w*|patch)\b"
+)
+_EMERGENT = re.compile(
+    r"\b(emergency|emergent|immediate medical attention|immediately|call 911|life-threatening|hospitali[sz]ation"
+    r"|admission)\b"
+)
+_URGENT = re.compile(r"\b(urgent|urgently|promptly|as soon as possible|asap|within (24|48|72) hours|expedited)\b")
+_SENTENCE_BREAK = re.compile(r"[.;!?\n]")
+# Cues in a sentence with a condition ("seek emergency care if...") are advice for a possible case, not an
+# assessment; "should" is not one, as directives ("should be hospitalized immediately") are assessments
+_CONDITIONAL = re.compile(r"\b(if|unless|in case)\b")
+
+
+@dataclass
+class SpecialistFindings:
+    """
+    Structured findings extracted from one specialist's (or the team's)
+    output: the conditions it considers, the tests it recommends and how
+    urgently it asks for follow-up. Names are lower-cased so the same
+    condition counts once across analyses.
+    """
+    role: str
+    conditions: list = field(default_factory=list)
+    tests: list = field(default_factory=list)
+    urgency: str = ROUTINE
+    words: int = 0
+
+
+def _item_name(text):
+    """The name a list item is about: its bold lead, or the text before a colon or dash"""
+    bold = _BOLD_LEAD.match(text)
+    name = bold.group(1) if bold else _NAME_END.split(text, 1)[0]
+    name = name.replace("*", "").strip(" .:;,-").lower()
+    if len(name) > MAX_ITEM_CHARS:
+        name = name[:MAX_ITEM_CHARS].rsplit(" ", 1)[0]
+    return name
+
+
+def _sentence_at(text, start):
+    before = _SENTENCE_BREAK.split(text[:start])[-1]
+    after = _SENTENCE_BREAK.split(text[start:], 1)[0]
+    return before + after
+
+
+def _mentions(pattern, text):
+    """Whether a cue is asserted: neither negated nor only advice for a case ("seek emergency care if...")"""
+    return any(
+        not is_negated(text, match.start()) and not _CONDITIONAL.search(_sentence_at(text, match.start()))
+        for match in pattern.finditer(text)
+    )
+
+
+def classify_urgency(text):
+    """ROUTINE, URGENT or EMERGENT, from the urgency cues the text asserts"""
+    text = text.lower()
+    if _mentions(_EMERGENT, text):
+        return EMERGENT
+    if _mentions(_URGENT, text):
+        return URGENT
+    return ROUTINE
+
+
+def extract_findings(role, text):
+    """
+    SpecialistFindings of an agent's markdown output, parsed locally.
+
+    Top-level list items under a heading about causes, conditions or
+    diagnoses are conditions; those under a heading about next steps or
+    recommendations are tests when they name one (ECG, MRI, blood levels...).
+    The team's answer is a plain list of health issues, so its items count
+    as conditions before any heading.
+    """
+    if not text:
+        return SpecialistFindings(role)
+    conditions, tests = [], []
+    section = "causes" if role == TEAM_ROLE else None
+    item_indent = None
+    for line in text.splitlines():
+        item = _LIST_ITEM.match(line)
+        if item is None:
+            heading = _HEADING.match(line)
+            if heading and (line.lstrip().startswith(("#", "**")) or line.rstrip().endswith(":")):
+                title = heading.group(1).lower()
+                section = "steps" if _STEPS_HEADING.search(title) else "causes" if _CAUSES_HEADING.search(title) else None
+                item_indent = None
+            continue
+        indent = len(item.group(1).expandtabs(4))
+        if item_indent is None:
+            item_indent = indent
+        if indent > item_indent or section is None:
+            # Sub-points elaborate on the item above them
+            continue
+        name = _item_name(item.group(2))
+        if not name:
+            continue
+        if section == "causes" and name not in conditions:
+            conditions.append(name)
+        elif section == "steps" and _TEST_TERMS.search(name) and name not in tests:
+            tests.append(name)
+    return SpecialistFindings(role, conditions, tests, classify_urgency(text), len(text.split()))
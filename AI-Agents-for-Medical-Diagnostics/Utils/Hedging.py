@@ -0,0 +1,207 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from contextlib import aclosing
+
+from Utils.Metrics import percentile
+from Utils.Scheduler import get_scheduler
+
+
+class HedgePolicy:
+    """
+    Decides when a slow LLM call gets a duplicate ("hedged") request.
+
+    A call is hedged once it has waited longer than the `percentile` of the
+    recent latencies for its key (e.g. role and whether it streams), learned
+    from the last `window` completed calls. Until a key has `min_samples`
+    of its own, the recent latencies of all keys are used instead; nothing
+    is hedged before `min_samples` calls have completed in total. Extra spend is capped by a budget: every call
+    earns `budget` hedges (0.05 allows at most 5% more requests), of which
+    at most `burst` can be saved up. Calls are not hedged while the
+    scheduler has no free concurrency slot, since the duplicate would only
+    queue behind other work.
+    """
+
+    def __init__(self, percentile=95, min_samples=20, window=200, budget=0.05, burst=5.0, min_delay=0.5):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.budget = budget
+        self.burst = burst
+        self.min_delay = min_delay
+        self.hedges = 0
+        self.wins = 0
+        self._credit = burst
+        self._samples = {}
+        self._all_samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def start(self, key):
+        """Register a call; returns the seconds after which it should be hedged, or None"""
+        with self._lock:
+            self._credit = min(self.burst, self._credit + self.budget)
+            samples = self._samples.get(key)
+            if samples is None or len(samples) < self.min_samples:
+                samples = self._all_samples
+            if len(samples) < self.min_samples:
+                return None
+            return max(self.min_delay, percentile(list(samples), self.percentile))
+
+    def try_hedge(self):
+        """Spend one hedge from the budget; False if the budget or the scheduler has no room"""
+        if not get_scheduler().has_capacity():
+            return False
+        with self._lock:
+            if self._credit < 1:
+                return False
+            self._credit -= 1
+            self.hedges += 1
+            return True
+
+    def observe(self, key, seconds, hedge_won=False):
+        """Record how long a call took, as seen by its caller"""
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+            self._all_samples.append(seconds)
+            if hedge_won:
+                self.wins += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hedges": self.hedges, "wins": self.wins, "credit": round(self._credit, 2)}
+
+
+async def _race(pending, attempts):
+    """Wait for the first successful task in `pending`; returns (task, None) or (None, first error) if all fail"""
+    first_error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        # Prefer the earliest attempt when several finish together
+        for task in sorted(done, key=attempts.index):
+            if task.exception() is None:
+                return task, None
+            first_error = first_error or task.exception()
+    return None, first_error
+
+
+async def hedged_call(policy, key, attempt, on_lost):
+    """
+    Await `attempt(0)`; if it outlasts the policy's delay, also start
+    `attempt(1)` and return the result of whichever succeeds first. The
+    other is cancelled after `on_lost(index)` is called for it. The time
+    the caller waited is fed back to the policy under `key`.
+    """
+    if policy is None:
+        return await attempt(0)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    delay = policy.start(key)
+    attempts = [asyncio.ensure_future(attempt(0))]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if not done and policy.try_hedge():
+            attempts.append(asyncio.ensure_future(attempt(1)))
+        winner, error = await _race(set(attempts), attempts)
+        if winner is None:
+            raise error
+        policy.observe(key, loop.time() - started, hedge_won=attempts.index(winner) == 1)
+        return winner.result()
+    finally:
+        for index, task in enumerate(attempts):
+            if task is not winner and not task.done():
+                if winner is not None:
+                    on_lost(index)
+                task.cancel()
+
+
+# Strong references to streams being discarded; the event loop only keeps weak ones to its tasks
+_discard_tasks = set()
+
+
+async def _discard_stream(first, stream):
+    """Cancel a losing stream and close it once its pending read has unwound"""
+    first.cancel()
+    await asyncio.wait({first})
+    try:
+        await stream.aclose()
+    except Exception:
+        # The other stream already answered; a losing stream failing to close changes nothing
+        pass
+
+
+async def hedged_stream(policy, key, open_stream, on_lost):
+    """
+    Yield from the async iterator `open_stream(0)`; if its first item takes
+    longer than the policy's delay, also open `open_stream(1)` and continue
+    with whichever produces a first item first. The other stream is
+    closed after `on_lost(index)` is called for it. The time to the first
+    item is fed back to the policy under `key`.
+    """
+    if policy is None:
+        async with aclosing(open_stream(0)) as stream:
+            async for item in stream:
+                yield item
+        return
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    delay = policy.start(key)
+    streams = [open_stream(0)]
+    firsts = [asyncio.ensure_future(anext(streams[0], None))]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(firsts, timeout=delay)
+        if not done and policy.try_hedge():
+            streams.append(open_stream(1))
+            firsts.append(asyncio.ensure_future(anext(streams[1], None)))
+        winner, error = await _race(set(firsts), firsts)
+        if winner is None:
+            raise error
+        policy.observe(key, loop.time() - started, hedge_won=firsts.index(winner) == 1)
+    finally:
+        for index, first in enumerate(firsts):
+            if first is not winner:
+                if winner is not None:
+                    on_lost(index)
+                task = asyncio.ensure_future(_discard_stream(first, streams[index]))
+                _discard_tasks.add(task)
+                task.add_done_callback(_discard_tasks.discard)
+
+    async with aclosing(streams[firsts.index(winner)]) as stream:
+        item = winner.result()
+        if item is None:
+            return
+        yield item
+        async for item in stream:
+            yield item
+
+
+_hedge_policy = None
+_hedge_policy_configured = False
+_hedge_policy_lock = threading.Lock()
+
+def get_hedge_policy():
+    """
+    Return the process-wide hedge policy, or None when hedging is off.
+
+    Enabled with LLM_HEDGING=1 and tuned through LLM_HEDGE_PERCENTILE and
+    LLM_HEDGE_BUDGET (the fraction of extra requests allowed).
+    """
+    global _hedge_policy, _hedge_policy_configured
+    with _hedge_policy_lock:
+        if not _hedge_policy_configured:
+            if os.getenv("LLM_HEDGING", "0") == "1":
+                _hedge_policy = HedgePolicy(
+                    percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "95")),
+                    budget=float(os.getenv("LLM_HEDGE_BUDGET", "0.05"))
+                )
+            _hedge_policy_configured = True
+        return _hedge_policy
+
+def set_hedge_policy(policy):
+    """Replace the process-wide hedge policy; pass None to turn hedging off"""
+    global _hedge_policy, _hedge_policy_configured
+    with _hedge_policy_lock:
+        _hedge_policy = policy
+        _hedge_policy_configured = True
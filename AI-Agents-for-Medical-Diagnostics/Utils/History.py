@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import asdict
+
+import numpy as np
+
+from Utils.Analytics import get_analytics_store
+from Utils.Similarity import NearDuplicateIndex, minhash_signature, numeric_fingerprint
+
+# Characters of the final diagnosis kept uncompressed for listing analyses
+PREVIEW_CHARS = 240
+
+def report_hash(medical_report):
+    return hashlib.sha256(medical_report.encode("utf-8")).hexdigest()
+
+def _pack(text):
+    return zlib.compress(text.encode("utf-8")) if text is not None else None
+
+def _unpack(blob):
+    return zlib.decompress(blob).decode("utf-8") if blob is not None else None
+
+def near_duplicate_group(medical_report, options):
+    """
+    Near-duplicates are only matched within a group: analyses run with the
+    same settings, of reports containing the same numbers.
+    """
+    payload = json.dumps(asdict(options) if options is not None else None, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16] + ":" + numeric_fingerprint(medical_report)
+
+def _match_query(query):
+    """Turn free text into an FTS5 query: every word must appear, as a prefix"""
+    words = query.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+class AnalysisHistory:
+    """
+    Persistent record of every completed analysis, in a SQLite file.
+
+    Reports, diagnoses and specialist outputs are stored zlib-compressed;
+    list queries only read the small indexed columns (timestamp, report
+    hash, specialist, a diagnosis preview), so paging through tens of
+    thousands of analyses never decompresses or loads them all. A
+    contentless FTS5 index over the report and all outputs provides full
+    text search without storing the text a second time.
+
+    Each report's MinHash signature is stored too, and find_near_duplicate()
+    looks up earlier reports that differ only trivially (whitespace, dates,
+    typos) through an in-memory LSH index with `near_duplicate_threshold`.
+
+    With an `analytics` store (Utils.Analytics), the structured findings of
+    every recorded analysis are also exported there for cohort queries.
+    """
+
+    def __init__(self, path=".cache/analysis_history.sqlite3", near_duplicate_threshold=0.9, analytics=None):
+        self.path = path
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.analytics = analytics
+        self._near_duplicates = None
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        # WAL lets the web app read while Main.py or the API server writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                id INTEGER PRIMARY KEY,
+                created_at REAL NOT NULL,
+                report_hash TEXT NOT NULL,
+                source TEXT,
+                mode TEXT,
+                model TEXT,
+                specialist_count INTEGER NOT NULL,
+                missing TEXT NOT NULL,
+                wall_time REAL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                cost REAL,
+                preview TEXT NOT NULL,
+                report BLOB NOT NULL,
+                final_diagnosis BLOB NOT NULL,
+                metrics BLOB
+            );
+            CREATE INDEX IF NOT EXISTS analyses_created_at ON analyses (created_at);
+            CREATE INDEX IF NOT EXISTS analyses_report_hash ON analyses (report_hash, created_at);
+            CREATE TABLE IF NOT EXISTS specialist_outputs (
+                analysis_id INTEGER NOT NULL REFERENCES analyses (id),
+                role TEXT NOT NULL,
+                latency REAL,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                output BLOB,
+                PRIMARY KEY (analysis_id, role)
+            );
+            CREATE INDEX IF NOT EXISTS specialist_outputs_role ON specialist_outputs (role, analysis_id);
+            CREATE TABLE IF NOT EXISTS report_signatures (
+                analysis_id INTEGER PRIMARY KEY REFERENCES analyses (id),
+                near_duplicate_group TEXT NOT NULL,
+                signature BLOB NOT NULL
+            );
+        """)
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS analyses_fts USING fts5(report, final_diagnosis, specialists, content='')"
+            )
+            self.full_text = True
+        except sqlite3.OperationalError:
+            print("SQLite was built without FTS5; history search only matches diagnosis previews")
+            self.full_text = False
+        self._conn.commit()
+
+    def record(self, medical_report, responses, final_diagnosis, metrics=None, options=None, source=None):
+        """
+        Store one analysis and return its id. `responses` maps roles to
+        outputs (None for specialists that failed or missed the deadline);
+        `metrics` is the analysis' MetricsCollector and `options` its
+        AnalysisOptions.
+        """
+        mode = options.mode if options is not None else None
+        group = near_duplicate_group(medical_report, options)
+        signature = minhash_signature(medical_report)
+        summary = metrics.summary() if metrics is not None else {"roles": {}}
+        models = sorted({call.model for call in metrics.calls()}) if metrics is not None else []
+        missing = [role for role, response in responses.items() if response is None]
+        outputs = "\n\n".join(f"{role}: {response}" for role, response in responses.items() if response)
+        created_at = time.time()
+        with self._lock:
+            cursor = self._conn.execute("""
+                INSERT INTO analyses (created_at, report_hash, source, mode, model, specialist_count, missing,
+                                      wall_time, prompt_tokens, completion_tokens, cost, preview,
+                                      report, final_diagnosis, metrics)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                created_at, report_hash(medical_report), source, mode, ",".join(models) or None,
+                len(responses) - len(missing), ",".join(missing),
+                summary.get("wall_time"), summary.get("prompt_tokens"), summary.get("completion_tokens"),
+                summary.get("cost"), final_diagnosis[:PREVIEW_CHARS],
+                _pack(medical_report), _pack(final_diagnosis),
+                _pack(json.dumps(summary)) if metrics is not None else None
+            ))
+            analysis_id = cursor.lastrowid
+            for role, response in responses.items():
+                stats = summary["roles"].get(role, {})
+                self._conn.execute("""
+                    INSERT INTO specialist_outputs (analysis_id, role, latency, prompt_tokens, completion_tokens, output)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (analysis_id, role, stats.get("latency_max"), stats.get("prompt_tokens"),
+                      stats.get("completion_tokens"), _pack(response)))
+            if self.full_text:
+                self._conn.execute(
+                    "INSERT INTO analyses_fts (rowid, report, final_diagnosis, specialists) VALUES (?, ?, ?, ?)",
+                    (analysis_id, medical_report, final_diagnosis, outputs)
+                )
+            self._conn.execute(
+                "INSERT INTO report_signatures (analysis_id, near_duplicate_group, signature) VALUES (?, ?, ?)",
+                (analysis_id, group, signature.tobytes())
+            )
+            self._conn.commit()
+            if self._near_duplicates is not None:
+                self._near_duplicates.add(analysis_id, signature, group)
+        if self.analytics is not None:
+            # The history stays the record of truth; a failed export only leaves a gap in the analytics
+            try:
+                self.analytics.append_analysis(analysis_id, created_at, report_hash(medical_report), responses,
+                                               final_diagnosis, metrics, options, source)
+            except Exception as e:
+                print(f"Could not export analysis {analysis_id} for analytics: {e}")
+        return analysis_id
+
+    def find_near_duplicate(self, medical_report, options=None):
+        """
+        (analysis id, estimated similarity) of the most similar earlier report
+        in the same near_duplicate_group(), if it reaches the threshold; else None.
+        The index is loaded from the store on first use and kept up to date by record().
+        """
+        signature = minhash_signature(medical_report)
+        with self._lock:
+            if self._near_duplicates is None:
+                index = NearDuplicateIndex(self.near_duplicate_threshold)
+                for analysis_id, group, blob in self._conn.execute(
+                    "SELECT analysis_id, near_duplicate_group, signature FROM report_signatures"
+                ):
+                    index.add(analysis_id, np.frombuffer(blob, dtype=np.uint32), group)
+                self._near_duplicates = index
+            return self._near_duplicates.query(signature, near_duplicate_group(medical_report, options))
+
+    def search(self, query=None, role=None, report_hash=None, limit=20, offset=0):
+        """
+        One page of analyses, newest first, as (rows, total matching).
+        Rows are dicts of the indexed columns only; use get() for the full record.
+        """
+        conditions, params = [], []
+        if query and query.strip():
+            if self.full_text:
+                conditions.append("id IN (SELECT rowid FROM analyses_fts WHERE analyses_fts MATCH ?)")
+                params.append(_match_query(query))
+            else:
+                conditions.append("preview LIKE ?")
+                params.append(f"%{query.strip()}%")
+        if role:
+            conditions.append("EXISTS (SELECT 1 FROM specialist_outputs WHERE role = ? AND analysis_id = id)")
+            params.append(role)
+        if report_hash:
+            conditions.append("report_hash = ?")
+            params.append(report_hash)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM analyses {where}", params).fetchone()[0]
+            rows = self._conn.execute(f"""
+                SELECT id, created_at, report_hash, source, mode, model, specialist_count, missing,
+                       wall_time, prompt_tokens, completion_tokens, cost, preview
+                FROM analyses {where}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ? OFFSET ?
+            """, params + [limit, offset]).fetchall()
+        return [dict(row) for row in rows], total
+
+    def get(self, analysis_id):
+        """The full record of one analysis, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM analyses WHERE id = ?", (analysis_id,)).fetchone()
+            if row is None:
+                return None
+            outputs = self._conn.execute(
+                "SELECT role, latency, prompt_tokens, completion_tokens, output FROM specialist_outputs "
+                "WHERE analysis_id = ?", (analysis_id,)
+            ).fetchall()
+        record = dict(row)
+        record["report"] = _unpack(row["report"])
+        record["final_diagnosis"] = _unpack(row["final_diagnosis"])
+        record["metrics"] = json.loads(_unpack(row["metrics"])) if row["metrics"] is not None else None
+        record["responses"] = {output["role"]: _unpack(output["output"]) for output in outputs}
+        record["specialists"] = {
+            output["role"]: {key: output[key] for key in ("latency", "prompt_tokens", "completion_tokens")}
+            for output in outputs
+        }
+        return record
+
+    def stats(self):
+        with self._lock:
+            count, first, last = self._conn.execute(
+                "SELECT COUNT(*), MIN(created_at), MAX(created_at) FROM analyses"
+            ).fetchone()
+        return {"analyses": count, "first": first, "last": last}
+
+
+_history = None
+_history_configured = False
+_history_lock = threading.Lock()
+
+def get_analysis_history():
+    """
+    Return the process-wide analysis history, creating it on first use.
+
+    Stored at ANALYSIS_HISTORY_PATH; set ANALYSIS_HISTORY_ENABLED=0 to
+    stop recording analyses. NEAR_DUPLICATE_THRESHOLD sets the similarity
+    at which reports count as near-duplicates. Recorded analyses are
+    exported to get_analytics_store() as well.
+    """
+    global _history, _history_configured
+    with _history_lock:
+        if not _history_configured:
+            if os.getenv("ANALYSIS_HISTORY_ENABLED", "1") != "0":
+                _history = AnalysisHistory(
+                    os.getenv("ANALYSIS_HISTORY_PATH", ".cache/analysis_history.sqlite3"),
+                    near_duplicate_threshold=float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.9")),
+                    analytics=get_analytics_store()
+                )
+            _history_configured = True
+        return _history
+
+def set_analysis_history(history):
+    """Replace the process-wide analysis history; pass None to stop recording"""
+    global _history, _history_configured
+    with _history_lock:
+        _history = history
+        _history_configured = True
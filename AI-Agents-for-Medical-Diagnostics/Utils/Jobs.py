@@ -0,0 +1,431 @@
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from Utils.Metrics import MetricsCollector, track_analysis
+from Utils.Orchestrator import PANEL_MODE, SPECIALISTS, AnalysisOptions, analysis_key, cancel_pending, collect_late_results, missing_specialists, run_panel_async, run_specialists_async, run_team_async, select_specialists
+from Utils.Similarity import is_trivial_edit
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# What JobQueue does with a report that nearly duplicates an earlier one
+NEAR_DUPLICATES_OFF = "off"
+NEAR_DUPLICATES_FLAG = "flag"      # analyze it, noting the earlier analysis
+NEAR_DUPLICATES_REUSE = "reuse"    # return the earlier analysis instead
+
+
+def _analyses(count):
+    return f"{count} analysis" if count == 1 else f"{count} analyses"
+
+
+class QueueFullError(Exception):
+    """Raised by JobQueue.submit() when the queue or the session is at its limit"""
+
+
+class Job:
+    """
+    One report analysis and its live progress.
+
+    Fields are updated on the queue's event loop and read from other
+    threads (e.g. a Streamlit script) through snapshot().
+    """
+
+    def __init__(self, medical_report, options, session_id, key):
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.medical_report = medical_report
+        self.options = options
+        self.sessions = {session_id}
+        self.roles = select_specialists(medical_report, options)
+        self.status = QUEUED
+        # Per specialist: waiting, writing, complete, failed, missed_deadline or skipped
+        self.specialist_status = {
+            role: "waiting" if role in self.roles else "skipped" for role in SPECIALISTS
+        }
+        self.specialist_text = {role: "" for role in self.roles}
+        self.responses = dict.fromkeys(self.roles)
+        # Team: waiting, synthesizing, preliminary, complete or failed
+        self.team_status = "waiting"
+        self.team_text = ""
+        self.final_diagnosis = None
+        self.missing = []
+        self.metrics = MetricsCollector()
+        self.from_cache = False
+        self.error = None
+        self.history_id = None
+        # {"analysis_id", "similarity"} of an earlier analysis of a near-identical report
+        self.near_duplicate_of = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._task = None
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def snapshot(self):
+        """A consistent copy of the job's progress, safe to read from any thread"""
+        with self._lock:
+            return {
+                "id": self.id,
+                "status": self.status,
+                "roles": list(self.roles),
+                "specialist_status": dict(self.specialist_status),
+                "specialist_text": dict(self.specialist_text),
+                "responses": dict(self.responses),
+                "team_status": self.team_status,
+                "team_text": self.team_text,
+                "final_diagnosis": self.final_diagnosis,
+                "missing": list(self.missing),
+                "from_cache": self.from_cache,
+                "error": self.error,
+                "history_id": self.history_id,
+                "near_duplicate_of": self.near_duplicate_of,
+                "submitted_at": self.submitted_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at
+            }
+
+    # -- progress callbacks, called on the event loop -----------------------
+
+    def on_token(self, role, text):
+        with self._lock:
+            self.specialist_status[role] = "writing"
+            self.specialist_text[role] += text
+
+    def on_escalate(self, role, model):
+        # The weak answer is replaced by the larger model's, so its streamed text is dropped
+        with self._lock:
+            self.specialist_status[role] = "escalating"
+            self.specialist_text[role] = ""
+
+    def on_result(self, role, response):
+        with self._lock:
+            self.responses[role] = response
+            self.specialist_status[role] = "complete" if response is not None else "failed"
+            if response is not None:
+                self.specialist_text[role] = response
+
+    def on_team_token(self, text):
+        with self._lock:
+            self.team_text += text
+
+    def _complete_from(self, responses, final_diagnosis, metrics, **fields):
+        """Finish with the results of an earlier analysis instead of running this one"""
+        with self._lock:
+            self.roles = list(responses)
+            self.specialist_status = {
+                role: "waiting" if role in self.roles else "skipped" for role in SPECIALISTS
+            }
+            self.specialist_text = {role: "" for role in self.roles}
+            self.responses = dict.fromkeys(self.roles)
+        for role, response in responses.items():
+            self.on_result(role, response)
+        self.metrics = metrics
+        self._finish(DONE, from_cache=True, final_diagnosis=final_diagnosis, team_status="complete",
+                     team_text=final_diagnosis, missing=missing_specialists(responses), **fields)
+
+    def _set(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def _finish(self, status, **fields):
+        self._set(status=status, finished_at=time.time(), **fields)
+
+
+class JobQueue:
+    """
+    Runs analyses on a background event loop with a bounded worker pool.
+
+    At most `workers` analyses run at once and all of them share one
+    budget of `max_concurrent_calls` LLM calls in flight. Waiting jobs are
+    dispatched round-robin across sessions, so one user submitting many
+    reports cannot starve the others. Submissions are refused with
+    QueueFullError beyond `max_queued` waiting jobs, or when a session
+    already has `max_jobs_per_session` unfinished jobs.
+
+    Submitting a report that is already queued or running with the same
+    settings joins that job instead of starting another, and jobs keep
+    running when the submitting browser tab goes away; complete results
+    are stored in `analysis_cache` (an AnalysisCache), so the work is
+    reused rather than wasted. Finished analyses are also recorded in
+    `history` (an AnalysisHistory) under `source`.
+
+    With a history, reports that nearly duplicate an earlier analysis with
+    the same settings (re-submissions differing in whitespace, dates or
+    typos) are handled per `near_duplicates`: NEAR_DUPLICATES_FLAG (the
+    default) runs the report but notes the match on the job,
+    NEAR_DUPLICATES_REUSE returns the earlier analysis instead, and
+    NEAR_DUPLICATES_OFF skips the lookup. Reuse returns the diagnosis of
+    another report, so it only happens when is_trivial_edit() confirms the
+    reports differ in whitespace, punctuation and case alone; any other
+    similar report is analyzed.
+    """
+
+    def __init__(self, background_loop, workers=4, max_concurrent_calls=16, max_queued=32,
+                 max_jobs_per_session=2, analysis_cache=None, keep_finished=256, history=None, source=None,
+                 near_duplicates=NEAR_DUPLICATES_FLAG):
+        self.background_loop = background_loop
+        self.workers = workers
+        self.max_concurrent_calls = max_concurrent_calls
+        self.max_queued = max_queued
+        self.max_jobs_per_session = max_jobs_per_session
+        self.analysis_cache = analysis_cache
+        self.keep_finished = keep_finished
+        self.history = history
+        self.source = source
+        self.near_duplicates = near_duplicates
+        self._jobs = OrderedDict()
+        self._active_by_key = {}
+        # session id -> deque of queued jobs; rotated for round-robin dispatch
+        self._queues = OrderedDict()
+        self._running = 0
+        self._lock = threading.Lock()
+        self.background_loop.submit(self._start()).result()
+
+    async def _start(self):
+        self._limiter = asyncio.Semaphore(self.max_concurrent_calls)
+        self._work_available = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    # -- submission and control (any thread) ---------------------------------
+
+    def submit(self, medical_report, options=None, session_id=None, reuse_similar=True):
+        """Queue an analysis and return its Job; may return a finished or shared job instead"""
+        return self.submit_batch([(medical_report, options)], session_id, reuse_similar)[0]
+
+    def submit_batch(self, analyses, session_id=None, reuse_similar=True):
+        """
+        Queue several (medical_report, options) analyses and return their Jobs
+        in order. The batch is admitted as a whole: if its new jobs would
+        exceed a limit, QueueFullError is raised and none are queued.
+        `reuse_similar=False` analyzes near-duplicates anyway.
+        """
+        analyses = [(medical_report, options or AnalysisOptions()) for medical_report, options in analyses]
+        # Looked up before taking the lock, since loading the index can take a moment
+        similar = [self._find_similar(medical_report, options) for medical_report, options in analyses]
+        with self._lock:
+            jobs, joined, created = [], [], {}
+            for (medical_report, options), match in zip(analyses, similar):
+                key = analysis_key(medical_report, options)
+                existing = created.get(key) or self._active_by_key.get(key)
+                if existing is not None and not existing.finished:
+                    joined.append(existing)
+                    jobs.append(existing)
+                    continue
+
+                job = Job(medical_report, options, session_id, key)
+                cached = self.analysis_cache.get(key) if self.analysis_cache is not None else None
+                if cached is not None:
+                    job._complete_from(*cached)
+                    self._remember(job)
+                elif match is not None and reuse_similar and match[2]:
+                    record, near_duplicate_of, _ = match
+                    metrics = MetricsCollector()
+                    metrics.close()
+                    job._complete_from(record["responses"], record["final_diagnosis"], metrics,
+                                       history_id=record["id"], near_duplicate_of=near_duplicate_of)
+                    self._remember(job)
+                else:
+                    if match is not None:
+                        job.near_duplicate_of = match[1]
+                    created[key] = job
+                jobs.append(job)
+
+            if created:
+                active = sum(1 for active_job in self._active_by_key.values() if session_id in active_job.sessions)
+                if active + len(created) > self.max_jobs_per_session:
+                    raise QueueFullError(f"{_analyses(active)} in progress plus {len(created)} submitted exceeds "
+                                         f"the limit of {self.max_jobs_per_session} per session")
+                if self.queued_count() + len(created) > self.max_queued:
+                    raise QueueFullError("The analysis queue is full; please try again shortly")
+
+            for job in joined:
+                job.sessions.add(session_id)
+            for key, job in created.items():
+                self._queues.setdefault(session_id, deque()).append(job)
+                self._active_by_key[key] = job
+                self._remember(job)
+        if created:
+            self.background_loop.call_soon(self._work_available.set)
+        return jobs
+
+    def _find_similar(self, medical_report, options):
+        """
+        (history record, {"analysis_id", "similarity"}, reusable) of an earlier
+        near-identical analysis, or None; `reusable` when the queue reuses
+        near-duplicates and the edit is confirmed to be trivial
+        """
+        if self.history is None or self.near_duplicates == NEAR_DUPLICATES_OFF:
+            return None
+        match = self.history.find_near_duplicate(medical_report, options)
+        record = self.history.get(match[0]) if match is not None else None
+        if record is None:
+            return None
+        reusable = self.near_duplicates == NEAR_DUPLICATES_REUSE and is_trivial_edit(record["report"], medical_report)
+        return record, {"analysis_id": record["id"], "similarity": round(match[1], 3)}, reusable
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns False if it had already finished"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return False
+            if job.status == QUEUED:
+                for session_queue in self._queues.values():
+                    if job in session_queue:
+                        session_queue.remove(job)
+                self._active_by_key.pop(job.key, None)
+                job._finish(CANCELLED)
+                return True
+            task = job._task
+        if task is not None:
+            self.background_loop.call_soon(task.cancel)
+        return True
+
+    def position(self, job_id):
+        """1-based place of a queued job in dispatch order, or None if it is not waiting"""
+        with self._lock:
+            queues = [list(session_queue) for session_queue in self._queues.values()]
+        order = []
+        for depth in range(max((len(session_queue) for session_queue in queues), default=0)):
+            order.extend(session_queue[depth] for session_queue in queues if depth < len(session_queue))
+        for place, job in enumerate(order, 1):
+            if job.id == job_id:
+                return place
+        return None
+
+    def queued_count(self):
+        return sum(len(session_queue) for session_queue in self._queues.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self.queued_count(),
+                "running": self._running,
+                "workers": self.workers,
+                "max_queued": self.max_queued,
+                "finished": sum(1 for job in self._jobs.values() if job.finished)
+            }
+
+    def _remember(self, job):
+        # Called with the lock held; keeps a bounded history of finished jobs
+        self._jobs[job.id] = job
+        finished = [job_id for job_id, known in self._jobs.items() if known.finished]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+
+    # -- workers (event loop) ----------------------------------------------
+
+    def _next_job(self):
+        with self._lock:
+            if not self._queues:
+                return None
+            session_id, session_queue = next(iter(self._queues.items()))
+            job = session_queue.popleft()
+            if session_queue:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+            self._running += 1
+            return job
+
+    async def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._work_available.clear()
+                await self._work_available.wait()
+                continue
+            job._task = asyncio.create_task(self._run(job))
+            # wait() rather than await, so cancelling the job doesn't cancel the worker
+            await asyncio.wait({job._task})
+            with self._lock:
+                self._running -= 1
+                # A job cancelled while dequeued may already have been replaced by a new submission
+                if self._active_by_key.get(job.key) is job:
+                    del self._active_by_key[job.key]
+                self._remember(job)
+
+    async def _synthesize(self, job, responses):
+        job._set(team_status="synthesizing", team_text="", missing=missing_specialists(responses))
+        return await run_team_async(responses, self._limiter, on_token=job.on_team_token, options=job.options)
+
+    async def _run(self, job):
+        with self._lock:
+            # cancel() may have finished the job between _next_job() and now
+            if job.status != QUEUED:
+                return
+            job._set(status=RUNNING, started_at=time.time())
+        options = job.options
+        pending = {}
+        try:
+            with track_analysis(job.metrics):
+                if options.mode == PANEL_MODE:
+                    responses, pending = await run_panel_async(
+                        job.medical_report, job.roles, self._limiter, job.on_result, options=options,
+                        on_escalate=job.on_escalate
+                    )
+                else:
+                    responses, pending = await run_specialists_async(
+                        job.medical_report, job.roles, self._limiter, job.on_result, job.on_token, options=options,
+                        on_escalate=job.on_escalate
+                    )
+                with job._lock:
+                    for role in pending.values():
+                        job.specialist_status[role] = "missed_deadline"
+
+                final_diagnosis = await self._synthesize(job, responses)
+                if pending:
+                    if options.refresh_on_late and final_diagnosis is not None:
+                        job._set(team_status="preliminary", final_diagnosis=final_diagnosis)
+                        if await collect_late_results(pending, responses, job.on_result):
+                            final_diagnosis = await self._synthesize(job, responses)
+                    else:
+                        cancel_pending(pending)
+        except asyncio.CancelledError:
+            cancel_pending(pending)
+            job._finish(CANCELLED)
+            return
+        except Exception as e:
+            print(f"Job {job.id} failed:", e)
+            job._finish(FAILED, error=str(e))
+            return
+
+        missing = missing_specialists(responses)
+        if final_diagnosis is None:
+            job._finish(FAILED, team_status="failed", missing=missing,
+                        error="The team did not return a diagnosis.")
+            return
+        if not missing and self.analysis_cache is not None:
+            self.analysis_cache.set(job.key, (responses, final_diagnosis, job.metrics))
+        # Recorded before the job is published as done, so pollers never see DONE without its history id
+        history_id = None
+        if self.history is not None:
+            try:
+                history_id = await asyncio.to_thread(
+                    self.history.record, job.medical_report, responses, final_diagnosis, job.metrics,
+                    options, self.source
+                )
+            except asyncio.CancelledError:
+                job._finish(CANCELLED)
+                return
+            except Exception as e:
+                print(f"Could not record job {job.id} in the analysis history:", e)
+        job._finish(DONE, team_status="complete", final_diagnosis=final_diagnosis, team_text=final_diagnosis,
+                    missing=missing, history_id=history_id)
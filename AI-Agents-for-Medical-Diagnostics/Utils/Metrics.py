@@ -0,0 +1,227 @@
+import contextvars
+import json
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+# USD per million (input, output) tokens; models not listed are costed at zero
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60)
+}
+
+# Error recorded for the copy of a hedged call that lost the race and was cancelled
+HEDGE_CANCELLED = "HedgeCancelled"
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values` (0 < q <= 100); None when empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+@dataclass
+class CallMetrics:
+    """
+    Timings and usage of one agent call. All times are seconds measured
+    from when the call was made, so `queue_wait` (rate limiting and
+    concurrency slots, summed over retries) is part of `ttft` and `latency`.
+    """
+    role: str
+    model: str
+    started_at: float = field(default_factory=time.time)
+    queue_wait: float = 0.0
+    ttft: float = None
+    latency: float = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    attempts: int = 0
+    cached: bool = False
+    streamed: bool = False
+    # A duplicate request sent because the original was slow; timed from the original's start
+    hedge: bool = False
+    # Asked of a larger model because a smaller model's answer failed the cascade's quality check
+    escalation: bool = False
+    error: str = None
+    _clock: float = field(default_factory=time.monotonic, repr=False)
+
+    @property
+    def cost(self):
+        return 0.0 if self.cached else estimate_cost(self.model, self.prompt_tokens, self.completion_tokens)
+
+    def elapsed(self):
+        return time.monotonic() - self._clock
+
+    def admitted(self, waited):
+        """Scheduler callback: an attempt was admitted after waiting `waited` seconds"""
+        self.queue_wait += waited
+        self.attempts += 1
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = self.elapsed()
+
+    def finish(self, prompt_tokens=0, completion_tokens=0, error=None):
+        """Close the call and record it in the process and current-analysis collectors"""
+        self.latency = self.elapsed()
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.error = error
+        record_call(self)
+
+    def to_dict(self):
+        data = {key: value for key, value in asdict(self).items() if not key.startswith("_")}
+        data["cost"] = self.cost
+        return data
+
+
+def _summarize(calls):
+    # Hedged calls are timed by the copy that answered; the cancelled copy is spend, not latency
+    answered = [call for call in calls if not call.cached and call.error != HEDGE_CANCELLED]
+    latencies = [call.latency for call in answered if call.latency is not None]
+    ttfts = [call.ttft for call in answered if call.ttft is not None]
+    waits = [call.queue_wait for call in answered]
+    return {
+        "calls": len(calls),
+        "errors": sum(1 for call in calls if call.error and call.error != HEDGE_CANCELLED),
+        "cache_hits": sum(1 for call in calls if call.cached),
+        "retries": sum(max(0, call.attempts - 1) for call in calls),
+        "hedges": sum(1 for call in calls if call.hedge),
+        "escalations": sum(1 for call in calls if call.escalation and not call.hedge),
+        "prompt_tokens": sum(call.prompt_tokens for call in calls),
+        "completion_tokens": sum(call.completion_tokens for call in calls),
+        "cost": sum(call.cost for call in calls),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_max": max(latencies) if latencies else None,
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "queue_wait_p50": percentile(waits, 50),
+        "queue_wait_p95": percentile(waits, 95)
+    }
+
+
+class MetricsCollector:
+    """
+    Thread-safe store of CallMetrics with per-role aggregates.
+
+    Only the most recent `max_records` calls are kept, so a long-running
+    process (the Streamlit app, a large batch) uses bounded memory; the
+    aggregates describe that window.
+    """
+
+    def __init__(self, max_records=10000):
+        self.created_at = time.time()
+        self._clock = time.monotonic()
+        self._closed_at = None
+        self._calls = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def record(self, call):
+        with self._lock:
+            self._calls.append(call)
+
+    def calls(self):
+        with self._lock:
+            return list(self._calls)
+
+    def close(self):
+        """Stop the wall clock, e.g. when the analysis being tracked has finished"""
+        if self._closed_at is None:
+            self._closed_at = time.monotonic()
+
+    def wall_time(self):
+        return (self._closed_at or time.monotonic()) - self._clock
+
+    def summary(self):
+        """Totals and per-role aggregates, as plain JSON-serializable data"""
+        calls = self.calls()
+        by_role = {}
+        for call in calls:
+            by_role.setdefault(call.role, []).append(call)
+        summary = _summarize(calls)
+        summary["wall_time"] = self.wall_time()
+        summary["roles"] = {role: _summarize(role_calls) for role, role_calls in by_role.items()}
+        return summary
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self):
+        """Render the per-role aggregates in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, key, quantiles=None):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for role, stats in summary["roles"].items():
+                if quantiles:
+                    for quantile, quantile_key in quantiles:
+                        if stats[quantile_key] is not None:
+                            lines.append(f'{name}{{role="{role}",quantile="{quantile}"}} {stats[quantile_key]:.6f}')
+                else:
+                    lines.append(f'{name}{{role="{role}"}} {stats[key]}')
+
+        metric("llm_calls_total", "counter", "Agent calls, including cache hits.", "calls")
+        metric("llm_call_errors_total", "counter", "Agent calls that failed or were cancelled.", "errors")
+        metric("llm_cache_hits_total", "counter", "Agent calls answered from the response cache.", "cache_hits")
+        metric("llm_retries_total", "counter", "Retried attempts of agent calls.", "retries")
+        metric("llm_hedges_total", "counter", "Duplicate requests sent for slow agent calls.", "hedges")
+        metric("llm_escalations_total", "counter", "Agent calls re-run on a larger model after a weak answer.",
+               "escalations")
+        metric("llm_prompt_tokens_total", "counter", "Prompt tokens sent.", "prompt_tokens")
+        metric("llm_completion_tokens_total", "counter", "Completion tokens received.", "completion_tokens")
+        metric("llm_cost_usd_total", "counter", "Estimated spend in US dollars.", "cost")
+        metric("llm_call_latency_seconds", "summary", "End-to-end latency of agent calls.", None,
+               [("0.5", "latency_p50"), ("0.95", "latency_p95")])
+        metric("llm_time_to_first_token_seconds", "summary", "Time to the first streamed token.", None,
+               [("0.5", "ttft_p50"), ("0.95", "ttft_p95")])
+        metric("llm_queue_wait_seconds", "summary", "Time spent waiting for rate limits and concurrency slots.", None,
+               [("0.5", "queue_wait_p50"), ("0.95", "queue_wait_p95")])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to `path`: Prometheus text for .prom/.txt files, JSON otherwise"""
+        content = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        with open(path, "w") as file:
+            file.write(content)
+
+
+_process_metrics = MetricsCollector()
+_analysis_metrics = contextvars.ContextVar("analysis_metrics", default=None)
+
+def get_process_metrics():
+    """Metrics of every agent call made by this process"""
+    return _process_metrics
+
+def record_call(call):
+    _process_metrics.record(call)
+    collector = _analysis_metrics.get()
+    if collector is not None:
+        collector.record(call)
+
+@contextmanager
+def track_analysis(collector=None):
+    """
+    Collect the calls made inside this block, including by asyncio tasks it
+    starts, into `collector` (a new MetricsCollector by default). The
+    collector's wall clock stops when the block exits.
+    """
+    collector = collector if collector is not None else MetricsCollector()
+    token = _analysis_metrics.set(collector)
+    try:
+        yield collector
+    finally:
+        _analysis_metrics.reset(token)
+        collector.close()
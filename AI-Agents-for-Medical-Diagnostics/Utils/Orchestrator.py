@@ -0,0 +1,588 @@
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, replace
+
+from Utils.Agents import Cardiologist, Psychologist, Pulmonologist, Neurologist, Dermatologist, Endocrinologist, MultidisciplinaryTeam, SpecialistPanel, SystemSummarizer, define_specialist
+from Utils.Metrics import MetricsCollector, track_analysis
+from Utils.Preprocessing import ROLE_SECTIONS, budget_specialist_reports, slice_report, truncate_to_tokens
+from Utils.Tiering import get_model_tiers
+from Utils.Triage import TRIAGE_RULES, triage_report
+
+# Execution modes: one call per specialist, or one "panel" call for all of them
+FANOUT_MODE = "fanout"
+PANEL_MODE = "panel"
+
+# Team synthesis: one call over every specialist report, or condensing them by organ system first
+SINGLE_SYNTHESIS = "single"
+HIERARCHICAL_SYNTHESIS = "hierarchical"
+
+# Specialists available to every analysis, in display order
+SPECIALISTS = {
+    "Cardiologist": Cardiologist,
+    "Psychologist": Psychologist,
+    "Pulmonologist": Pulmonologist,
+    "Neurologist": Neurologist,
+    "Dermatologist": Dermatologist,
+    "Endocrinologist": Endocrinologist
+}
+
+# Organ system of each specialist, by which hierarchical synthesis groups their reports
+ORGAN_SYSTEMS = {
+    "Cardiologist": "Cardiovascular",
+    "Psychologist": "Mental health",
+    "Pulmonologist": "Respiratory",
+    "Neurologist": "Nervous system",
+    "Dermatologist": "Skin",
+    "Endocrinologist": "Endocrine and metabolic"
+}
+
+
+def register_specialist(role, template, sections=None, triage_terms=None, organ_system=None):
+    """
+    Make a new specialist available to every analysis from its prompt template.
+
+    `sections` names the report sections it receives when reports are sliced
+    (the whole report by default), `triage_terms` maps keywords to weights
+    for triage and `organ_system` groups it with other specialists in
+    hierarchical synthesis (a group of its own by default).
+    """
+    SPECIALISTS[role] = define_specialist(role, template)
+    if sections is not None:
+        ROLE_SECTIONS[role] = set(sections)
+    if triage_terms is not None:
+        TRIAGE_RULES[role] = dict(triage_terms)
+    if organ_system is not None:
+        ORGAN_SYSTEMS[role] = organ_system
+    return SPECIALISTS[role]
+
+
+@dataclass
+class AnalysisOptions:
+    """Per-run settings shared by single-report, batch and dashboard analyses"""
+    # FANOUT_MODE isolates specialists in separate calls; PANEL_MODE sends the report once
+    mode: str = FANOUT_MODE
+    # Seconds each specialist call may take, and seconds to wait for all of them
+    specialist_timeout: float = None
+    deadline: float = None
+    # Re-run the team synthesis when specialists answer after the deadline
+    refresh_on_late: bool = False
+    # Consult only the specialists the local triage rules consider relevant
+    triage: bool = False
+    min_specialists: int = 2
+    always_consult: tuple = ()
+    # Send each specialist only the report sections relevant to its role
+    slice_reports: bool = True
+    # Token caps on the report text per specialist call, and on each specialist's output fed to the team
+    report_token_budget: int = 3000
+    specialist_output_token_budget: int = 800
+    # With HIERARCHICAL_SYNTHESIS and more than `synthesis_fan_in` reports, the reports are first
+    # condensed by organ system, at most `synthesis_fan_in` per call, into summaries of `summary_token_budget`
+    synthesis: str = SINGLE_SYNTHESIS
+    synthesis_fan_in: int = 4
+    summary_token_budget: int = 300
+
+
+def analysis_key(medical_report, options=None):
+    """Hash identifying an analysis: the report text plus every option that can change its result"""
+    options = options or AnalysisOptions()
+    payload = json.dumps([medical_report, asdict(options)], sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """
+    In-memory LRU cache of complete analyses, shared by every caller in the process.
+
+    Holds at most `max_entries` results and treats entries older than
+    `ttl_seconds` as missing. Values are whatever the caller stores,
+    typically `(responses, final_diagnosis, metrics)`.
+    """
+
+    def __init__(self, max_entries=128, ttl_seconds=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+def select_specialists(medical_report, options=None):
+    """Roles to consult for a report: all of them, or the triaged subset"""
+    options = options or AnalysisOptions()
+    if not options.triage:
+        return list(SPECIALISTS)
+    result = triage_report(
+        medical_report,
+        roles=SPECIALISTS,
+        min_specialists=options.min_specialists,
+        always_consult=options.always_consult
+    )
+    return result.selected
+
+
+def prepare_report(medical_report, roles, options=None):
+    """The part of a report sent to the given specialist role(s), within the token budget"""
+    options = options or AnalysisOptions()
+    if options.slice_reports:
+        return slice_report(medical_report, roles, options.report_token_budget)
+    return truncate_to_tokens(medical_report, options.report_token_budget)
+
+
+def collect_report_paths(pattern):
+    """Expand a directory or glob pattern into a sorted list of report files"""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.txt")
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+
+def missing_specialists(responses):
+    """Consulted specialists that have not (yet) produced a usable report"""
+    return [role for role, response in responses.items() if response is None]
+
+
+def build_team(responses, options=None, system_summaries=None):
+    """Create the MultidisciplinaryTeam agent from a dict of specialist responses and, optionally, their summaries"""
+    options = options or AnalysisOptions()
+    reports = budget_specialist_reports(responses, options.specialist_output_token_budget)
+    return MultidisciplinaryTeam(reports, missing_specialists=missing_specialists(responses),
+                                 system_summaries=system_summaries)
+
+
+def synthesis_groups(roles, fan_in):
+    """
+    Split specialist roles into groups of at most `fan_in` for hierarchical
+    synthesis. Specialists of the same organ system stay in one group unless
+    the system alone has more than `fan_in` of them.
+    """
+    by_system = {}
+    for role in roles:
+        by_system.setdefault(ORGAN_SYSTEMS.get(role, role), []).append(role)
+    groups, current = [], []
+    for system_roles in by_system.values():
+        for start in range(0, len(system_roles), fan_in):
+            chunk = system_roles[start:start + fan_in]
+            if len(current) + len(chunk) > fan_in:
+                groups.append(current)
+                current = []
+            current.extend(chunk)
+    if current:
+        groups.append(current)
+    return groups
+
+
+def format_diagnosis(final_diagnosis, specialist_count=len(SPECIALISTS)):
+    return f"### Enhanced Final Diagnosis ({specialist_count} Specialists):\n\n" + str(final_diagnosis)
+
+
+def write_result(output_path, final_diagnosis, specialist_count=len(SPECIALISTS)):
+    """Write a formatted final diagnosis, creating the parent directory if needed"""
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output_path, "w") as txt_file:
+        txt_file.write(format_diagnosis(final_diagnosis, specialist_count))
+
+
+def result_path_for(report_path, output_dir):
+    name = os.path.splitext(os.path.basename(report_path))[0]
+    return os.path.join(output_dir, name + ".txt")
+
+
+async def _limited(coroutine, limiter):
+    async with limiter:
+        return await coroutine
+
+
+async def _run_specialist(agent, limiter, on_token, timeout, on_escalate=None):
+    # The timeout starts once the call holds a slot, so queueing doesn't count against it
+    async with limiter:
+        try:
+            response = await asyncio.wait_for(agent.arun(on_token), timeout)
+        except asyncio.TimeoutError:
+            print(f"{agent.role} timed out after {timeout}s")
+            response = None
+    escalation = get_model_tiers().escalation_for(agent.role, agent.model_name, response)
+    if escalation is None:
+        return response
+    model, problems = escalation
+    print(f"Escalating {agent.role} from {agent.model_name} to {model}: {', '.join(problems)}")
+    if on_escalate is not None:
+        on_escalate(agent.role, model)
+    return await _run_specialist(agent.escalate(model), limiter, on_token, timeout)
+
+
+def _role_tokens(on_token, role):
+    if on_token is None:
+        return None
+    return lambda text: on_token(role, text)
+
+
+async def run_specialists_async(medical_report, roles=None, limiter=None, on_result=None, on_token=None,
+                                options=None, on_escalate=None, escalate=None):
+    """
+    Run the given specialist `roles` (default: all) for one report on the current event loop.
+
+    `limiter` is an asyncio.Semaphore bounding LLM calls in flight; pass a
+    shared one to budget calls across several reports. `on_result(role,
+    response)` is called as each specialist answers, in completion order,
+    with None for a failed or timed out call. When `on_token(role, text)` is
+    given, responses are streamed and it is called for every chunk as it
+    arrives.
+
+    With a cascade configured in the model tiers, answers that fail the
+    local quality check are asked again of the larger model;
+    `on_escalate(role, model)` is called first, so streamed text from the
+    weak answer can be discarded. `escalate` maps roles whose answer was
+    already found weak elsewhere (e.g. in a panel) to the model asked directly.
+
+    Each specialist receives the report as prepared by prepare_report().
+    `options.specialist_timeout` bounds each call and `options.deadline`
+    bounds the whole step, both in seconds. Returns `(responses, pending)`:
+    a dict with an entry per consulted role (None until it answers) and a
+    dict of still-running tasks to roles, which is empty unless the
+    deadline expired. Pass `pending` on to collect_late_results() or
+    cancel_pending().
+    """
+    options = options or AnalysisOptions()
+    roles = list(roles or SPECIALISTS)
+    escalate = escalate or {}
+    limiter = limiter or asyncio.Semaphore(len(roles))
+    tasks = {}
+    for role in roles:
+        agent = SPECIALISTS[role](prepare_report(medical_report, role, options))
+        if role in escalate:
+            agent = agent.escalate(escalate[role])
+        tasks[asyncio.create_task(_run_specialist(agent, limiter, _role_tokens(on_token, role),
+                                                  options.specialist_timeout, on_escalate))] = role
+    loop = asyncio.get_running_loop()
+    deadline = options.deadline
+    expires_at = loop.time() + deadline if deadline is not None else None
+
+    responses = dict.fromkeys(roles)
+    pending = set(tasks)
+    try:
+        while pending:
+            timeout = max(expires_at - loop.time(), 0) if expires_at is not None else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                print(f"Deadline reached; still waiting on {', '.join(tasks[task] for task in pending)}")
+                break
+            for task in done:
+                role = tasks[task]
+                responses[role] = task.result()
+                if on_result:
+                    on_result(role, responses[role])
+    except asyncio.CancelledError:
+        # Don't leave specialist calls running (and spending) for an abandoned analysis
+        cancel_pending(pending)
+        raise
+    return responses, {task: tasks[task] for task in pending}
+
+
+async def run_panel_async(medical_report, roles=None, limiter=None, on_result=None, options=None, on_escalate=None):
+    """
+    Run the given specialist `roles` (default: all) as one SpecialistPanel call.
+
+    The report is sent once and the structured response is split back into
+    per-specialist reports. Roles the panel fails to return are retried as
+    individual specialist calls, so a malformed response degrades to fan-out
+    rather than to missing reports. With a cascade configured in the model
+    tiers, each role's section gets the same quality check as a fan-out
+    answer, and weak ones are asked again of the cascade model as
+    individual calls (`on_escalate(role, model)` is called first). Returns
+    `(responses, pending)` like run_specialists_async().
+    """
+    options = options or AnalysisOptions()
+    roles = list(roles or SPECIALISTS)
+    limiter = limiter or asyncio.Semaphore(1)
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    deadline = options.deadline
+    timeout = min((t for t in (options.specialist_timeout, deadline) if t is not None), default=None)
+
+    # The panel sees the union of the sections its specialists need
+    panel = SpecialistPanel(prepare_report(medical_report, roles, options), roles)
+    responses = panel.parse(await _run_specialist(panel, limiter, None, timeout))
+    escalate = {}
+    for role, response in responses.items():
+        escalation = get_model_tiers().escalation_for(role, panel.model_name, response) if response else None
+        if escalation is not None:
+            model, problems = escalation
+            print(f"Escalating {role} from the {panel.model_name} panel to {model}: {', '.join(problems)}")
+            if on_escalate is not None:
+                on_escalate(role, model)
+            escalate[role] = model
+            responses[role] = None
+        elif response is not None and on_result:
+            on_result(role, response)
+
+    retry = missing_specialists(responses)
+    if not retry:
+        return responses, {}
+    missing = [role for role in retry if role not in escalate]
+    if missing:
+        print(f"Panel did not return {', '.join(missing)}; consulting them individually")
+    remaining = max(deadline - (loop.time() - started_at), 0) if deadline is not None else None
+    retried, pending = await run_specialists_async(
+        medical_report, retry, limiter, on_result, options=replace(options, deadline=remaining),
+        on_escalate=on_escalate, escalate=escalate
+    )
+    responses.update(retried)
+    return responses, pending
+
+
+async def collect_late_results(pending, responses, on_result=None):
+    """Wait for specialists that missed the deadline; returns the roles that answered"""
+    answered = []
+    remaining = set(pending)
+    try:
+        while remaining:
+            done, remaining = await asyncio.wait(remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                role = pending[task]
+                responses[role] = task.result()
+                if responses[role] is not None:
+                    answered.append(role)
+                if on_result:
+                    on_result(role, responses[role])
+    except asyncio.CancelledError:
+        cancel_pending(remaining)
+        raise
+    return answered
+
+
+def cancel_pending(pending):
+    for task in pending:
+        task.cancel()
+
+
+async def condense_reports_async(responses, limiter=None, options=None):
+    """
+    Map step of hierarchical synthesis: condense the specialist reports by
+    organ system, one SystemSummarizer call per synthesis_groups() group, all
+    in parallel. Returns section labels mapped to summaries; a group whose
+    call fails contributes its reports instead.
+    """
+    options = options or AnalysisOptions()
+    limiter = limiter or asyncio.Semaphore(1)
+    reports = budget_specialist_reports(responses, options.specialist_output_token_budget)
+    answered = [role for role, report in reports.items() if report is not None]
+    groups = synthesis_groups(answered, options.synthesis_fan_in)
+    # Roughly three words per four tokens
+    word_budget = options.summary_token_budget * 3 // 4
+
+    async def condense(roles):
+        systems = {role: ORGAN_SYSTEMS.get(role, role) for role in roles}
+        summarizer = SystemSummarizer({role: reports[role] for role in roles}, systems, word_budget)
+        return await _limited(summarizer.arun(), limiter)
+
+    summaries = {}
+    for roles, summary in zip(groups, await asyncio.gather(*(condense(roles) for roles in groups))):
+        if summary is None:
+            summaries.update((f"{role} Report", reports[role]) for role in roles)
+            continue
+        systems = ", ".join(dict.fromkeys(ORGAN_SYSTEMS.get(role, role) for role in roles))
+        summaries[f"{systems} Summary ({', '.join(roles)})"] = truncate_to_tokens(summary,
+                                                                                  options.summary_token_budget)
+    return summaries
+
+
+async def run_team_async(responses, limiter=None, on_token=None, options=None):
+    """
+    Run the team synthesis; `on_token(text)` streams the diagnosis as it is written.
+
+    With `options.synthesis` set to HIERARCHICAL_SYNTHESIS and more reports
+    than `options.synthesis_fan_in`, the reports are condensed by
+    condense_reports_async() first, so the team's prompt stays about the
+    same size however many specialists were consulted.
+    """
+    options = options or AnalysisOptions()
+    limiter = limiter or asyncio.Semaphore(1)
+    summaries = None
+    answered = len(responses) - len(missing_specialists(responses))
+    if options.synthesis == HIERARCHICAL_SYNTHESIS and answered > options.synthesis_fan_in:
+        summaries = await condense_reports_async(responses, limiter, options)
+    return await _limited(build_team(responses, options, summaries).arun(on_token), limiter)
+
+
+def _checkpointed(on_result, checkpoint):
+    if checkpoint is None:
+        return on_result
+
+    def save_and_report(role, response):
+        checkpoint.save_response(role, response)
+        if on_result:
+            on_result(role, response)
+    return save_and_report
+
+
+async def analyze_report_async(medical_report, limiter=None, on_result=None, options=None, metrics=None,
+                               checkpoint=None):
+    """
+    Run the consulted specialists concurrently, then the team synthesis, for one report.
+
+    In `PANEL_MODE` the specialists are answered by one combined call instead.
+    With `options.triage`, only the specialists selected by the local triage
+    rules are consulted. When `options.deadline` expires the team works from
+    the reports received so far, and its prompt names the missing
+    specialists. With `options.refresh_on_late`, specialists that answer
+    after the deadline trigger a second synthesis whose diagnosis is
+    returned instead; otherwise they are cancelled.
+
+    Every agent call made for the report is recorded in `metrics` (a
+    MetricsCollector) when one is given.
+
+    With a `checkpoint` (an AnalysisCheckpoint), each step is saved as it
+    completes and steps already saved there are not run again: only the
+    missing specialists are consulted, and the team synthesis is reused
+    when it was made from the same specialist reports.
+    """
+    options = options or AnalysisOptions()
+    run_step = run_panel_async if options.mode == PANEL_MODE else run_specialists_async
+    roles = select_specialists(medical_report, options)
+    restored = {role: checkpoint.responses[role] for role in roles
+                if checkpoint is not None and checkpoint.responses.get(role) is not None}
+    with track_analysis(metrics):
+        for role, response in restored.items():
+            if on_result:
+                on_result(role, response)
+        on_result = _checkpointed(on_result, checkpoint)
+        remaining = [role for role in roles if role not in restored]
+        responses, pending = {}, {}
+        if remaining:
+            responses, pending = await run_step(medical_report, remaining, limiter, on_result, options=options)
+        responses = {role: restored[role] if role in restored else responses[role] for role in roles}
+        final_diagnosis = checkpoint.final_for(responses) if checkpoint is not None else None
+        if final_diagnosis is None:
+            final_diagnosis = await run_team_async(responses, limiter, options=options)
+            if checkpoint is not None:
+                checkpoint.save_final(final_diagnosis, responses)
+        if pending:
+            if options.refresh_on_late:
+                if await collect_late_results(pending, responses, on_result):
+                    final_diagnosis = await run_team_async(responses, limiter, options=options)
+                    if checkpoint is not None:
+                        checkpoint.save_final(final_diagnosis, responses)
+            else:
+                cancel_pending(pending)
+    return responses, final_diagnosis
+
+
+def analyze_report(medical_report, max_concurrency=None, options=None, metrics=None, checkpoint=None):
+    limiter = asyncio.Semaphore(max_concurrency or len(SPECIALISTS))
+    return asyncio.run(analyze_report_async(medical_report, limiter, options=options, metrics=metrics,
+                                            checkpoint=checkpoint))
+
+
+async def run_batch_async(report_paths, output_dir="Results", max_concurrency=8, options=None, on_complete=None,
+                          history=None, checkpoints=None, resume=False, keep_checkpoints=False):
+    """
+    Analyze many reports on one event loop with at most `max_concurrency` LLM calls in flight.
+
+    Work is pipelined rather than processed one report at a time: a small
+    number of reports beyond what the call budget can serve are kept in
+    flight, so while one report waits on its team synthesis the next
+    report's specialists use the freed slots. Reports are only read once a
+    report worker picks them up, so memory stays flat regardless of how
+    many files are in the batch. `options` apply to every report.
+    `on_complete(report_path, output_path, metrics)`, if given, is called as
+    each report finishes with the MetricsCollector of its calls. With a
+    `history` (an AnalysisHistory), every analysis is also recorded there.
+
+    With `checkpoints` (a CheckpointStore), every step of every report is
+    checkpointed as it completes. With `resume`, steps checkpointed by an
+    earlier, interrupted run are reused instead of being run again; reports
+    restored entirely from checkpoints are not recorded in the history twice.
+    A report's checkpoint is discarded once its diagnosis is written, unless
+    `keep_checkpoints` is set.
+
+    A report that cannot be read or analyzed is skipped and the batch goes on.
+
+    Returns (written, failed): dicts mapping each report path to the result
+    file written for it, and each skipped report's path to its error.
+    """
+    limiter = asyncio.Semaphore(max_concurrency)
+    reports = iter(report_paths)
+    written, failed = {}, {}
+
+    async def analyze_file(report_path):
+        with open(report_path, "r", encoding="utf-8") as file:
+            medical_report = file.read()
+        print(f"Queued {report_path}")
+        checkpoint = None
+        if checkpoints is not None:
+            key = analysis_key(medical_report, options)
+            checkpoint = await asyncio.to_thread(checkpoints.open, key, resume)
+            if checkpoint.responses:
+                print(f"Resuming {report_path} with {len(checkpoint.responses)} checkpointed specialists")
+        metrics = MetricsCollector()
+        responses, final_diagnosis = await analyze_report_async(
+            medical_report, limiter, options=options, metrics=metrics, checkpoint=checkpoint
+        )
+        output_path = result_path_for(report_path, output_dir)
+        write_result(output_path, final_diagnosis, len(responses))
+        written[report_path] = output_path
+        restored = checkpoint is not None and checkpoint.saved == 0
+        if history is not None and final_diagnosis is not None and not restored:
+            await asyncio.to_thread(history.record, medical_report, responses, final_diagnosis, metrics,
+                                    options or AnalysisOptions(), report_path)
+        if checkpoint is not None and final_diagnosis is not None and not keep_checkpoints:
+            await asyncio.to_thread(checkpoints.discard, key)
+        summary = metrics.summary()
+        print(f"Diagnosis for {report_path} saved to {output_path} ({len(responses)} specialists consulted, "
+              f"{summary['wall_time']:.1f}s, ${summary['cost']:.4f})")
+        if on_complete is not None:
+            on_complete(report_path, output_path, metrics)
+
+    async def report_worker():
+        for report_path in reports:
+            # One unreadable or failing report must not abort the rest of the batch
+            try:
+                await analyze_file(report_path)
+            except Exception as e:
+                print(f"Failed to analyze {report_path}: {e}")
+                failed[report_path] = str(e)
+
+    report_workers = max_concurrency // len(SPECIALISTS) + 2
+    await asyncio.gather(*(report_worker() for _ in range(report_workers)))
+    return written, failed
+
+
+def run_batch(report_paths, output_dir="Results", max_concurrency=8, options=None, history=None, checkpoints=None,
+              resume=False, keep_checkpoints=False):
+    return asyncio.run(run_batch_async(report_paths, output_dir, max_concurrency, options, history=history,
+                                       checkpoints=checkpoints, resume=resume, keep_checkpoints=keep_checkpoints))
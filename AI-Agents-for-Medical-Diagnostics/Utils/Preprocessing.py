@@ -0,0 +1,159 @@
+import math
+import re
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # optional: fall back to a character-based estimate
+    tiktoken = None
+
+# Rough characters per token for English clinical text, used when tiktoken is unavailable
+CHARS_PER_TOKEN = 4
+
+_encoders = {}
+_encoder_lock = threading.Lock()
+
+def _encoder(model):
+    with _encoder_lock:
+        if model not in _encoders:
+            encoder = None
+            if tiktoken is not None:
+                try:
+                    encoder = tiktoken.encoding_for_model(model)
+                except Exception:
+                    # Unknown model, or the encoding files could not be fetched
+                    try:
+                        encoder = tiktoken.get_encoding("o200k_base")
+                    except Exception:
+                        encoder = None
+            _encoders[model] = encoder
+        return _encoders[model]
+
+def count_tokens(text, model="gpt-4o"):
+    """Count tokens locally with tiktoken, or estimate them if it is not available"""
+    if not text:
+        return 0
+    encoder = _encoder(model)
+    if encoder is not None:
+        return len(encoder.encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def truncate_to_tokens(text, budget, model="gpt-4o"):
+    """
+    Trim `text` to at most `budget` tokens, cutting at line boundaries where possible.
+
+    Returns the text unchanged when it already fits; otherwise keeps whole
+    lines from the start and appends a marker saying how much was dropped.
+    """
+    if not text or budget is None or count_tokens(text, model) <= budget:
+        return text
+    marker = "\n[... truncated to fit a {} token budget ...]".format(budget)
+    remaining = budget - count_tokens(marker, model)
+    kept = []
+    for line in text.splitlines():
+        cost = count_tokens(line + "\n", model)
+        if cost > remaining:
+            if not kept:
+                # A single oversized line: keep as many characters as the budget allows
+                kept.append(line[:max(remaining, 0) * CHARS_PER_TOKEN])
+            break
+        kept.append(line)
+        remaining -= cost
+    return "\n".join(kept) + marker
+
+def compress_text(text, budget=None, model="gpt-4o"):
+    """
+    Cheap lossless-in-meaning compression: drop markdown decoration and redundant whitespace.
+
+    With a token `budget`, text that already fits is returned unchanged, so
+    lists and headings are only lost when the space is actually needed.
+    """
+    if not text or (budget is not None and count_tokens(text, model) <= budget):
+        return text
+    text = re.sub(r"[*_`#]{1,3}", "", text)
+    text = re.sub(r"[ \t]+", " ", text)
+    lines = [line.strip() for line in text.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+# Report sections recognized from headings such as "Chief Complaint:" or "Blood Tests: ...".
+# Text before the first recognized heading is the "header" (patient details).
+SECTION_HEADINGS = {
+    "complaint": r"chief complaint|presenting complaint|reason for (visit|referral)|history of present(ing)? illness|hpi|symptoms",
+    "history": r"(past |personal )?medical history|family history|social history|surgical history|lifestyle( factors)?|past history",
+    "medications": r"(current )?medications?|meds|allergies|drug history",
+    "labs": r"(recent )?lab(oratory)?( and diagnostic)?( tests| results| findings)?|blood (tests|work)|diagnostic results|urinalysis",
+    "ecg": r"electrocardiogram( \(ecg\))?|ecg|ekg|holter( monitor)?.*|echocardiogram|stress test",
+    "imaging": r"imaging|radiology|x-?ray|ct( scan)?|mri|ultrasound|chest x-?ray",
+    "exam": r"physical exam(ination)?( findings)?|vital signs|(cardiovascular|respiratory|neurological|skin|abdominal|general) exam(ination)?",
+    "assessment": r"assessment|impression|plan|diagnosis|differential diagnosis"
+}
+
+# Sections each specialist needs; roles not listed receive the whole report
+ROLE_SECTIONS = {
+    "Cardiologist": {"complaint", "history", "medications", "labs", "ecg", "imaging", "exam"},
+    "Psychologist": {"complaint", "history", "medications", "assessment"},
+    "Pulmonologist": {"complaint", "history", "medications", "labs", "imaging", "exam"},
+    "Neurologist": {"complaint", "history", "medications", "imaging", "exam"},
+    "Dermatologist": {"complaint", "history", "medications", "exam"},
+    "Endocrinologist": {"complaint", "history", "medications", "labs", "exam"}
+}
+
+_HEADING_LINE = re.compile(r"^\s*([A-Za-z][A-Za-z0-9 ()/&,'-]{0,60}?)\s*:\s*(.*)$")
+_section_patterns = {
+    section: re.compile(rf"^({pattern})$", re.IGNORECASE) for section, pattern in SECTION_HEADINGS.items()
+}
+
+def _heading_section(heading):
+    for section, pattern in _section_patterns.items():
+        if pattern.match(heading.strip()):
+            return section
+    return None
+
+def split_sections(medical_report):
+    """
+    Split a report into `(section, text)` chunks in their original order.
+
+    A line starts a new chunk when it begins with a recognized heading
+    followed by a colon; any other line belongs to the current chunk.
+    """
+    chunks = []
+    section, lines = "header", []
+    for line in medical_report.splitlines():
+        match = _HEADING_LINE.match(line)
+        new_section = _heading_section(match.group(1)) if match else None
+        if new_section is not None:
+            if lines:
+                chunks.append((section, "\n".join(lines)))
+            section, lines = new_section, []
+        lines.append(line)
+    if lines:
+        chunks.append((section, "\n".join(lines)))
+    return chunks
+
+def slice_report(medical_report, roles, token_budget=None, model="gpt-4o"):
+    """
+    Keep only the report sections relevant to `roles` (one role or a list), within `token_budget`.
+
+    The header is always kept. Reports without any recognized headings, and
+    roles without a ROLE_SECTIONS entry, get the whole report, so slicing
+    never hides information it cannot classify.
+    """
+    if isinstance(roles, str):
+        roles = [roles]
+    chunks = split_sections(medical_report)
+    if all(section == "header" for section, _ in chunks) or any(role not in ROLE_SECTIONS for role in roles):
+        sliced = medical_report
+    else:
+        wanted = {"header"}.union(*(ROLE_SECTIONS[role] for role in roles))
+        sliced = "\n".join(text for section, text in chunks if section in wanted)
+    return truncate_to_tokens(sliced, token_budget, model)
+
+def budget_specialist_reports(responses, token_budget, model="gpt-4o"):
+    """Compress each specialist's output that exceeds `token_budget` tokens and cap it there before the team step"""
+    if token_budget is None:
+        return dict(responses)
+    return {
+        role: truncate_to_tokens(compress_text(response, token_budget, model), token_budget, model) if response is not None else None
+        for role, response in responses.items()
+    }
@@ -0,0 +1,34 @@
+import asyncio
+import threading
+
+
+class BackgroundLoop:
+    """
+    An asyncio event loop running forever on a daemon thread.
+
+    Async HTTP clients are bound to the loop that opened them (see
+    get_chat_model), so running every analysis on one long-lived loop lets
+    them reuse the same connection pool instead of opening a new one per
+    asyncio.run().
+    """
+
+    def __init__(self, name="analysis-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """Schedule `coroutine` on the loop; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
@@ -0,0 +1,374 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+# HTTP statuses worth retrying: throttling, timeouts and transient server errors
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+_RETRYABLE_NAMES = ("RateLimit", "Timeout", "APIConnection", "ConnectionError", "InternalServer", "ServiceUnavailable")
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate_per_minute`, holding at most `capacity`.
+
+    reserve() always succeeds and returns how long the caller must wait
+    before using what it reserved; the balance may go negative, which
+    queues later callers behind earlier ones.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.available -= amount
+            return -self.available / self.rate if self.available < 0 else 0.0
+
+    def refund(self, amount):
+        """Return (or, if negative, charge) tokens once the actual usage is known"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.available = min(self.capacity, self.available + amount)
+
+
+class RetryableError(Exception):
+    """Raised by callers to force a retry; `retry_after` (seconds) is honored if set"""
+
+    def __init__(self, message="", retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def classify_error(exc):
+    """
+    Return `(retryable, throttled, retry_after)` for an exception from a chat model.
+
+    Works on OpenAI/httpx errors without importing them, by looking at the
+    status code, Retry-After headers and exception class names.
+    """
+    status = getattr(exc, "status_code", None)
+    response = getattr(exc, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+
+    retry_after = getattr(exc, "retry_after", None)
+    headers = getattr(response, "headers", None) or {}
+    if retry_after is None:
+        try:
+            if "retry-after-ms" in headers:
+                retry_after = float(headers["retry-after-ms"]) / 1000.0
+            elif "retry-after" in headers:
+                retry_after = float(headers["retry-after"])
+        except (TypeError, ValueError):
+            retry_after = None
+
+    # Client libraries wrap provider errors in their own subclasses, so check the whole hierarchy
+    names = " ".join(cls.__name__ for cls in type(exc).__mro__)
+    throttled = status == 429 or "RateLimit" in names
+    retryable = (
+        isinstance(exc, (RetryableError, asyncio.TimeoutError, TimeoutError, ConnectionError))
+        or status in RETRYABLE_STATUS
+        or any(part in names for part in _RETRYABLE_NAMES)
+    )
+    return retryable, throttled, retry_after
+
+
+class LLMScheduler:
+    """
+    Shared admission control and retry policy for every LLM call in the process.
+
+    Calls are admitted when requests-per-minute and tokens-per-minute token
+    buckets allow it and fewer than the current concurrency limit are in
+    flight. The limit adapts AIMD-style: it grows by roughly one slot per
+    window of successful calls and halves (at most once per cooldown) when
+    the provider throttles. Failed calls are retried with full-jitter
+    exponential backoff, never sooner than the provider's Retry-After.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=300_000, max_concurrency=32,
+                 initial_concurrency=None, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 expected_completion_tokens=800, decrease_cooldown=5.0):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(initial_concurrency or max(1, max_concurrency // 2))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.expected_completion_tokens = expected_completion_tokens
+        self.decrease_cooldown = decrease_cooldown
+
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._async_waiters = []
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+
+    # -- concurrency slots ---------------------------------------------------
+
+    def _has_slot(self):
+        return self._in_flight < max(1, int(self.concurrency_limit))
+
+    def _wake_waiters(self):
+        # Called with the lock held, whenever slots may have become available
+        free = max(1, int(self.concurrency_limit)) - self._in_flight
+        while free > 0 and self._async_waiters:
+            loop, future = self._async_waiters.pop(0)
+            if not future.done():
+                loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+                free -= 1
+        self._slot_freed.notify_all()
+
+    def _acquire(self):
+        with self._lock:
+            while not self._has_slot():
+                self._slot_freed.wait()
+            self._in_flight += 1
+
+    async def _acquire_async(self):
+        while True:
+            with self._lock:
+                if self._has_slot():
+                    self._in_flight += 1
+                    return
+                future = asyncio.get_running_loop().create_future()
+                self._async_waiters.append((asyncio.get_running_loop(), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    self._async_waiters = [w for w in self._async_waiters if w[1] is not future]
+                    # We may have been woken just before cancellation; pass the slot on
+                    self._wake_waiters()
+                raise
+
+    def _release(self, outcome):
+        with self._lock:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if outcome == "throttled":
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+                    self._last_decrease = now
+            elif outcome == "success":
+                self.concurrency_limit = min(
+                    float(self.max_concurrency), self.concurrency_limit + 1.0 / self.concurrency_limit
+                )
+            self._wake_waiters()
+
+    # -- rate budgets and backoff -------------------------------------------
+
+    def _admission_delay(self, prompt_tokens):
+        estimate = prompt_tokens + self.expected_completion_tokens
+        return max(self.request_bucket.reserve(1), self.token_bucket.reserve(estimate)), estimate
+
+    def _settle_tokens(self, estimate, response):
+        usage = getattr(response, "usage_metadata", None) or {}
+        actual = usage.get("total_tokens") if isinstance(usage, dict) else None
+        if actual is not None:
+            self.token_bucket.refund(estimate - actual)
+
+    def _backoff(self, attempt, retry_after):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    def _handle_failure(self, exc, attempt, label):
+        """Record a failed attempt; returns the delay before retrying, or re-raises"""
+        retryable, throttled, retry_after = classify_error(exc)
+        with self._lock:
+            if throttled:
+                self.throttled += 1
+            if not retryable or attempt >= self.max_retries:
+                self.failures += 1
+                raise exc
+            self.retries += 1
+        delay = self._backoff(attempt, retry_after)
+        print(f"{label} failed ({type(exc).__name__}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        return delay, ("throttled" if throttled else "error")
+
+    # -- public API ----------------------------------------------------------
+
+    def call(self, fn, prompt_tokens=0, label="LLM call", on_admit=None):
+        """
+        Run `fn()` under the rate budgets and retry policy, blocking the calling thread.
+
+        `on_admit(waited)`, if given, is called each time an attempt is
+        admitted with the seconds it waited for the budgets and a slot.
+        """
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            delay, estimate = self._admission_delay(prompt_tokens)
+            if delay:
+                time.sleep(delay)
+            self._acquire()
+            if on_admit is not None:
+                on_admit(time.monotonic() - queued_at)
+            outcome = "error"
+            try:
+                with self._lock:
+                    self.calls += 1
+                response = fn()
+                outcome = "success"
+                self._settle_tokens(estimate, response)
+                return response
+            except Exception as e:
+                delay, outcome = self._handle_failure(e, attempt, label)
+            finally:
+                self._release(outcome)
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, coroutine_fn, prompt_tokens=0, label="LLM call", on_admit=None):
+        """Async counterpart of call(); `coroutine_fn()` must return a fresh awaitable per attempt"""
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            delay, estimate = self._admission_delay(prompt_tokens)
+            if delay:
+                await asyncio.sleep(delay)
+            await self._acquire_async()
+            if on_admit is not None:
+                on_admit(time.monotonic() - queued_at)
+            outcome = "error"
+            try:
+                with self._lock:
+                    self.calls += 1
+                response = await coroutine_fn()
+                outcome = "success"
+                self._settle_tokens(estimate, response)
+                return response
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            except Exception as e:
+                delay, outcome = self._handle_failure(e, attempt, label)
+            finally:
+                self._release(outcome)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stream(self, stream_fn, prompt_tokens=0, label="LLM stream", on_admit=None):
+        """
+        Iterate `stream_fn()` under the scheduler. Failures before the first
+        chunk are retried; once output has been yielded, errors propagate.
+        """
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            delay, _ = self._admission_delay(prompt_tokens)
+            if delay:
+                time.sleep(delay)
+            self._acquire()
+            if on_admit is not None:
+                on_admit(time.monotonic() - queued_at)
+            outcome = "error"
+            started = False
+            try:
+                with self._lock:
+                    self.calls += 1
+                for chunk in stream_fn():
+                    started = True
+                    yield chunk
+                outcome = "success"
+                return
+            except Exception as e:
+                if started:
+                    raise
+                delay, outcome = self._handle_failure(e, attempt, label)
+            finally:
+                self._release(outcome)
+            time.sleep(delay)
+            attempt += 1
+
+    async def astream(self, stream_fn, prompt_tokens=0, label="LLM stream", on_admit=None):
+        """Async counterpart of stream()"""
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            delay, _ = self._admission_delay(prompt_tokens)
+            if delay:
+                await asyncio.sleep(delay)
+            await self._acquire_async()
+            if on_admit is not None:
+                on_admit(time.monotonic() - queued_at)
+            outcome = "error"
+            started = False
+            try:
+                with self._lock:
+                    self.calls += 1
+                async for chunk in stream_fn():
+                    started = True
+                    yield chunk
+                outcome = "success"
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                outcome = "cancelled"
+                raise
+            except Exception as e:
+                if started:
+                    raise
+                delay, outcome = self._handle_failure(e, attempt, label)
+            finally:
+                self._release(outcome)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def has_capacity(self):
+        """True when a new call would get a concurrency slot without waiting"""
+        with self._lock:
+            return self._has_slot()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "failures": self.failures,
+                "in_flight": self._in_flight,
+                "concurrency_limit": round(self.concurrency_limit, 2)
+            }
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """
+    Return the process-wide scheduler, creating it on first use.
+
+    Configured through LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE,
+    LLM_MAX_CONCURRENCY and LLM_MAX_RETRIES.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler(
+                requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", "500")),
+                tokens_per_minute=float(os.getenv("LLM_TOKENS_PER_MINUTE", "300000")),
+                max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "32")),
+                max_retries=int(os.getenv("LLM_MAX_RETRIES", "5"))
+            )
+        return _scheduler
+
+def set_scheduler(scheduler):
+    """Replace the process-wide scheduler, e.g. to apply different provider limits"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
@@ -0,0 +1,118 @@
+import hashlib
+import re
+
+import numpy as np
+
+# Hash functions per MinHash signature; signatures are stored as NUM_PERM uint32 values
+NUM_PERM = 64
+# Words per shingle; a typo then changes only a few of a report's shingles
+SHINGLE_WORDS = 3
+
+_DATE = re.compile(
+    r"\b(\d{4}[-/.]\d{1,2}[-/.]\d{1,2}"
+    r"|\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4}"
+    r"|(jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.? \d{1,2}(st|nd|rd|th)?,? \d{4}"
+    r"|\d{1,2}(st|nd|rd|th)? (jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?,? \d{4})\b"
+)
+_TIME = re.compile(r"\b\d{1,2}:\d{2}(:\d{2})?\s*(am|pm)?\b")
+_WORD = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+# Fixed odd multipliers and offsets, so signatures stay comparable across processes and restarts
+_rng = np.random.default_rng(20240517)
+_MULTIPLIERS = _rng.integers(1, 2**63, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_OFFSETS = _rng.integers(0, 2**63, size=NUM_PERM, dtype=np.uint64)
+
+
+def normalize_report(text):
+    """Lower-cased words of a report, with dates and times removed so re-submitted copies compare equal"""
+    text = _TIME.sub(" ", _DATE.sub(" ", text.lower()))
+    return _WORD.findall(text)
+
+
+def numeric_fingerprint(text):
+    """
+    Hash of the numbers in a report, in order, after dates and times are removed.
+    Reports only count as near-duplicates when these match, so a changed lab
+    value or dose is never mistaken for a trivial edit.
+    """
+    numbers = [word for word in normalize_report(text) if word[0].isdigit()]
+    return hashlib.blake2b(" ".join(numbers).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def minhash_signature(text):
+    """MinHash signature (NUM_PERM uint32 values) of the report's word shingles"""
+    words = normalize_report(text)
+    size = min(SHINGLE_WORDS, len(words)) or 1
+    shingles = {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+         for shingle in shingles),
+        dtype=np.uint64, count=len(shingles)
+    )
+    # Multiply-shift hashing: the top 32 bits of a*h + b (mod 2**64) for each hash function
+    permuted = (hashes[:, None] * _MULTIPLIERS + _OFFSETS) >> np.uint64(32)
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def is_trivial_edit(original, edited):
+    """
+    Whether `edited` differs from `original` only in whitespace, punctuation
+    and case. MinHash similarity alone cannot tell: "no signs of ischemia"
+    and "signs of ischemia" share almost every shingle, and a one-letter
+    edit can change a finding ("left" to "lift", "ileum" to "ilium"). So
+    every word, number and date must be the same.
+    """
+    return _WORD.findall(original.lower()) == _WORD.findall(edited.lower())
+
+
+def lsh_bands(threshold, num_perm=NUM_PERM):
+    """
+    Bands for locality-sensitive hashing that make pairs at `threshold`
+    similarity very likely to share a bucket: the most rows per band whose
+    collision threshold (1/bands)**(1/rows) stays below `threshold`.
+    """
+    for rows in range(num_perm, 0, -1):
+        if num_perm % rows == 0 and (rows / num_perm) ** (1 / rows) <= threshold - 0.1:
+            return num_perm // rows, rows
+    return num_perm, 1
+
+
+class NearDuplicateIndex:
+    """
+    In-memory MinHash LSH index of report signatures.
+
+    Each signature is split into bands and filed under one bucket per band,
+    so a query only compares against reports sharing a bucket rather than
+    scanning every report; candidates are then kept if their estimated
+    Jaccard similarity reaches `threshold`. Entries are filed under a
+    `group` (e.g. the analysis settings) and only match within it.
+    """
+
+    def __init__(self, threshold=0.9):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_bands(threshold)
+        self._buckets = {}
+        self._signatures = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def _keys(self, signature, group):
+        data = signature.tobytes()
+        width = self.rows * signature.itemsize
+        return [(group, band, data[band * width:(band + 1) * width]) for band in range(self.bands)]
+
+    def add(self, item_id, signature, group=None):
+        self._signatures[item_id] = signature
+        for key in self._keys(signature, group):
+            self._buckets.setdefault(key, []).append(item_id)
+
+    def query(self, signature, group=None):
+        """(item id, estimated similarity) of the most similar indexed entry at or above the threshold, or None"""
+        candidates = {item_id for key in self._keys(signature, group) for item_id in self._buckets.get(key, ())}
+        best = None
+        for item_id in candidates:
+            similarity = float(np.count_nonzero(self._signatures[item_id] == signature)) / signature.size
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (item_id, similarity)
+        return best
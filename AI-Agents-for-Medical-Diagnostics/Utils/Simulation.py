@@ -0,0 +1,173 @@
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+import time
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+from Utils.Preprocessing import count_tokens
+
+# Tokens emitted per streamed chunk; real APIs send a few tokens per server-sent event
+CHUNK_TOKENS = 4
+
+_PANEL_KEYS = re.compile(r"exactly these keys: (.+?)\.\s*$", re.MULTILINE)
+_FILLER = (
+    "Possible cause: findings are consistent with the reported symptoms. "
+    "Recommended next step: targeted testing and follow-up review. "
+).split()
+_WEAK_ANSWER = "I'm sorry, but it is unclear from this report what is causing the symptoms."
+
+# How much faster smaller models answer in simulated runs: time to first token is
+# divided by the factor and the token rate multiplied by it
+MODEL_SPEEDUPS = {
+    "gpt-4o-mini": 2.0,
+    "gpt-4.1-mini": 1.6
+}
+
+
+class SimulatedAPIError(Exception):
+    """Error raised by SimulatedChatModel; mirrors the status code and Retry-After of a provider error"""
+
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class SimulatedRateLimitError(SimulatedAPIError):
+    def __init__(self, retry_after=None):
+        super().__init__("Simulated rate limit exceeded", 429, retry_after)
+
+
+class SimulatedChatModel(BaseChatModel):
+    """
+    Offline stand-in for ChatOpenAI with a configurable latency and failure profile.
+
+    Time to first token is log-normal around `ttft_median` (spread
+    `ttft_sigma`), plus the prompt's tokens at `prefill_tokens_per_second`
+    when set; then `output_tokens` are produced at `tokens_per_second`.
+    Each call fails with probability `error_rate` (HTTP 500) or
+    `rate_limit_rate` (HTTP 429 with `retry_after`), and with probability
+    `weak_answer_rate` answers with a short non-answer that fails the
+    cascade's quality check. Responses carry token
+    usage like the real API, and calls bound with a JSON `response_format`
+    (the specialist panel) return an object with the requested keys.
+    """
+
+    ttft_median: float = 0.5
+    ttft_sigma: float = 0.5
+    tokens_per_second: float = 80.0
+    prefill_tokens_per_second: float | None = None
+    output_tokens: int = 300
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 0.5
+    weak_answer_rate: float = 0.0
+    seed: int | None = None
+    _rng: random.Random = PrivateAttr(default=None)
+
+    def model_post_init(self, context):
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self):
+        return "simulated"
+
+    def _plan(self, messages, kwargs):
+        """Draw one call's outcome: (first-token delay, response text, usage) or raise its injected error"""
+        roll = self._rng.random()
+        if roll < self.rate_limit_rate:
+            raise SimulatedRateLimitError(self.retry_after)
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise SimulatedAPIError("Simulated server error", 500)
+        ttft = self.ttft_median * math.exp(self._rng.gauss(0, self.ttft_sigma))
+        prompt = "\n".join(str(message.content) for message in messages)
+        output_tokens = self.output_tokens
+        if self.weak_answer_rate and self._rng.random() < self.weak_answer_rate:
+            text = _WEAK_ANSWER
+            output_tokens = count_tokens(text)
+        else:
+            text = " ".join(_FILLER[i % len(_FILLER)] for i in range(output_tokens))
+        if (kwargs.get("response_format") or {}).get("type") == "json_object":
+            match = _PANEL_KEYS.search(prompt)
+            keys = re.findall(r'"([^"]+)"', match.group(1)) if match else []
+            text = json.dumps({key: text for key in keys})
+        if self.prefill_tokens_per_second:
+            ttft += count_tokens(prompt) / self.prefill_tokens_per_second
+        usage = {
+            "input_tokens": count_tokens(prompt),
+            "output_tokens": output_tokens,
+            "total_tokens": count_tokens(prompt) + output_tokens
+        }
+        return ttft, text, usage
+
+    def _chunks(self, text):
+        words = text.split(" ")
+        for start in range(0, len(words), CHUNK_TOKENS):
+            piece = " ".join(words[start:start + CHUNK_TOKENS])
+            yield piece if start == 0 else " " + piece
+
+    def _generation_time(self, usage):
+        return usage["output_tokens"] / self.tokens_per_second
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        ttft, text, usage = self._plan(messages, kwargs)
+        time.sleep(ttft + self._generation_time(usage))
+        message = AIMessage(content=text, usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        ttft, text, usage = self._plan(messages, kwargs)
+        await asyncio.sleep(ttft + self._generation_time(usage))
+        message = AIMessage(content=text, usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        ttft, text, usage = self._plan(messages, kwargs)
+        time.sleep(ttft)
+        for piece in self._chunks(text):
+            time.sleep(CHUNK_TOKENS / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        ttft, text, usage = self._plan(messages, kwargs)
+        await asyncio.sleep(ttft)
+        for piece in self._chunks(text):
+            await asyncio.sleep(CHUNK_TOKENS / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+
+def simulated_model_factory(weak_answer_rates=None, **profile):
+    """
+    A get_chat_model() factory returning one shared SimulatedChatModel per
+    model name, so a seeded run draws a reproducible sequence of outcomes.
+    Models in MODEL_SPEEDUPS answer that much faster than `profile`, and
+    `weak_answer_rates` maps model names to their `weak_answer_rate`. The
+    OpenAI client settings (timeout, max_retries...) are ignored.
+    """
+    models = {}
+    lock = threading.Lock()
+
+    def factory(model_name, temperature, **params):
+        with lock:
+            if model_name not in models:
+                seed = profile.get("seed")
+                model = SimulatedChatModel(**dict(
+                    profile,
+                    weak_answer_rate=(weak_answer_rates or {}).get(model_name, 0.0),
+                    seed=seed + len(models) if seed is not None else None
+                ))
+                speedup = MODEL_SPEEDUPS.get(model_name, 1.0)
+                model.ttft_median /= speedup
+                model.tokens_per_second *= speedup
+                models[model_name] = model
+            return models[model_name]
+    return factory
@@ -0,0 +1,116 @@
+import os
+import re
+import threading
+from dataclasses import dataclass, field
+
+# Roles that combine several specialists rather than answering as one
+TEAM_ROLE = "MultidisciplinaryTeam"
+PANEL_ROLE = "SpecialistPanel"
+SUMMARY_ROLE = "SystemSummarizer"
+
+_REFUSAL = re.compile(r"\b(i'?m sorry|i am sorry|i cannot|i can'?t|i'?m unable|i am unable|as an ai)\b", re.IGNORECASE)
+_UNCERTAIN = re.compile(
+    r"\b(unclear|uncertain|cannot be determined|cannot determine|not enough information|insufficient information"
+    r"|difficult to (say|determine))\b",
+    re.IGNORECASE
+)
+_NEXT_STEPS = re.compile(r"\b(recommend\w*|next steps?|refer\w*|follow[- ]up|test\w*|evaluat\w*|monitor\w*)\b",
+                         re.IGNORECASE)
+
+
+def check_specialist_output(text, min_words=60, max_uncertain=2):
+    """
+    Local quality check of a specialist's answer, without another model
+    call. Returns the problems found; an empty list means the answer
+    passes. Answers that are missing, short, decline to answer, give no
+    next steps or hedge repeatedly fail.
+    """
+    if not text or not text.strip():
+        return ["no answer"]
+    problems = []
+    words = len(text.split())
+    if words < min_words:
+        problems.append(f"only {words} words")
+    if _REFUSAL.search(text):
+        problems.append("declines to answer")
+    if not _NEXT_STEPS.search(text):
+        problems.append("no recommended next steps")
+    uncertain = len(_UNCERTAIN.findall(text))
+    if uncertain > max_uncertain:
+        problems.append(f"{uncertain} statements of uncertainty")
+    return problems
+
+
+@dataclass
+class ModelTiers:
+    """
+    The model each agent role runs on.
+
+    Specialists (as well as the specialist panel and the organ system
+    summaries of hierarchical synthesis) use `specialist_model` and the
+    team synthesis uses `team_model`, unless `role_models` names a model for
+    the role. With a `cascade_model`, a specialist answer that fails
+    check_specialist_output() is asked again of that model, so a small
+    specialist model only pays flagship latency and price for the reports
+    it cannot handle.
+    """
+    specialist_model: str = "gpt-4o"
+    team_model: str = "gpt-4o"
+    role_models: dict = field(default_factory=dict)
+    cascade_model: str = None
+    # Thresholds of the cascade's quality check
+    min_words: int = 60
+    max_uncertain: int = 2
+
+    def model_for(self, role):
+        if role in self.role_models:
+            return self.role_models[role]
+        return self.team_model if role == TEAM_ROLE else self.specialist_model
+
+    def escalation_for(self, role, model_name, text):
+        """
+        (model, problems) when a specialist's answer from `model_name` should be
+        re-run on the cascade model, else None. Combined roles never escalate.
+        """
+        if self.cascade_model in (None, model_name) or role in (TEAM_ROLE, PANEL_ROLE, SUMMARY_ROLE):
+            return None
+        problems = check_specialist_output(text, self.min_words, self.max_uncertain)
+        return (self.cascade_model, problems) if problems else None
+
+
+def parse_role_models(value):
+    """Parse "Cardiologist=gpt-4o,Neurologist=gpt-4.1" into a dict"""
+    role_models = {}
+    for item in (value or "").split(","):
+        if item.strip():
+            role, _, model = item.partition("=")
+            role_models[role.strip()] = model.strip()
+    return role_models
+
+
+_model_tiers = None
+_model_tiers_lock = threading.Lock()
+
+def get_model_tiers():
+    """
+    Return the process-wide model tiers, configured on first use from
+    LLM_SPECIALIST_MODEL, LLM_TEAM_MODEL, LLM_ROLE_MODELS
+    ("Role=model,...") and LLM_CASCADE_MODEL. Every role runs on gpt-4o
+    without a cascade by default.
+    """
+    global _model_tiers
+    with _model_tiers_lock:
+        if _model_tiers is None:
+            _model_tiers = ModelTiers(
+                specialist_model=os.getenv("LLM_SPECIALIST_MODEL", "gpt-4o"),
+                team_model=os.getenv("LLM_TEAM_MODEL", "gpt-4o"),
+                role_models=parse_role_models(os.getenv("LLM_ROLE_MODELS")),
+                cascade_model=os.getenv("LLM_CASCADE_MODEL") or None
+            )
+        return _model_tiers
+
+def set_model_tiers(tiers):
+    """Replace the process-wide model tiers for agents created afterwards; None goes back to the environment's"""
+    global _model_tiers
+    with _model_tiers_lock:
+        _model_tiers = tiers
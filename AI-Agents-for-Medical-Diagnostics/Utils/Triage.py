@@ -0,0 +1,145 @@
+import math
+import re
+import threading
+
+# Keyword rules per specialist: term -> weight. Terms match at word starts,
+# so "palpitation" also covers "palpitations". Extend this dict to triage
+# additional specialists.
+TRIAGE_RULES = {
+    "Cardiologist": {
+        "chest pain": 3, "palpitation": 3, "heart": 1.5, "cardiac": 1.5, "ecg": 1.5,
+        "electrocardiogram": 1.5, "arrhythmia": 3, "tachycardia": 2.5, "bradycardia": 2.5,
+        "murmur": 2, "troponin": 2, "echocardiogram": 1, "holter": 1.5, "syncope": 2.5,
+        "hypertension": 2, "blood pressure": 1, "edema": 1.5, "angina": 3, "myocardial": 3
+    },
+    "Psychologist": {
+        "anxiety": 3, "panic": 3, "depress": 3, "stress": 1.5, "impending doom": 3,
+        "mood": 2, "insomnia": 2, "trauma": 2, "ptsd": 3, "suicid": 3, "therapy": 1,
+        "benzodiazepine": 2, "lorazepam": 2, "ssri": 2, "sertraline": 2, "psychiatric": 2
+    },
+    "Pulmonologist": {
+        "shortness of breath": 3, "dyspnea": 3, "cough": 2.5, "wheez": 3, "asthma": 3,
+        "copd": 3, "lung": 1.5, "respiratory": 1.5, "breath sounds": 1, "spirometry": 2,
+        "oxygen saturation": 1.5, "hypoxia": 3, "pneumonia": 3, "crackles": 2, "inhaler": 2
+    },
+    "Neurologist": {
+        "dizziness": 2.5, "headache": 3, "migraine": 3, "seizure": 3, "numbness": 3,
+        "tingling": 2.5, "tremor": 3, "weakness": 1.5, "vertigo": 2.5, "memory": 2,
+        "confusion": 2, "neurolog": 1.5, "mri": 1, "eeg": 2, "stroke": 3, "faint": 2
+    },
+    "Dermatologist": {
+        "rash": 3, "skin": 2, "lesion": 3, "itch": 2.5, "pruritus": 2.5, "eczema": 3,
+        "psoriasis": 3, "urticaria": 3, "hives": 3, "mole": 2.5, "acne": 3, "dermat": 2,
+        "flushing": 2, "alopecia": 3
+    },
+    "Endocrinologist": {
+        "thyroid": 2.5, "diabet": 3, "glucose": 2.5, "hba1c": 3, "insulin": 2.5,
+        "hormone": 2, "weight loss": 2, "weight gain": 2, "sweating": 1.5, "heat intolerance": 3,
+        "cortisol": 3, "adrenal": 3, "metanephrine": 3, "endocrin": 2, "tsh": 2.5
+    }
+}
+
+# Cues that negate a finding when they appear shortly before it in the same clause
+_NEGATION_CUES = re.compile(r"\b(no|not|denies|denied|without|negative for|absence of|free of)\b")
+_CLAUSE_BREAK = re.compile(r"[.;:\n]")
+_NEGATION_WINDOW = 40
+
+_compiled_rules = {}
+
+def _compiled(role):
+    if role not in _compiled_rules:
+        _compiled_rules[role] = [
+            (term, weight, re.compile(r"\b" + re.escape(term)))
+            for term, weight in TRIAGE_RULES[role].items()
+        ]
+    return _compiled_rules[role]
+
+def is_negated(text, start):
+    """Whether a match at `start` of lower-cased `text` is preceded by a negation in the same clause"""
+    window = text[max(0, start - _NEGATION_WINDOW):start]
+    clause = _CLAUSE_BREAK.split(window)[-1]
+    return _NEGATION_CUES.search(clause) is not None
+
+def keyword_scores(medical_report):
+    """
+    Score each specialist's relevance from the keyword rules.
+
+    Each matched term contributes its weight, damped logarithmically for
+    repeats; mentions in a negated clause ("no wheezing") are ignored.
+    Returns `({role: score}, {role: [matched terms]})`.
+    """
+    text = medical_report.lower()
+    scores = {}
+    reasons = {}
+    for role in TRIAGE_RULES:
+        score = 0.0
+        matched = []
+        for term, weight, pattern in _compiled(role):
+            hits = sum(1 for match in pattern.finditer(text) if not is_negated(text, match.start()))
+            if hits:
+                score += weight * (1 + math.log(hits))
+                matched.append(term)
+        scores[role] = score
+        reasons[role] = matched
+    return scores, reasons
+
+
+_triage_scorer = None
+_triage_scorer_lock = threading.Lock()
+
+def get_triage_scorer():
+    """The scorer used by triage_report() when none is passed, or None for keyword rules only"""
+    with _triage_scorer_lock:
+        return _triage_scorer
+
+def set_triage_scorer(scorer):
+    """
+    Register a callable returning `{role: score}` for a report, whose scores
+    are added to the keyword scores of every triage; pass None to remove it.
+    """
+    global _triage_scorer
+    with _triage_scorer_lock:
+        _triage_scorer = scorer
+
+
+class TriageResult:
+    def __init__(self, selected, scores, reasons):
+        self.selected = selected
+        self.scores = scores
+        self.reasons = reasons
+
+    @property
+    def skipped(self):
+        return [role for role in self.scores if role not in self.selected]
+
+    def __repr__(self):
+        return f"TriageResult(selected={self.selected}, skipped={self.skipped})"
+
+
+def triage_report(medical_report, roles=None, threshold=3.0, min_specialists=2, always_consult=(), scorer=None):
+    """
+    Decide locally, without any LLM call, which specialists to consult for a report.
+
+    A specialist is consulted when its score reaches `threshold`, when it is
+    listed in `always_consult`, or when it is among the `min_specialists`
+    highest scoring roles. `scorer`, if given, is a callable returning
+    `{role: score}` for the report; its scores are added to the keyword
+    scores, which lets a lightweight learned model refine the rules; it
+    defaults to the one registered with set_triage_scorer().
+    Selected roles keep the order of `roles`.
+    """
+    roles = list(roles or TRIAGE_RULES)
+    scores, reasons = keyword_scores(medical_report)
+    scores = {role: scores.get(role, 0.0) for role in roles}
+    reasons = {role: reasons.get(role, []) for role in roles}
+    scorer = scorer if scorer is not None else get_triage_scorer()
+    if scorer is not None:
+        for role, extra in scorer(medical_report).items():
+            if role in scores:
+                scores[role] += extra
+
+    chosen = {role for role in roles if scores[role] >= threshold}
+    chosen.update(role for role in always_consult if role in scores)
+    ranked = sorted(roles, key=lambda role: scores[role], reverse=True)
+    chosen.update(ranked[:min_specialists])
+    return TriageResult([role for role in roles if role in chosen], scores, reasons)
@@ -0,0 +1,412 @@
+# Importing the needed modules
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+from dotenv import load_dotenv
+from Utils.Agents import set_chat_model_factory
+from Utils.History import get_analysis_history
+from Utils.Jobs import NEAR_DUPLICATES_FLAG, NEAR_DUPLICATES_OFF, NEAR_DUPLICATES_REUSE, QUEUED, DONE, JobQueue, QueueFullError
+from Utils.Metrics import get_process_metrics
+from Utils.Orchestrator import FANOUT_MODE, HIERARCHICAL_SYNTHESIS, PANEL_MODE, SINGLE_SYNTHESIS, SPECIALISTS, AnalysisCache, AnalysisOptions
+from Utils.Runtime import BackgroundLoop
+from Utils.Scheduler import get_scheduler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import dataclasses
+import json
+import os
+import time
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Loading API key from a dotenv file.
+load_dotenv(dotenv_path='apikey.env')
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = 5 * 1024 * 1024
+# Seconds between progress checks of a streamed analysis
+STREAM_POLL_INTERVAL = 0.2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the diagnosis pipeline over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on (default: 8000)")
+    parser.add_argument("--workers", type=int, default=8, help="Analyses run at once (default: 8)")
+    parser.add_argument("--max-calls", type=int, default=32,
+                        help="LLM calls in flight across all running analyses (default: 32)")
+    parser.add_argument("--max-queued", type=int, default=256,
+                        help="Waiting analyses before submissions are refused with 429 (default: 256)")
+    parser.add_argument("--max-per-client", type=int, default=64,
+                        help="Unfinished analyses per client before its submissions are refused with 429 (default: 64)")
+    parser.add_argument("--max-batch", type=int, default=100, help="Reports accepted in one request (default: 100)")
+    parser.add_argument("--retry-after", type=int, default=5,
+                        help="Seconds clients are asked to wait after a 429 response (default: 5)")
+    parser.add_argument("--keep-results", type=int, default=1024,
+                        help="Finished analyses whose results stay available (default: 1024)")
+    parser.add_argument("--near-duplicates", choices=[NEAR_DUPLICATES_REUSE, NEAR_DUPLICATES_FLAG, NEAR_DUPLICATES_OFF],
+                        default=os.getenv("NEAR_DUPLICATE_MODE", NEAR_DUPLICATES_FLAG),
+                        help="For reports nearly identical to an earlier analysis: return that analysis, flag the "
+                             "match, or ignore it (default: NEAR_DUPLICATE_MODE or flag). reuse returns the earlier "
+                             "report's diagnosis, and only for copies differing in whitespace, punctuation or case")
+    parser.add_argument("--simulate", action="store_true",
+                        help="Answer with the simulated chat model instead of the OpenAI API (no network, no cost)")
+    parser.add_argument("--ttft", type=float, default=0.5, help="With --simulate, median seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0, help="With --simulate, generation speed")
+    parser.add_argument("--output-tokens", type=int, default=300, help="With --simulate, tokens per response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="With --simulate, fraction of calls failing")
+    parser.add_argument("--seed", type=int, help="With --simulate, random seed for reproducible runs")
+    return parser.parse_args()
+
+
+# Allowed values of the string options, and the smallest value of the numeric ones
+OPTION_CHOICES = {
+    "mode": (FANOUT_MODE, PANEL_MODE),
+    "synthesis": (SINGLE_SYNTHESIS, HIERARCHICAL_SYNTHESIS)
+}
+OPTION_MINIMUMS = {"synthesis_fan_in": 2}
+
+
+def check_option(field, value):
+    """Raise ValueError naming the field unless `value` suits the AnalysisOptions field"""
+    if value is None and field.default is None:
+        return
+    name = field.name
+    if field.type is bool:
+        if not isinstance(value, bool):
+            raise ValueError(f'"{name}" must be true or false')
+    elif field.type is int:
+        minimum = OPTION_MINIMUMS.get(name, 1)
+        if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+            raise ValueError(f'"{name}" must be an integer of at least {minimum}')
+    elif field.type is float:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+            raise ValueError(f'"{name}" must be a positive number of seconds')
+    elif field.type is str:
+        choices = OPTION_CHOICES[name]
+        if value not in choices:
+            raise ValueError(f'"{name}" must be one of: {", ".join(choices)}')
+    elif name == "always_consult":
+        if not isinstance(value, list) or any(role not in SPECIALISTS for role in value):
+            raise ValueError(f'"{name}" must be a list of specialists: {", ".join(SPECIALISTS)}')
+
+
+def parse_options(data):
+    """AnalysisOptions from a request's "options" object; raises ValueError naming any unknown or invalid setting"""
+    if data is None:
+        return AnalysisOptions()
+    if not isinstance(data, dict):
+        raise ValueError('"options" must be an object')
+    fields = {field.name: field for field in dataclasses.fields(AnalysisOptions)}
+    unknown = sorted(set(data) - set(fields))
+    if unknown:
+        raise ValueError(f"Unknown options: {', '.join(unknown)}")
+    for name, value in data.items():
+        check_option(fields[name], value)
+    if "always_consult" in data:
+        data = dict(data, always_consult=tuple(data["always_consult"]))
+    return AnalysisOptions(**data)
+
+
+def parse_submission(body):
+    """
+    The (report, options) pairs of a submission body, and whether it was a batch.
+
+    A single analysis is {"report": "...", "options": {...}}; a batch is
+    {"reports": ["...", {"report": "...", "options": {...}}], "options": {...}},
+    where the top-level options apply to reports that don't set their own.
+    The body may also set "reuse_similar": false to analyze near-duplicates anyway.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("The request body must be a JSON object")
+    unknown = sorted(set(body) - {"report", "reports", "options", "reuse_similar"})
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}; analysis settings go in \"options\"")
+    if not isinstance(body.get("reuse_similar", True), bool):
+        raise ValueError('"reuse_similar" must be true or false')
+    default_options = body.get("options")
+    batch = "reports" in body
+    entries = body["reports"] if batch else [body]
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('"reports" must be a non-empty list')
+
+    analyses = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"report": entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get("report"), str) or not entry["report"].strip():
+            raise ValueError('Each analysis needs a non-empty "report" string')
+        analyses.append((entry["report"], parse_options(entry.get("options", default_options))))
+    return analyses, batch
+
+
+def job_status(job, job_queue):
+    """Progress of a job without the report-sized texts"""
+    snapshot = job.snapshot()
+    return {
+        "id": snapshot["id"],
+        "status": snapshot["status"],
+        "position": job_queue.position(job.id) if snapshot["status"] == QUEUED else None,
+        "specialists": snapshot["specialist_status"],
+        "team": snapshot["team_status"],
+        "missing": snapshot["missing"],
+        "from_cache": snapshot["from_cache"],
+        "near_duplicate_of": snapshot["near_duplicate_of"],
+        "error": snapshot["error"],
+        "submitted_at": snapshot["submitted_at"],
+        "started_at": snapshot["started_at"],
+        "finished_at": snapshot["finished_at"]
+    }
+
+
+def job_result(job):
+    snapshot = job.snapshot()
+    return {
+        "id": snapshot["id"],
+        "status": snapshot["status"],
+        "final_diagnosis": snapshot["final_diagnosis"],
+        "responses": {role: text for role, text in snapshot["responses"].items() if text is not None},
+        "missing": snapshot["missing"],
+        "from_cache": snapshot["from_cache"],
+        "near_duplicate_of": snapshot["near_duplicate_of"],
+        "error": snapshot["error"],
+        "history_id": snapshot["history_id"],
+        "metrics": job.metrics.summary()
+    }
+
+
+def gauge(name, help_text, value):
+    return f"# HELP {name} {help_text}\n# TYPE {name} gauge\n{name} {value}\n"
+
+
+class DiagnosisAPIHandler(BaseHTTPRequestHandler):
+    """
+    Routes:
+      POST   /v1/analyses              submit one report or a batch (202, or 429 when full)
+      GET    /v1/analyses/<id>         progress
+      GET    /v1/analyses/<id>/result  final diagnosis and specialist reports (202 until finished)
+      GET    /v1/analyses/<id>/stream  server-sent events with incremental specialist output
+      DELETE /v1/analyses/<id>         cancel
+      GET    /v1/history               past analyses, newest first (?q=&role=&report_hash=&limit=&offset=)
+      GET    /v1/history/<id>          one past analysis in full
+      GET    /healthz                  liveness and queue state
+      GET    /metrics                  Prometheus metrics
+    """
+
+    server_version = "MedicalDiagnosisAPI/1.0"
+    protocol_version = "HTTP/1.1"
+
+    # -- routing -------------------------------------------------------------
+
+    def route(self):
+        parts = [part for part in urlsplit(self.path).path.split("/") if part]
+        if parts[:2] != ["v1", "analyses"]:
+            return parts, None
+        return parts[2:], True
+
+    def do_GET(self):
+        parts, analyses = self.route()
+        if analyses is None and parts == ["healthz"]:
+            return self.send_json(200, self.health())
+        if analyses is None and parts == ["metrics"]:
+            return self.send_body(200, self.metrics_text().encode("utf-8"), "text/plain; version=0.0.4")
+        if analyses is None and parts[:2] == ["v1", "history"] and len(parts) <= 3:
+            return self.history(parts[2:])
+        if analyses and len(parts) in (1, 2):
+            job = self.server.job_queue.get(parts[0])
+            if job is None:
+                return self.send_json(404, {"error": "Unknown analysis id"})
+            if len(parts) == 1:
+                return self.send_json(200, job_status(job, self.server.job_queue))
+            if parts[1] == "result":
+                if not job.finished:
+                    return self.send_json(202, job_status(job, self.server.job_queue))
+                return self.send_json(200 if job.status == DONE else 409, job_result(job))
+            if parts[1] == "stream":
+                return self.stream(job)
+        self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        parts, analyses = self.route()
+        if not analyses or parts:
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The body cannot be delimited, so the connection cannot be reused either
+            self.close_connection = True
+            return self.send_json(400, {"error": "Content-Length must be a non-negative integer"})
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            return self.send_json(413, {"error": f"Request body is larger than {MAX_BODY_BYTES} bytes"})
+        try:
+            body = json.loads(self.rfile.read(length) or b"null")
+            submissions, batch = parse_submission(body)
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {"error": str(e)})
+        if len(submissions) > self.server.max_batch:
+            return self.send_json(413, {"error": f"At most {self.server.max_batch} reports per request"})
+
+        try:
+            jobs = self.server.job_queue.submit_batch(submissions, self.client_id(), body.get("reuse_similar") is not False)
+        except QueueFullError as e:
+            return self.send_json(429, {"error": str(e)}, {"Retry-After": str(self.server.retry_after)})
+        except (TypeError, ValueError) as e:
+            # Settings parse_options() let through but the pipeline rejects still get an answer
+            return self.send_json(400, {"error": str(e)})
+        statuses = [job_status(job, self.server.job_queue) for job in jobs]
+        status_code = 200 if all(job.finished for job in jobs) else 202
+        if batch:
+            return self.send_json(status_code, {"analyses": statuses})
+        self.send_json(status_code, statuses[0], {"Location": f"/v1/analyses/{jobs[0].id}"})
+
+    def do_DELETE(self):
+        parts, analyses = self.route()
+        if not analyses or len(parts) != 1:
+            return self.send_json(404, {"error": "Not found"})
+        if self.server.job_queue.get(parts[0]) is None:
+            return self.send_json(404, {"error": "Unknown analysis id"})
+        cancelled = self.server.job_queue.cancel(parts[0])
+        self.send_json(200, {"id": parts[0], "cancelled": cancelled})
+
+    def client_id(self):
+        """Fairness and per-client limits are keyed by X-Client-Id, or the client's address without one"""
+        return self.headers.get("X-Client-Id") or self.client_address[0]
+
+    # -- endpoints -------------------------------------------------------------
+
+    def history(self, parts):
+        history = get_analysis_history()
+        if history is None:
+            return self.send_json(404, {"error": "The analysis history is disabled"})
+        if parts:
+            record = history.get(int(parts[0])) if parts[0].isdigit() else None
+            if record is None:
+                return self.send_json(404, {"error": "Unknown history id"})
+            return self.send_json(200, record)
+
+        query = {name: values[-1] for name, values in parse_qs(urlsplit(self.path).query).items()}
+        try:
+            limit = max(1, min(int(query.get("limit", 20)), 200))
+            offset = int(query.get("offset", 0))
+        except ValueError:
+            return self.send_json(400, {"error": '"limit" and "offset" must be integers'})
+        if offset < 0:
+            return self.send_json(400, {"error": '"offset" must not be negative'})
+        rows, total = history.search(query.get("q"), query.get("role"), query.get("report_hash"), limit, offset)
+        self.send_json(200, {"total": total, "limit": limit, "offset": offset, "analyses": rows})
+
+    def health(self):
+        return {"status": "ok", "queue": self.server.job_queue.stats(), "scheduler": get_scheduler().stats()}
+
+    def metrics_text(self):
+        queue_stats = self.server.job_queue.stats()
+        scheduler_stats = get_scheduler().stats()
+        return (
+            get_process_metrics().to_prometheus()
+            + gauge("analysis_jobs_queued", "Analyses waiting for a worker.", queue_stats["queued"])
+            + gauge("analysis_jobs_running", "Analyses in progress.", queue_stats["running"])
+            + gauge("llm_calls_in_flight", "LLM calls currently admitted by the scheduler.", scheduler_stats["in_flight"])
+            + gauge("llm_concurrency_limit", "Current adaptive limit on LLM calls in flight.",
+                    scheduler_stats["concurrency_limit"])
+        )
+
+    def stream(self, job):
+        """Server-sent events: progress changes, new specialist and team text, then the result"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        last_status = None
+        sent = {}
+        try:
+            while True:
+                # Read before the snapshot, so the final snapshot holds everything
+                finished = job.finished
+                status = job_status(job, self.server.job_queue)
+                progress = {key: status[key] for key in ("status", "position", "specialists", "team", "missing")}
+                if progress != last_status:
+                    self.send_event("status", progress)
+                    last_status = progress
+
+                snapshot = job.snapshot()
+                texts = dict(snapshot["specialist_text"], team=snapshot["team_text"])
+                for role, text in texts.items():
+                    if len(text) < sent.get(role, 0):
+                        # A specialist escalated to a larger model, or the team restarted with late specialists
+                        self.send_event("reset", {"role": role})
+                        sent[role] = 0
+                    if len(text) > sent.get(role, 0):
+                        self.send_event("token", {"role": role, "text": text[sent.get(role, 0):]})
+                        sent[role] = len(text)
+
+                if finished:
+                    self.send_event("result", job_result(job))
+                    return
+                time.sleep(STREAM_POLL_INTERVAL)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; the analysis carries on and its result stays available
+            pass
+
+    # -- responses -------------------------------------------------------------
+
+    def send_event(self, event, data):
+        self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def send_json(self, status_code, payload, headers=None):
+        self.send_body(status_code, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    def send_body(self, status_code, body, content_type, headers=None):
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    args = parse_args()
+    if args.simulate:
+        # Imported here so the real backend doesn't pay for the simulation's imports
+        from Utils.Simulation import simulated_model_factory
+        set_chat_model_factory(simulated_model_factory(
+            ttft_median=args.ttft, tokens_per_second=args.tokens_per_second,
+            output_tokens=args.output_tokens, error_rate=args.error_rate, seed=args.seed
+        ))
+
+    background_loop = BackgroundLoop()
+    server = ThreadingHTTPServer((args.host, args.port), DiagnosisAPIHandler)
+    server.job_queue = JobQueue(
+        background_loop,
+        workers=args.workers,
+        max_concurrent_calls=args.max_calls,
+        max_queued=args.max_queued,
+        max_jobs_per_session=args.max_per_client,
+        analysis_cache=AnalysisCache(max_entries=int(os.getenv("ANALYSIS_CACHE_SIZE", "128"))),
+        keep_finished=args.keep_results,
+        history=get_analysis_history(),
+        source="api",
+        near_duplicates=args.near_duplicates
+    )
+    server.max_batch = args.max_batch
+    server.retry_after = args.retry_after
+
+    backend = "simulated LLM" if args.simulate else "OpenAI API"
+    print(f"Serving the diagnosis API on http://{args.host}:{args.port} ({backend}); press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        background_loop.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# Importing the needed modules
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+from dotenv import load_dotenv
+from Utils.Agents import SpecialistPanel, set_chat_model_factory, set_response_cache
+from Utils.Hedging import HedgePolicy, set_hedge_policy
+from Utils.Metrics import percentile
+from Utils.Orchestrator import FANOUT_MODE, HIERARCHICAL_SYNTHESIS, PANEL_MODE, SINGLE_SYNTHESIS, SPECIALISTS, AnalysisOptions, collect_report_paths, prepare_report, register_specialist, run_batch_async, select_specialists
+from Utils.Preprocessing import count_tokens
+from Utils.Scheduler import LLMScheduler, set_scheduler
+from Utils.Simulation import simulated_model_factory
+from Utils.Tiering import SUMMARY_ROLE, TEAM_ROLE, ModelTiers, set_model_tiers
+import argparse
+import asyncio
+import contextlib
+import itertools
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Loading API key from a dotenv file.
+load_dotenv(dotenv_path='apikey.env')
+
+# Reports per run with --hedge when --reports-count is not given: hedging only starts once enough
+# latencies are known, so a handful of reports would never show a hedge
+HEDGE_REPORTS_COUNT = 100
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the diagnosis pipeline, against the real API or a simulated one.")
+    parser.add_argument("reports", nargs="?", help="Directory or glob of reports to benchmark (e.g. 'Medical Reports/*.txt')")
+    parser.add_argument("--modes", nargs="+", choices=[FANOUT_MODE, PANEL_MODE], default=[FANOUT_MODE, PANEL_MODE],
+                        help="Execution modes to compare (default: both)")
+    parser.add_argument("--triage", action="store_true", help="Triage specialists before running them")
+    parser.add_argument("--no-slicing", action="store_true", help="Send every specialist the whole report")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only compare the size of the specialist prompts; makes no API calls")
+    parser.add_argument("--reports-count", type=int,
+                        help="Number of reports per run; the input reports are repeated as needed (default: one "
+                             f"each, or {HEDGE_REPORTS_COUNT} with --hedge)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[8],
+                        help="Maximum LLM calls in flight; one run per value (default: 8)")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Run every configuration without and with hedged requests, to compare tail latency")
+    parser.add_argument("--hedge-percentile", type=float, default=95,
+                        help="With --hedge, latency percentile after which a call is duplicated (default: 95)")
+    parser.add_argument("--hedge-budget", type=float, default=0.05,
+                        help="With --hedge, maximum fraction of extra requests (default: 0.05)")
+    parser.add_argument("--tiering", action="store_true",
+                        help="Compare every role on --large-model, specialists on --small-model, and the small "
+                             "model with a cascade to the large one")
+    parser.add_argument("--small-model", default="gpt-4o-mini", help="Specialist model for --tiering (default: gpt-4o-mini)")
+    parser.add_argument("--large-model", default="gpt-4o", help="Team and escalation model for --tiering (default: gpt-4o)")
+    parser.add_argument("--synthesis", nargs="+", choices=[SINGLE_SYNTHESIS, HIERARCHICAL_SYNTHESIS],
+                        default=[SINGLE_SYNTHESIS], help="Team synthesis modes to compare (default: single)")
+    parser.add_argument("--synthesis-fan-in", type=int, default=4,
+                        help="Specialist reports per condensing call in hierarchical synthesis (default: 4)")
+    parser.add_argument("--panel-sizes", type=int, nargs="+",
+                        help=f"Specialists consulted per report; benchmark-only specialists are added beyond the "
+                             f"{len(SPECIALISTS)} built-in ones, up to {len(SPECIALISTS) + 14} (default: built-in only)")
+    parser.add_argument("--cold-start", action="store_true",
+                        help="Measure import and first-agent time in fresh interpreters instead of running reports")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per cold-start measurement (default: 5)")
+
+    simulation = parser.add_argument_group("simulated backend")
+    simulation.add_argument("--simulate", action="store_true",
+                            help="Use the simulated chat model instead of the OpenAI API (no network, no cost)")
+    simulation.add_argument("--ttft", type=float, default=0.5, help="Median seconds to first token (default: 0.5)")
+    simulation.add_argument("--ttft-sigma", type=float, default=0.5,
+                            help="Log-normal spread of the time to first token (default: 0.5)")
+    simulation.add_argument("--tokens-per-second", type=float, default=80.0, help="Generation speed (default: 80)")
+    simulation.add_argument("--output-tokens", type=int, default=300, help="Tokens per response (default: 300)")
+    simulation.add_argument("--prefill-tokens-per-second", type=float,
+                            help="Prompt tokens processed per second before the first token (default: no prefill time)")
+    simulation.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls failing with HTTP 500")
+    simulation.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of calls failing with HTTP 429")
+    simulation.add_argument("--weak-answer-rate", type=float, default=0.1,
+                            help="Fraction of --small-model answers too weak to pass the cascade check (default: 0.1)")
+    simulation.add_argument("--seed", type=int, help="Random seed for reproducible runs")
+    simulation.add_argument("--rpm", type=float, default=1e9,
+                            help="Requests per minute enforced by the scheduler (default: unlimited)")
+    simulation.add_argument("--tpm", type=float, default=1e12,
+                            help="Tokens per minute enforced by the scheduler (default: unlimited)")
+    return parser.parse_args()
+
+
+# Specialists registered for --panel-sizes beyond the built-in ones, with their organ systems
+EXTRA_SPECIALISTS = {
+    "Nephrologist": "Renal and urinary",
+    "Gastroenterologist": "Digestive",
+    "Hematologist": "Blood",
+    "Rheumatologist": "Musculoskeletal",
+    "Infectious Disease Specialist": "Immune and infectious",
+    "Oncologist": "Oncology",
+    "Ophthalmologist": "Eye",
+    "Otolaryngologist": "Ear, nose and throat",
+    "Urologist": "Renal and urinary",
+    "Allergist": "Immune and infectious",
+    "Hepatologist": "Digestive",
+    "Sleep Specialist": "Nervous system",
+    "Vascular Surgeon": "Cardiovascular",
+    "Geriatrician": "General"
+}
+
+EXTRA_SPECIALIST_TEMPLATE = """
+        Act like a {role}. You will receive a patient's report.
+        Task: Review the patient's report and provide an assessment from your specialty.
+        Please only return the possible causes of the patient's symptoms within your specialty and the recommended next steps.
+        Patient's Report: {{medical_report}}
+    """
+
+
+def grow_panel(size):
+    """Register benchmark-only specialists until `size` are available"""
+    for role, organ_system in EXTRA_SPECIALISTS.items():
+        if len(SPECIALISTS) >= size:
+            return
+        if role not in SPECIALISTS:
+            register_specialist(role, EXTRA_SPECIALIST_TEMPLATE.format(role=role.lower()), organ_system=organ_system)
+
+
+def team_step_latency(summary):
+    """Seconds of the team step of one report: the slowest condensing call, then the team call"""
+    roles = summary["roles"]
+    return sum(roles[role]["latency_max"] or 0 for role in (SUMMARY_ROLE, TEAM_ROLE) if role in roles)
+
+
+# Startup paths timed by --cold-start, each in a fresh interpreter
+COLD_START_TARGETS = {
+    "orchestration import": "import Utils.Orchestrator",
+    "web app imports": "import streamlit, Utils.Metrics, Utils.Orchestrator",
+    "first specialist agent": "import Utils.Orchestrator as o; o.SPECIALISTS['Cardiologist']('report').build_prompt()",
+    "dashboard charts": "import pandas, plotly.express"
+}
+
+
+def print_cold_start(runs):
+    # Building a client needs a key but makes no request, so any placeholder will do
+    env = dict(os.environ, OPENAI_API_KEY=os.getenv("OPENAI_API_KEY") or "sk-cold-start")
+    print(f"{'startup path':<24} {'median s':>9} {'max s':>7}")
+    for name, code in COLD_START_TARGETS.items():
+        timed = f"import time; started = time.perf_counter(); {code}; print(time.perf_counter() - started)"
+        durations = [
+            float(subprocess.run([sys.executable, "-c", timed], capture_output=True, text=True,
+                                 env=env, check=True).stdout.strip().splitlines()[-1])
+            for _ in range(runs)
+        ]
+        print(f"{name:<24} {statistics.median(durations):>9.3f} {max(durations):>7.3f}")
+
+
+def specialist_prompt_tokens(medical_report, roles, options):
+    """Input tokens sent to the model for the specialist step of one report"""
+    if options.mode == PANEL_MODE:
+        return count_tokens(SpecialistPanel(prepare_report(medical_report, roles, options), roles).build_prompt())
+    return sum(
+        count_tokens(SPECIALISTS[role](prepare_report(medical_report, role, options)).build_prompt())
+        for role in roles
+    )
+
+
+def print_prompt_sizes(reports, args):
+    print(f"{'mode':<8} {'calls/report':>12} {'prompt tokens/report':>21}")
+    for mode in args.modes:
+        options = AnalysisOptions(mode=mode, triage=args.triage, slice_reports=not args.no_slicing)
+        calls, tokens = [], []
+        for medical_report in reports:
+            roles = select_specialists(medical_report, options)
+            calls.append((1 if mode == PANEL_MODE else len(roles)) + 1)
+            tokens.append(specialist_prompt_tokens(medical_report, roles, options))
+        print(f"{mode:<8} {statistics.mean(calls):>12.1f} {statistics.mean(tokens):>21.0f}")
+
+
+def tier_configurations(args):
+    """(name, ModelTiers) for each model configuration to run; None uses the configured tiers"""
+    if not args.tiering:
+        return [("-", None)]
+    return [
+        ("single", ModelTiers(specialist_model=args.large_model, team_model=args.large_model)),
+        ("tiered", ModelTiers(specialist_model=args.small_model, team_model=args.large_model)),
+        ("cascade", ModelTiers(specialist_model=args.small_model, team_model=args.large_model,
+                               cascade_model=args.large_model))
+    ]
+
+
+def run_once(report_paths, options, concurrency, hedge, tiers, args):
+    """Run one batch through the real orchestration; returns per-report summaries, wall time and peak memory"""
+    set_model_tiers(tiers)
+    set_scheduler(LLMScheduler(
+        requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+        max_concurrency=concurrency, initial_concurrency=concurrency
+    ))
+    # A fresh policy per run, so each one learns its latencies from scratch
+    set_hedge_policy(HedgePolicy(percentile=args.hedge_percentile, budget=args.hedge_budget) if hedge else None)
+    summaries = []
+
+    def on_complete(report_path, output_path, metrics):
+        summaries.append(metrics.summary())
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as output_dir:
+        # The pipeline logs every call; keep the benchmark table readable
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(run_batch_async(report_paths, output_dir, concurrency, options, on_complete))
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return summaries, elapsed, peak
+
+
+def main():
+    args = parse_args()
+    if args.cold_start:
+        print_cold_start(args.runs)
+        return
+    if not args.reports:
+        raise SystemExit("A directory or glob of reports is required unless --cold-start is given")
+    report_paths = collect_report_paths(args.reports)
+    if not report_paths:
+        raise SystemExit(f"No reports found for {args.reports!r}")
+    count = args.reports_count or (max(len(report_paths), HEDGE_REPORTS_COUNT) if args.hedge else len(report_paths))
+    report_paths = [report_paths[i % len(report_paths)] for i in range(count)]
+
+    if args.simulate or args.dry_run:
+        # A dry run only builds prompts, so it never needs real credentials
+        set_chat_model_factory(simulated_model_factory(
+            ttft_median=args.ttft, ttft_sigma=args.ttft_sigma, tokens_per_second=args.tokens_per_second,
+            output_tokens=args.output_tokens, prefill_tokens_per_second=args.prefill_tokens_per_second,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate, seed=args.seed,
+            weak_answer_rates={args.small_model: args.weak_answer_rate}
+        ))
+
+    if args.dry_run:
+        reports = []
+        for report_path in report_paths:
+            with open(report_path, "r") as file:
+                reports.append(file.read())
+        print_prompt_sizes(reports, args)
+        return
+
+    # Measure real calls, not cache hits
+    set_response_cache(None)
+
+    print(f"{'mode':<8} {'conc':>5} {'hedge':>5} {'tiers':>7} {'synthesis':>12} {'panel':>5} {'reports':>7} "
+          f"{'calls/rep':>9} {'tokens/rep':>10} {'$/rep':>7} {'reports/s':>9} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} "
+          f"{'team s':>7} {'errors':>6} {'retries':>7} {'hedges':>6} {'escal.':>6} {'peak MB':>8}")
+    # Ascending, since specialists registered for a larger panel cannot be removed again
+    for panel_size in sorted(args.panel_sizes or [len(SPECIALISTS)]):
+        grow_panel(panel_size)
+        for mode, synthesis in itertools.product(args.modes, args.synthesis):
+            options = AnalysisOptions(mode=mode, triage=args.triage, slice_reports=not args.no_slicing,
+                                      synthesis=synthesis, synthesis_fan_in=args.synthesis_fan_in)
+            for concurrency in args.concurrency:
+                for hedge, (tier_name, tiers) in itertools.product([False, True] if args.hedge else [False],
+                                                                   tier_configurations(args)):
+                    summaries, elapsed, peak = run_once(report_paths, options, concurrency, hedge, tiers, args)
+                    latencies = [summary["wall_time"] for summary in summaries]
+                    calls = statistics.mean(summary["calls"] for summary in summaries)
+                    tokens = statistics.mean(summary["prompt_tokens"] for summary in summaries)
+                    cost = statistics.mean(summary["cost"] for summary in summaries)
+                    team = statistics.median(team_step_latency(summary) for summary in summaries)
+                    errors = sum(summary["errors"] for summary in summaries)
+                    retries = sum(summary["retries"] for summary in summaries)
+                    hedges = sum(summary["hedges"] for summary in summaries)
+                    escalations = sum(summary["escalations"] for summary in summaries)
+                    print(f"{mode:<8} {concurrency:>5} {'on' if hedge else 'off':>5} {tier_name:>7} {synthesis:>12} "
+                          f"{len(SPECIALISTS):>5} {len(summaries):>7} {calls:>9.1f} {tokens:>10.0f} {cost:>7.4f} "
+                          f"{len(summaries) / elapsed:>9.2f} {percentile(latencies, 50):>7.2f} "
+                          f"{percentile(latencies, 95):>7.2f} {percentile(latencies, 99):>7.2f} {team:>7.2f} "
+                          f"{errors:>6} {retries:>7} {hedges:>6} {escalations:>6} {peak / 1e6:>8.1f}")
+
+if __name__ == "__main__":
+    main()
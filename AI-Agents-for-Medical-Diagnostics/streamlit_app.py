@@ -1,15 +1,20 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import time
 import json
+import math
 import os
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 # Import our medical agents
-from Utils.Agents import Cardiologist, Psychologist, Pulmonologist, Neurologist, Dermatologist, Endocrinologist, MultidisciplinaryTeam
+from Utils.Agents import get_response_cache
+from Utils.Analytics import get_analytics_store, item_counts, specialist_summary
+from Utils.Findings import extract_findings
+from Utils.History import get_analysis_history
+from Utils.Jobs import CANCELLED, DONE, NEAR_DUPLICATES_FLAG, QUEUED, JobQueue, QueueFullError
+from Utils.Metrics import get_process_metrics
+from Utils.Orchestrator import SPECIALISTS, PANEL_MODE, FANOUT_MODE, HIERARCHICAL_SYNTHESIS, SINGLE_SYNTHESIS, AnalysisCache, AnalysisOptions
+from Utils.Runtime import BackgroundLoop
 
 # Load environment variables
 load_dotenv(dotenv_path='apikey.env')
@@ -70,150 +75,383 @@ if 'agent_responses' not in st.session_state:
     st.session_state.agent_responses = {}
 if 'final_diagnosis' not in st.session_state:
     st.session_state.final_diagnosis = ""
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
-def run_agent_analysis(agent_name, agent):
-    """Run individual agent analysis"""
-    try:
-        response = agent.run()
-        return agent_name, response, "success"
-    except Exception as e:
-        return agent_name, f"Analysis failed: {str(e)}", "error"
+# Display labels for each specialist role
+SPECIALIST_LABELS = {
+    "Cardiologist": "🫀 Cardiologist",
+    "Psychologist": "🧠 Psychologist",
+    "Pulmonologist": "🫁 Pulmonologist",
+    "Neurologist": "🧬 Neurologist",
+    "Dermatologist": "🩺 Dermatologist",
+    "Endocrinologist": "⚕️ Endocrinologist"
+}
 
-def analyze_medical_report(medical_report):
-    """Run all 6 medical agents concurrently"""
-    
-    # Create agents
-    agents = {
-        "🫀 Cardiologist": Cardiologist(medical_report),
-        "🧠 Psychologist": Psychologist(medical_report), 
-        "🫁 Pulmonologist": Pulmonologist(medical_report),
-        "🧬 Neurologist": Neurologist(medical_report),
-        "🩺 Dermatologist": Dermatologist(medical_report),
-        "⚕️ Endocrinologist": Endocrinologist(medical_report)
-    }
+# Display text for each specialist status reported by a job
+SPECIALIST_STATUS_LABELS = {
+    "waiting": "⏳ Waiting...",
+    "writing": "✍️ Writing...",
+    "escalating": "🔼 Asking a larger model...",
+    "complete": "✅ Complete!",
+    "failed": "❌ Failed",
+    "missed_deadline": "⌛ Missed deadline",
+    "skipped": "⏭️ Skipped by triage"
+}
+
+# Seconds between refreshes of a running analysis
+JOB_POLL_INTERVAL = 0.5
+
+@st.cache_resource
+def get_background_loop():
+    """One event loop per server process, so every session and rerun reuses the same async HTTP connections"""
+    return BackgroundLoop()
+
+@st.cache_resource
+def get_analysis_cache():
+    """Completed analyses shared by all sessions, keyed by report text and settings"""
+    return AnalysisCache(max_entries=int(os.getenv("ANALYSIS_CACHE_SIZE", "128")))
+
+@st.cache_resource
+def get_job_queue():
+    """Analyses from every session run here, sharing one bounded budget of LLM calls"""
+    return JobQueue(
+        get_background_loop(),
+        workers=int(os.getenv("JOB_WORKERS", "4")),
+        max_concurrent_calls=int(os.getenv("JOB_MAX_CONCURRENT_CALLS", "16")),
+        max_queued=int(os.getenv("JOB_MAX_QUEUED", "32")),
+        max_jobs_per_session=int(os.getenv("JOB_MAX_PER_SESSION", "2")),
+        analysis_cache=get_analysis_cache(),
+        history=get_analysis_history(),
+        source="web",
+        near_duplicates=os.getenv("NEAR_DUPLICATE_MODE", NEAR_DUPLICATES_FLAG)
+    )
+
+def show_job_progress(job):
+    """Render a job's current state: queue position, specialist statuses and output, and the team synthesis"""
+    snapshot = job.snapshot()
+    roles = snapshot["roles"]
     
-    # Progress tracking
     st.subheader("🏥 Medical Specialists Analysis")
-    status_placeholder = st.empty()
-    overall_progress = st.progress(0, text="Initializing medical analysis...")
+    if snapshot["status"] == QUEUED:
+        position = get_job_queue().position(snapshot["id"])
+        st.info(f"🕒 Waiting for a free analysis slot (position {position or 1} in the queue)...")
     
-    # Show agent status
-    agent_status = {name: "⏳ Waiting..." for name in agents.keys()}
+    status_text = "**Analysis Status:**\n\n"
+    for role, status in snapshot["specialist_status"].items():
+        status_text += f"- {SPECIALIST_LABELS.get(role, role)}: {SPECIALIST_STATUS_LABELS[status]}\n"
+    st.markdown(status_text)
     
-    def update_status_display():
-        status_text = "**Analysis Status:**\n\n"
-        for agent_name, status in agent_status.items():
-            status_text += f"- {agent_name}: {status}\n"
-        status_placeholder.markdown(status_text)
+    answered = sum(1 for role in roles if snapshot["specialist_status"][role] in ("complete", "failed"))
+    if snapshot["status"] == DONE:
+        st.progress(1.0, text="🎉 Complete medical analysis finished!")
+    else:
+        st.progress(answered / len(roles) if roles else 0.0,
+                    text=f"Medical Analysis Progress: {answered}/{len(roles)} specialists complete")
     
-    update_status_display()
+    # Specialist output, as far as it has streamed in
+    live_columns = st.columns(2)
+    for i, role in enumerate(roles):
+        with live_columns[i % 2]:
+            with st.expander(SPECIALIST_LABELS.get(role, role), expanded=not job.finished):
+                status = snapshot["specialist_status"][role]
+                text = snapshot["specialist_text"][role]
+                if status == "failed":
+                    st.markdown("Analysis failed: the specialist did not return a response.")
+                elif text:
+                    st.markdown(text + (" ▌" if status == "writing" else ""))
+                else:
+                    st.caption("⏳ Waiting for first tokens...")
     
-    # Run agents concurrently
-    responses = {}
-    completed_count = 0
+    team_status = snapshot["team_status"]
+    if team_status == "waiting":
+        return
+    st.subheader("🏆 Multidisciplinary Team Analysis")
+    missing = snapshot["missing"]
+    if team_status == "synthesizing":
+        if missing:
+            st.warning(f"🔄 Synthesizing without: {', '.join(missing)}")
+        else:
+            st.info("🔄 Multidisciplinary team is synthesizing all specialist reports...")
+    elif team_status == "preliminary":
+        st.info("⌛ Preliminary diagnosis shown; waiting for late specialists...")
+    elif team_status == "failed":
+        st.error("❌ Team analysis failed: the team did not return a diagnosis.")
+    elif missing:
+        st.warning(f"⚠️ Team analysis complete without: {', '.join(missing)}")
+    else:
+        st.success("✅ Multidisciplinary team analysis complete!")
+    if team_status == "preliminary":
+        st.markdown(snapshot["final_diagnosis"])
+    elif team_status != "failed" and snapshot["team_text"]:
+        st.markdown(snapshot["team_text"] + (" ▌" if team_status == "synthesizing" else ""))
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def follow_job(job_id):
+    """Poll a running job without blocking the rest of the page; reruns the app once it finishes"""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return
+    if job.finished:
+        st.rerun()
+    if st.button("⏹️ Cancel analysis"):
+        get_job_queue().cancel(job_id)
+    show_job_progress(job)
+
+# Analyses listed per page of the history browser
+HISTORY_PAGE_SIZE = 20
+
+def show_history():
+    """Browse recorded analyses a page at a time; only the opened analysis is loaded in full"""
+    st.subheader("🗂️ Analysis History")
+    history = get_analysis_history()
+    if history is None:
+        st.info("📋 The analysis history is disabled (ANALYSIS_HISTORY_ENABLED=0).")
+        return
+    
+    search_col, role_col = st.columns([3, 1])
+    with search_col:
+        query = st.text_input("🔎 Search reports, diagnoses and specialist findings", key="history_query")
+    with role_col:
+        role = st.selectbox("Consulted specialist", ["Any"] + list(SPECIALISTS),
+                            format_func=lambda role: SPECIALIST_LABELS.get(role, role), key="history_role")
     
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        # Submit all agent tasks
-        future_to_agent = {
-            executor.submit(run_agent_analysis, name, agent): name 
-            for name, agent in agents.items()
+    # Start from the first page whenever the filters change
+    filters = (query, role)
+    if st.session_state.get("history_filters") != filters:
+        st.session_state.history_filters = filters
+        st.session_state.history_page = 0
+    page = st.session_state.history_page
+    rows, total = history.search(query, None if role == "Any" else role,
+                                 limit=HISTORY_PAGE_SIZE, offset=page * HISTORY_PAGE_SIZE)
+    if not total:
+        st.info("📋 No recorded analyses match." if query or role != "Any" else "📋 No analyses recorded yet.")
+        return
+    
+    pages = math.ceil(total / HISTORY_PAGE_SIZE)
+    st.caption(f"{total:,} analyses • page {page + 1} of {pages}")
+    st.dataframe([
+        {
+            "#": row["id"],
+            "Date": datetime.fromtimestamp(row["created_at"]).strftime("%Y-%m-%d %H:%M"),
+            "Source": row["source"],
+            "Specialists": row["specialist_count"],
+            "Missing": row["missing"],
+            "Time (s)": round(row["wall_time"], 1) if row["wall_time"] is not None else None,
+            "Cost ($)": round(row["cost"], 4) if row["cost"] is not None else None,
+            "Diagnosis": row["preview"]
         }
-        
-        # Collect results as they complete
-        for future in as_completed(future_to_agent):
-            agent_name, response, status = future.result()
-            responses[agent_name] = response
-            completed_count += 1
-            
-            # Update status
-            if status == "success":
-                agent_status[agent_name] = "✅ Complete!"
-            else:
-                agent_status[agent_name] = "❌ Failed"
-            
-            update_status_display()
-            
-            # Update overall progress
-            progress_percent = completed_count / len(agents)
-            overall_progress.progress(
-                progress_percent, 
-                text=f"Medical Analysis Progress: {completed_count}/{len(agents)} specialists complete"
-            )
+        for row in rows
+    ], hide_index=True, use_container_width=True)
     
-    # Final team analysis
-    st.subheader("🏆 Multidisciplinary Team Analysis")
-    team_progress = st.empty()
+    newer_col, older_col, open_col = st.columns([1, 1, 3])
+    with newer_col:
+        if st.button("⬅️ Newer", disabled=page == 0):
+            st.session_state.history_page = page - 1
+            st.rerun()
+    with older_col:
+        if st.button("Older ➡️", disabled=page + 1 >= pages):
+            st.session_state.history_page = page + 1
+            st.rerun()
+    with open_col:
+        analysis_id = st.selectbox("Open analysis", [row["id"] for row in rows],
+                                   format_func=lambda analysis_id: f"#{analysis_id}", key="history_selected")
     
-    team_progress.info("🔄 Multidisciplinary team is synthesizing all specialist reports...")
+    record = history.get(analysis_id)
+    if record is None:
+        return
+    with st.expander("🏆 Final Diagnosis", expanded=True):
+        st.markdown(record["final_diagnosis"])
+    for role, output in record["responses"].items():
+        with st.expander(SPECIALIST_LABELS.get(role, role)):
+            st.markdown(output or "No response: the specialist failed or missed the deadline.")
+    with st.expander("📄 Medical Report"):
+        st.text(record["report"])
     
-    try:
-        # Clean agent names for team analysis (remove emojis)
-        clean_responses = {
-            name.split()[-1]: response 
-            for name, response in responses.items()
-        }
-        
-        team_agent = MultidisciplinaryTeam(
-            cardiologist_report=clean_responses["Cardiologist"],
-            psychologist_report=clean_responses["Psychologist"], 
-            pulmonologist_report=clean_responses["Pulmonologist"],
-            neurologist_report=clean_responses["Neurologist"],
-            dermatologist_report=clean_responses["Dermatologist"],
-            endocrinologist_report=clean_responses["Endocrinologist"]
-        )
-        
-        final_diagnosis = team_agent.run()
-        
-        team_progress.success("✅ Multidisciplinary team analysis complete!")
-        overall_progress.progress(1.0, text="🎉 Complete medical analysis finished!")
-        
-        return responses, final_diagnosis
-        
-    except Exception as e:
-        team_progress.error(f"❌ Team analysis failed: {str(e)}")
-        return responses, f"Team analysis failed: {str(e)}"
+    analyses_of_report = history.search(report_hash=record["report_hash"], limit=1)[1]
+    if analyses_of_report > 1:
+        st.caption(f"This report has been analyzed {analyses_of_report} times.")
+    st.download_button(
+        label="⬇️ Download JSON",
+        data=json.dumps(record, indent=2, default=str),
+        file_name=f"medical_diagnosis_{analysis_id}.json",
+        mime="application/json"
+    )
+
+# Days of analyses aggregated by the cohort analytics
+COHORT_DAYS_OPTIONS = [7, 30, 90, 365]
+
+@st.cache_data(ttl=60, show_spinner=False)
+def cohort_analytics(days):
+    """Per-specialist aggregates and the most named conditions and tests of the last `days` days"""
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    table = get_analytics_store().scan(["role", "answered", "urgency", "conditions", "tests", "latency", "cost"],
+                                       since=since)
+    return len(table), specialist_summary(table), item_counts(table, "conditions"), item_counts(table, "tests")
+
+def show_cohort_analytics():
+    """Aggregates over every exported analysis, read from the columnar analytics store"""
+    st.subheader("📊 Cohort Analytics")
+    if get_analytics_store() is None:
+        st.info("📋 Analytics are disabled (ANALYTICS_ENABLED=0, or pyarrow is not installed).")
+        return
+    days = st.selectbox("Period", COHORT_DAYS_OPTIONS, index=1, format_func=lambda days: f"Last {days} days",
+                        key="cohort_days")
+    rows, by_specialist, conditions, tests = cohort_analytics(days)
+    if not rows:
+        st.info("📋 No analyses exported in this period yet.")
+        return
+    by_specialist["role"] = by_specialist["role"].map(lambda role: SPECIALIST_LABELS.get(role, role))
+    st.dataframe(by_specialist, use_container_width=True, hide_index=True)
+    conditions_col, tests_col = st.columns(2)
+    with conditions_col:
+        st.caption("Most considered conditions")
+        st.dataframe(conditions, use_container_width=True, hide_index=True)
+    with tests_col:
+        st.caption("Most recommended tests")
+        st.dataframe(tests, use_container_width=True, hide_index=True)
 
-def create_analysis_summary(responses, final_diagnosis):
-    """Create visual summary of the analysis"""
+def publish_job(job):
+    """Store a finished job's results in the session for the dashboard and export tabs"""
+    snapshot = job.snapshot()
+    responses = {}
+    for role in snapshot["roles"]:
+        status = snapshot["specialist_status"][role]
+        if status == "complete":
+            responses[SPECIALIST_LABELS.get(role, role)] = snapshot["responses"][role]
+        elif status == "failed":
+            responses[SPECIALIST_LABELS.get(role, role)] = "Analysis failed: the specialist did not return a response."
+    st.session_state.agent_responses = responses
+    st.session_state.final_diagnosis = (
+        snapshot["final_diagnosis"] or "Team analysis failed: the team did not return a diagnosis."
+    )
+    st.session_state.analysis_metrics = job.metrics
+    st.session_state.analysis_complete = True
+    st.session_state.analysis_timestamp = datetime.now()
+    st.session_state.published_job_id = job.id
+    st.session_state.history_id = snapshot["history_id"]
+
+def create_analysis_summary(responses, final_diagnosis, metrics=None):
+    """Create visual summary of the analysis from its recorded call metrics"""
+    summary = metrics.summary() if metrics is not None else None
     
     # Create metrics
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        st.metric("👨‍⚕️ Specialists Consulted", "6", "100% Coverage")
-    with col2:
-        st.metric("🔬 Analysis Type", "AI-Powered", "Advanced")
-    with col3:
-        st.metric("⏱️ Analysis Time", "~2-3 min", "Concurrent")
-    with col4:
-        st.metric("📊 Report Quality", "Comprehensive", "Multi-perspective")
+        st.metric("👨‍⚕️ Specialists Consulted", str(len(responses)), f"{len(responses) / len(SPECIALISTS):.0%} Coverage")
+    if summary is not None:
+        with col2:
+            st.metric("⏱️ Analysis Time", f"{summary['wall_time']:.1f}s",
+                      f"p95 call {summary['latency_p95']:.1f}s" if summary["latency_p95"] is not None else "All cached",
+                      delta_color="off")
+        with col3:
+            st.metric("🔤 Tokens", f"{summary['prompt_tokens'] + summary['completion_tokens']:,}",
+                      f"{summary['prompt_tokens']:,} in / {summary['completion_tokens']:,} out", delta_color="off")
+        with col4:
+            st.metric("💵 Estimated Cost", f"${summary['cost']:.4f}",
+                      f"{summary['cache_hits']} cached • {summary['retries']} retries", delta_color="off")
+    else:
+        with col2:
+            st.metric("🔬 Analysis Type", "AI-Powered", "Advanced")
+        with col3:
+            st.metric("⏱️ Analysis Time", "Not measured")
+        with col4:
+            st.metric("📊 Report Quality", "Comprehensive", "Multi-perspective")
     
-    # Create specialist response chart
+    # Conditions, recommended tests and urgency each specialist reported
     st.subheader("📈 Specialist Analysis Overview")
+    findings_data = specialist_findings(responses)
+    st.plotly_chart(build_findings_chart(findings_data), use_container_width=True)
+    st.dataframe(findings_data, use_container_width=True, hide_index=True)
     
-    # Count words in each response as a proxy for analysis depth
-    analysis_data = []
-    for agent_name, response in responses.items():
-        word_count = len(str(response).split()) if response else 0
-        analysis_data.append({
-            "Specialist": agent_name,
-            "Analysis Depth (Words)": word_count,
-            "Status": "✅ Complete" if word_count > 10 else "⚠️ Limited"
-        })
+    if summary is None or not summary["roles"]:
+        return
     
-    df = pd.DataFrame(analysis_data)
+    # Per-role latency breakdown, slowest first, to show which specialist dominates the tail
+    call_data = []
+    for role, stats in summary["roles"].items():
+        latency = stats["latency_max"] or 0.0
+        queue_wait = stats["queue_wait_p95"] or 0.0
+        call_data.append({
+            "Specialist": SPECIALIST_LABELS.get(role, role),
+            "Queue Wait (s)": queue_wait,
+            "Model Time (s)": max(latency - queue_wait, 0.0),
+            "Time to First Token (s)": stats["ttft_p50"],
+            "Prompt Tokens": stats["prompt_tokens"],
+            "Completion Tokens": stats["completion_tokens"],
+            "Cost ($)": round(stats["cost"], 5),
+            "Errors": stats["errors"]
+        })
+    call_data.sort(key=lambda row: row["Model Time (s)"], reverse=True)
+    st.plotly_chart(build_latency_chart(call_data), use_container_width=True)
+    st.dataframe(call_data, use_container_width=True, hide_index=True)
+
+def specialist_findings(responses):
+    """
+    Findings of the shown analysis: read from the analytics store when it
+    was recorded there, else extracted from the responses on the spot
+    """
+    store = get_analytics_store()
+    history_id = st.session_state.get("history_id")
+    rows = []
+    if store is not None and history_id is not None:
+        # No date bound: a reused or earlier analysis may sit in any partition. Files whose analysis_id
+        # statistics exclude it are skipped without reading their data.
+        rows = [
+            row for row in store.scan(["role", "urgency", "conditions", "tests"], analysis_id=history_id).to_pylist()
+            if row["role"] in SPECIALIST_LABELS
+        ]
+    if not rows:
+        for agent_name, response in responses.items():
+            findings = extract_findings(agent_name, response)
+            rows.append({"role": agent_name, "urgency": findings.urgency, "conditions": findings.conditions,
+                         "tests": findings.tests})
+    return [
+        {
+            "Specialist": SPECIALIST_LABELS.get(row["role"], row["role"]),
+            "Conditions Considered": len(row["conditions"]),
+            "Recommended Tests": len(row["tests"]),
+            "Urgency": row["urgency"],
+            "Conditions": ", ".join(row["conditions"]),
+            "Tests": ", ".join(row["tests"])
+        }
+        for row in rows
+    ]
+
+# Figures are rebuilt only when their data changes, not on every rerun
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_findings_chart(findings_data):
+    # Charting libraries are only needed once results are shown, so they stay off the cold-start path
+    import pandas as pd
+    import plotly.express as px
     
-    # Create bar chart
     fig = px.bar(
-        df, 
-        x="Specialist", 
-        y="Analysis Depth (Words)",
-        color="Status",
-        title="Medical Specialist Analysis Depth",
-        color_discrete_map={"✅ Complete": "#28a745", "⚠️ Limited": "#ffc107"}
+        pd.DataFrame(findings_data),
+        x="Specialist",
+        y="Conditions Considered",
+        color="Urgency",
+        hover_data=["Recommended Tests"],
+        title="Conditions Considered per Specialist",
+        color_discrete_map={"routine": "#28a745", "urgent": "#ffc107", "emergent": "#dc3545"}
     )
     fig.update_layout(height=400)
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def build_latency_chart(call_data):
+    import pandas as pd
+    import plotly.express as px
+    
+    fig = px.bar(
+        pd.DataFrame(call_data),
+        x="Specialist",
+        y=["Queue Wait (s)", "Model Time (s)"],
+        title="Latency per Agent Call",
+        color_discrete_sequence=["#ffc107", "#667eea"]
+    )
+    fig.update_layout(height=400, yaxis_title="Seconds", legend_title_text="")
+    return fig
 
 def main():
     # Header
@@ -225,6 +463,78 @@ def main():
         st.header("🔧 System Information")
         st.info("**AI Specialists Available:**\n- 🫀 Cardiologist\n- 🧠 Psychologist\n- 🫁 Pulmonologist\n- 🧬 Neurologist\n- 🩺 Dermatologist\n- ⚕️ Endocrinologist")
         
+        cache = get_response_cache()
+        if cache is not None:
+            cache_stats = cache.stats()
+            st.header("💾 Response Cache")
+            st.caption(
+                f"{cache_stats['hits']} hits • {cache_stats['misses']} misses • "
+                f"{cache_stats['hit_rate']:.0%} hit rate • {cache_stats['entries']} entries"
+            )
+        
+        queue_stats = get_job_queue().stats()
+        st.header("🧵 Analysis Queue")
+        st.caption(
+            f"{queue_stats['running']}/{queue_stats['workers']} running • "
+            f"{queue_stats['queued']}/{queue_stats['max_queued']} waiting"
+        )
+        
+        analysis_cache = get_analysis_cache()
+        analysis_cache_stats = analysis_cache.stats()
+        st.header("♻️ Analysis Cache")
+        st.caption(
+            f"{analysis_cache_stats['entries']} saved analyses • {analysis_cache_stats['hits']} reused • "
+            f"{analysis_cache_stats['misses']} new"
+        )
+        if st.button("🗑️ Clear analysis cache", disabled=not analysis_cache_stats["entries"]):
+            analysis_cache.clear()
+            st.rerun()
+        
+        process_stats = get_process_metrics().summary()
+        if process_stats["calls"]:
+            st.header("📈 Call Metrics")
+            latency_p95 = process_stats["latency_p95"]
+            st.caption(
+                f"{process_stats['calls']} calls • p95 {latency_p95 or 0:.1f}s • "
+                f"{process_stats['errors']} errors • ${process_stats['cost']:.4f} estimated"
+            )
+            st.download_button(
+                "⬇️ Prometheus metrics", data=get_process_metrics().to_prometheus(),
+                file_name="metrics.prom", mime="text/plain"
+            )
+        
+        st.header("⏱️ Latency Controls")
+        specialist_timeout = st.number_input(
+            "Per-specialist timeout (s, 0 = none)", min_value=0, value=0, step=10,
+            help="Specialists slower than this are treated as missing"
+        )
+        deadline = st.number_input(
+            "Overall deadline (s, 0 = none)", min_value=0, value=0, step=10,
+            help="After this, the team synthesizes whichever specialist reports have arrived"
+        )
+        refresh_on_late = st.checkbox(
+            "Refresh diagnosis with late reports", value=False,
+            help="Re-run the team synthesis when specialists answer after the deadline"
+        )
+        execution_mode = st.radio(
+            "Execution mode", [FANOUT_MODE, PANEL_MODE],
+            format_func={FANOUT_MODE: "One call per specialist", PANEL_MODE: "Single panel call"}.get,
+            help="A single panel call sends the report once (cheaper); separate calls keep specialists isolated and stream live"
+        )
+        slice_reports = st.checkbox(
+            "Send specialists only relevant sections", value=True,
+            help="Split the report into sections (history, labs, ECG, exam...) and give each specialist only what its role needs"
+        )
+        use_triage = st.checkbox(
+            "Smart triage", value=False,
+            help="Consult only the specialists whose area the report mentions (decided locally, no extra API calls)"
+        )
+        hierarchical_synthesis = st.checkbox(
+            "Condense reports by organ system", value=False,
+            help="Summarize specialist reports per organ system in parallel before the team synthesis, "
+                 "which keeps the final step fast for large panels"
+        )
+        
         st.header("📁 Sample Reports")
         if st.button("📋 Load Sample Report"):
             try:
@@ -272,29 +582,65 @@ def main():
         # Analysis button
         if st.button("🚀 Start Medical Analysis", type="primary", disabled=not medical_report):
             if medical_report:
-                st.session_state.analysis_complete = False
-                
-                with st.spinner("Initializing AI medical specialists..."):
-                    time.sleep(1)  # Brief pause for UX
-                
-                # Run analysis
-                responses, final_diagnosis = analyze_medical_report(medical_report)
-                
-                # Store results
-                st.session_state.agent_responses = responses
-                st.session_state.final_diagnosis = final_diagnosis
-                st.session_state.analysis_complete = True
-                st.session_state.analysis_timestamp = datetime.now()
-                
-                st.balloons()  # Celebration animation
+                options = AnalysisOptions(
+                    mode=execution_mode,
+                    specialist_timeout=specialist_timeout or None,
+                    deadline=deadline or None,
+                    refresh_on_late=refresh_on_late,
+                    triage=use_triage,
+                    slice_reports=slice_reports,
+                    synthesis=HIERARCHICAL_SYNTHESIS if hierarchical_synthesis else SINGLE_SYNTHESIS
+                )
+                # Queue the analysis; a report already analyzed (or in progress) with the same settings is reused
+                try:
+                    job = get_job_queue().submit(medical_report, options, st.session_state.session_id)
+                    st.session_state.job_id = job.id
+                    st.session_state.analysis_complete = False
+                except QueueFullError as e:
+                    st.error(f"🚦 {e}")
+        
+        job = get_job_queue().get(st.session_state.job_id) if st.session_state.get("job_id") else None
+        if job is not None and not job.finished:
+            follow_job(job.id)
+        elif job is not None:
+            newly_finished = st.session_state.get("published_job_id") != job.id
+            if newly_finished:
+                publish_job(job)
+            show_job_progress(job)
+            if job.status == DONE:
+                near_duplicate_of = job.near_duplicate_of
+                if job.from_cache and near_duplicate_of:
+                    st.info(f"♻️ A near-identical report ({near_duplicate_of['similarity']:.0%} similar, ignoring "
+                            f"whitespace, dates and small edits) was already analyzed with the same settings; "
+                            f"showing analysis #{near_duplicate_of['analysis_id']}.")
+                    if st.button("🔁 Analyze this version anyway"):
+                        job = get_job_queue().submit(job.medical_report, job.options, st.session_state.session_id,
+                                                     reuse_similar=False)
+                        st.session_state.job_id = job.id
+                        st.rerun()
+                elif job.from_cache:
+                    st.info("♻️ This report was already analyzed with the same settings; showing the saved result.")
+                elif near_duplicate_of:
+                    st.info(f"ℹ️ This report is {near_duplicate_of['similarity']:.0%} similar to analysis "
+                            f"#{near_duplicate_of['analysis_id']} in the history.")
+                if newly_finished:
+                    st.balloons()  # Celebration animation
                 st.success("🎉 Medical analysis complete! Check the Results Dashboard tab.")
+            elif job.status == CANCELLED:
+                st.warning("⏹️ Analysis cancelled.")
+            else:
+                st.error(f"❌ Analysis failed: {job.error}")
     
     with tab2:
         st.header("📊 Medical Analysis Results")
         
         if st.session_state.analysis_complete and st.session_state.agent_responses:
             # Analysis summary
-            create_analysis_summary(st.session_state.agent_responses, st.session_state.final_diagnosis)
+            create_analysis_summary(
+                st.session_state.agent_responses,
+                st.session_state.final_diagnosis,
+                st.session_state.get("analysis_metrics")
+            )
             
             # Detailed results
             st.subheader("🏆 Final Multidisciplinary Diagnosis")
@@ -368,10 +714,15 @@ Generated: {st.session_state.analysis_timestamp.strftime('%Y-%m-%d %H:%M:%S')}
                     st.session_state.analysis_complete = False
                     st.session_state.agent_responses = {}
                     st.session_state.final_diagnosis = ""
+                    st.session_state.history_id = None
                     st.rerun()
         
         else:
             st.info("📋 No results to export yet. Please complete an analysis first!")
+        
+        st.divider()
+        show_history()
+        show_cohort_analytics()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
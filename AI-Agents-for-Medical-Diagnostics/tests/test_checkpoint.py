@@ -0,0 +1,99 @@
+import asyncio
+import os
+
+import pytest
+
+from Utils import Orchestrator
+from Utils.Checkpoint import AnalysisCheckpoint, CheckpointStore
+from Utils.Orchestrator import AnalysisOptions, analysis_key, analyze_report_async, run_batch_async
+
+REPORT = "Chief Complaint: Episodes of chest pain and palpitations.\nMedical History: Anxiety."
+
+
+class FakeSteps:
+    """Replaces the specialist and team calls; `fail` lists specialists that return no answer"""
+
+    def __init__(self, monkeypatch, fail=()):
+        self.specialist_calls = []
+        self.team_calls = 0
+        self.fail = set(fail)
+        monkeypatch.setattr(Orchestrator, "run_specialists_async", self.run_specialists)
+        monkeypatch.setattr(Orchestrator, "run_team_async", self.run_team)
+
+    async def run_specialists(self, medical_report, roles, limiter=None, on_result=None, options=None):
+        self.specialist_calls.append(list(roles))
+        responses = {role: None if role in self.fail else f"{role} assessment" for role in roles}
+        for role, response in responses.items():
+            if on_result:
+                on_result(role, response)
+        return responses, {}
+
+    async def run_team(self, responses, limiter=None, options=None):
+        self.team_calls += 1
+        return "Team diagnosis from " + ", ".join(sorted(role for role, text in responses.items() if text))
+
+
+def test_checkpoint_restores_saved_steps(tmp_path):
+    checkpoint = AnalysisCheckpoint(str(tmp_path))
+    checkpoint.save_response("Cardiologist", "Possible arrhythmia.")
+    checkpoint.save_response("Psychologist", None)
+    checkpoint.save_final("Panic disorder", {"Cardiologist": "Possible arrhythmia.", "Psychologist": None})
+    assert checkpoint.saved == 2
+
+    restored = AnalysisCheckpoint(str(tmp_path))
+    assert restored.responses == {"Cardiologist": "Possible arrhythmia."}
+    assert restored.final_for({"Cardiologist": "Possible arrhythmia.", "Psychologist": None}) == "Panic disorder"
+    assert restored.final_for({"Cardiologist": "Possible arrhythmia.", "Psychologist": "Anxiety."}) is None
+    assert restored.saved == 0
+
+
+def test_checkpoint_ignores_unreadable_and_temporary_files(tmp_path):
+    AnalysisCheckpoint(str(tmp_path)).save_response("Cardiologist", "Possible arrhythmia.")
+    (tmp_path / "Neurologist.json").write_text('{"step": "Neurolo')
+    (tmp_path / ".abc.tmp").write_text("partial")
+    assert AnalysisCheckpoint(str(tmp_path)).responses == {"Cardiologist": "Possible arrhythmia."}
+
+
+def test_store_discards_earlier_steps_unless_resuming(tmp_path):
+    store = CheckpointStore(str(tmp_path))
+    store.open("key").save_response("Cardiologist", "Possible arrhythmia.")
+    assert store.open("key", resume=True).responses == {"Cardiologist": "Possible arrhythmia."}
+    assert store.open("key", resume=False).responses == {}
+    store.discard("key")
+    assert not os.path.exists(tmp_path / "key")
+
+
+def test_resume_only_runs_the_missing_specialists(tmp_path, monkeypatch):
+    roles = list(Orchestrator.SPECIALISTS)
+    steps = FakeSteps(monkeypatch, fail=roles[:2])
+    asyncio.run(analyze_report_async(REPORT, checkpoint=AnalysisCheckpoint(str(tmp_path))))
+    assert steps.specialist_calls == [roles]
+
+    steps.fail = set()
+    responses, final_diagnosis = asyncio.run(analyze_report_async(REPORT, checkpoint=AnalysisCheckpoint(str(tmp_path))))
+    assert steps.specialist_calls[1] == roles[:2]
+    assert all(responses[role] == f"{role} assessment" for role in roles)
+    # The first diagnosis lacked two specialists, so the team ran again
+    assert steps.team_calls == 2
+    assert final_diagnosis == "Team diagnosis from " + ", ".join(sorted(roles))
+
+
+def test_completed_analysis_is_restored_without_calls(tmp_path, monkeypatch):
+    steps = FakeSteps(monkeypatch)
+    first = asyncio.run(analyze_report_async(REPORT, checkpoint=AnalysisCheckpoint(str(tmp_path))))
+    checkpoint = AnalysisCheckpoint(str(tmp_path))
+    assert asyncio.run(analyze_report_async(REPORT, checkpoint=checkpoint)) == first
+    assert (len(steps.specialist_calls), steps.team_calls, checkpoint.saved) == (1, 1, 0)
+
+
+@pytest.mark.parametrize("keep_checkpoints", [False, True])
+def test_batch_removes_checkpoints_once_written(tmp_path, monkeypatch, keep_checkpoints):
+    FakeSteps(monkeypatch)
+    report_path = tmp_path / "report.txt"
+    report_path.write_text(REPORT, encoding="utf-8")
+    store = CheckpointStore(str(tmp_path / "checkpoints"))
+    written, failed = asyncio.run(run_batch_async([str(report_path)], output_dir=str(tmp_path / "results"),
+                                                  checkpoints=store, keep_checkpoints=keep_checkpoints))
+    assert list(written) == [str(report_path)] and failed == {}
+    key = analysis_key(REPORT, AnalysisOptions())
+    assert os.path.exists(os.path.join(store.directory, key)) == keep_checkpoints
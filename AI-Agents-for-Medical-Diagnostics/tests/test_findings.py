@@ -0,0 +1,65 @@
+import pytest
+
+from Utils.Findings import EMERGENT, MAX_ITEM_CHARS, ROUTINE, URGENT, classify_urgency, extract_findings
+from Utils.Tiering import TEAM_ROLE
+
+CARDIOLOGIST_OUTPUT = """\
+### Possible Causes
+1. **Panic disorder**: recurrent episodes with palpitations and a sense of impending doom.
+   - Normal ECG between episodes supports a non-cardiac cause.
+2. Paroxysmal supraventricular tachycardia - episodic palpitations with sudden onset.
+3. **Panic disorder**: listed again by the model.
+
+**Recommended Next Steps:**
+- 24-hour Holter monitoring to capture an episode
+- Echocardiogram: to rule out structural heart disease
+- Thyroid function tests (TSH, free T4)
+- Reassurance and lifestyle advice
+"""
+
+
+@pytest.mark.parametrize("text, urgency", [
+    ("Routine follow-up with the primary care physician in three months.", ROUTINE),
+    ("The patient should be seen by cardiology within 48 hours.", URGENT),
+    ("An echocardiogram should be arranged promptly.", URGENT),
+    ("The patient should be hospitalized immediately for monitoring.", EMERGENT),
+    ("Call 911 now; this is a life-threatening presentation.", EMERGENT),
+    ("No emergency intervention is needed at this time.", ROUTINE),
+    ("Seek emergency care if chest pain recurs or worsens.", ROUTINE),
+    ("Seek emergency care if symptoms worsen. Arrange an echocardiogram urgently.", URGENT),
+])
+def test_classify_urgency(text, urgency):
+    assert classify_urgency(text) == urgency
+
+
+def test_emergent_cues_outrank_urgent_ones():
+    assert classify_urgency("Arrange tests urgently. Admission is recommended.") == EMERGENT
+
+
+def test_extract_findings_reads_conditions_and_tests_from_their_sections():
+    findings = extract_findings("Cardiologist", CARDIOLOGIST_OUTPUT)
+    assert findings.role == "Cardiologist"
+    assert findings.conditions == ["panic disorder", "paroxysmal supraventricular tachycardia"]
+    # Sub-points are skipped and recommendations that name no test are not tests
+    assert findings.tests == ["24-hour holter monitoring to capture an episode", "echocardiogram",
+                              "thyroid function tests"]
+    assert findings.urgency == ROUTINE
+    assert findings.words == len(CARDIOLOGIST_OUTPUT.split())
+
+
+def test_team_items_before_any_heading_are_conditions():
+    text = "- **Panic disorder**: fits the episodes\n- Hyperthyroidism: weight loss and tremor\n"
+    assert extract_findings(TEAM_ROLE, text).conditions == ["panic disorder", "hyperthyroidism"]
+    assert extract_findings("Cardiologist", text).conditions == []
+
+
+def test_long_item_names_are_cut_at_a_word_boundary():
+    text = "Possible causes:\n- " + "very " * 40 + "long condition\n"
+    name = extract_findings("Neurologist", text).conditions[0]
+    assert len(name) <= MAX_ITEM_CHARS and not name.endswith(" ")
+
+
+@pytest.mark.parametrize("text", [None, ""])
+def test_missing_output_has_no_findings(text):
+    findings = extract_findings("Psychologist", text)
+    assert (findings.conditions, findings.tests, findings.urgency, findings.words) == ([], [], ROUTINE, 0)
@@ -0,0 +1,32 @@
+import pytest
+
+from Utils.Hedging import HedgePolicy
+
+
+def test_nothing_is_hedged_before_enough_calls_completed():
+    policy = HedgePolicy(min_samples=5, min_delay=0)
+    for _ in range(4):
+        policy.observe(("Cardiologist", False), 1.0)
+    assert policy.start(("Cardiologist", False)) is None
+
+
+def test_new_keys_use_the_latencies_of_all_calls():
+    policy = HedgePolicy(percentile=50, min_samples=4, min_delay=0)
+    for role in ("Cardiologist", "Psychologist", "Neurologist", "Pulmonologist"):
+        policy.observe((role, False), 2.0)
+    assert policy.start(("Dermatologist", False)) == pytest.approx(2.0)
+
+
+def test_keys_with_enough_samples_use_their_own():
+    policy = HedgePolicy(percentile=50, min_samples=3, min_delay=0)
+    for _ in range(3):
+        policy.observe(("MultidisciplinaryTeam", False), 8.0)
+        policy.observe(("Cardiologist", False), 1.0)
+    assert policy.start(("MultidisciplinaryTeam", False)) == pytest.approx(8.0)
+    assert policy.start(("Cardiologist", False)) == pytest.approx(1.0)
+
+
+def test_delay_is_at_least_min_delay():
+    policy = HedgePolicy(min_samples=1, min_delay=0.5)
+    policy.observe("key", 0.1)
+    assert policy.start("key") == 0.5
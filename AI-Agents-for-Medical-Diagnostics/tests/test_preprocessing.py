@@ -0,0 +1,88 @@
+from Utils.Preprocessing import (
+    budget_specialist_reports, compress_text, count_tokens, slice_report, split_sections, truncate_to_tokens
+)
+
+REPORT = """\
+Patient Name: Michael Johnson
+Age: 29
+Chief Complaint: Episodes of chest pain and palpitations.
+Medical History: Generalized anxiety disorder.
+Current Medications: Sertraline 50 mg daily.
+Recent Lab and Diagnostic Results:
+- Blood tests: TSH 1.8 mIU/L, troponin negative.
+Electrocardiogram (ECG): Normal sinus rhythm.
+Physical Examination Findings: Heart rate 96, no murmurs.
+Assessment: Reports excessive worry and fear of further attacks.
+"""
+
+
+def test_count_tokens_of_empty_text_is_zero():
+    assert count_tokens("") == 0
+    assert count_tokens(None) == 0
+    assert count_tokens("chest pain") > 0
+
+
+def test_truncate_to_tokens_leaves_fitting_text_alone():
+    assert truncate_to_tokens(REPORT, 10_000) == REPORT
+    assert truncate_to_tokens(REPORT, None) == REPORT
+    assert truncate_to_tokens("", 5) == ""
+
+
+def test_truncate_to_tokens_keeps_whole_lines_within_the_budget():
+    budget = count_tokens(REPORT) // 2
+    truncated = truncate_to_tokens(REPORT, budget)
+    assert count_tokens(truncated) <= budget
+    kept, marker = truncated.rsplit("\n", 1)
+    assert REPORT.startswith(kept + "\n")
+    assert marker == f"[... truncated to fit a {budget} token budget ...]"
+
+
+def test_truncate_to_tokens_cuts_an_oversized_first_line():
+    line = "palpitations " * 200
+    truncated = truncate_to_tokens(line, 40)
+    assert count_tokens(truncated) <= 40
+    assert truncated.startswith("palpitations")
+
+
+def test_split_sections_keeps_the_report_in_order():
+    sections = [section for section, _ in split_sections(REPORT)]
+    assert sections == ["header", "complaint", "history", "medications", "labs", "ecg", "exam", "assessment"]
+    assert "\n".join(text for _, text in split_sections(REPORT)) == REPORT.rstrip("\n")
+
+
+def test_slice_report_keeps_the_header_and_the_role_sections():
+    sliced = slice_report(REPORT, "Psychologist")
+    assert "Patient Name: Michael Johnson" in sliced
+    assert "Chief Complaint" in sliced and "Assessment: Reports" in sliced
+    assert "Electrocardiogram" not in sliced and "Blood tests" not in sliced
+
+
+def test_slice_report_takes_the_union_for_several_roles():
+    sliced = slice_report(REPORT, ["Psychologist", "Cardiologist"])
+    assert "Electrocardiogram" in sliced and "Assessment: Reports" in sliced
+
+
+def test_slice_report_sends_unclassifiable_input_whole():
+    assert slice_report(REPORT, "Oncologist") == REPORT
+    plain = "Patient reports chest pain on exertion and shortness of breath."
+    assert slice_report(plain, "Dermatologist") == plain
+
+
+def test_slice_report_applies_the_token_budget():
+    sliced = slice_report(REPORT, "Cardiologist", token_budget=30)
+    assert count_tokens(sliced) <= 30
+
+
+def test_compress_text_strips_markdown_only_when_over_budget():
+    text = "## **Possible Causes**\n\n-   *Panic disorder*   \n"
+    assert compress_text(text, budget=1000) == text
+    assert compress_text(text) == "Possible Causes\n- Panic disorder"
+
+
+def test_budget_specialist_reports_caps_each_report():
+    long_report = "**Finding:** palpitations with normal ECG.\n" * 100
+    budgeted = budget_specialist_reports({"Cardiologist": long_report, "Psychologist": "Brief.", "Neurologist": None},
+                                         token_budget=50)
+    assert count_tokens(budgeted["Cardiologist"]) <= 50
+    assert budgeted["Psychologist"] == "Brief."
+    assert budgeted["Neurologist"] is None
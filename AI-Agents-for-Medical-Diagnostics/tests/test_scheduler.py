@@ -0,0 +1,164 @@
+import asyncio
+
+import pytest
+
+from Utils import Scheduler
+from Utils.Scheduler import LLMScheduler, RetryableError, TokenBucket, classify_error
+
+
+class FakeClock:
+    """Stands in for the scheduler's `time` module; sleeping only advances the clock"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(Scheduler, "time", clock)
+    return clock
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = type("Response", (), {"status_code": status_code, "headers": headers or {}})()
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class APIStatusError(Exception):
+    pass
+
+
+class InternalServerError(APIStatusError):
+    pass
+
+
+def test_token_bucket_spends_capacity_without_waiting(clock):
+    bucket = TokenBucket(60)
+    assert bucket.reserve(60) == 0.0
+
+
+def test_token_bucket_queues_callers_behind_a_negative_balance(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    assert bucket.reserve(1) == pytest.approx(2.0)
+
+
+def test_token_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(60, capacity=10)
+    bucket.reserve(10)
+    clock.now += 5
+    assert bucket.reserve(5) == 0.0
+    clock.now += 3600
+    bucket.reserve(0)
+    assert bucket.available == 10
+
+
+def test_token_bucket_refund_settles_the_estimate(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(60)
+    bucket.refund(30)
+    assert bucket.available == pytest.approx(30)
+    bucket.refund(-40)
+    assert bucket.reserve(0) == pytest.approx(10.0)
+
+
+def test_concurrency_grows_additively_on_success(clock):
+    scheduler = LLMScheduler(max_concurrency=32, initial_concurrency=4)
+    for _ in range(4):
+        scheduler._in_flight += 1
+        scheduler._release("success")
+    assert 4.9 < scheduler.concurrency_limit < 5.0
+
+
+def test_concurrency_is_capped_at_the_maximum(clock):
+    scheduler = LLMScheduler(max_concurrency=4, initial_concurrency=4)
+    scheduler._in_flight += 1
+    scheduler._release("success")
+    assert scheduler.concurrency_limit == 4.0
+
+
+def test_concurrency_halves_on_throttling_once_per_cooldown(clock):
+    scheduler = LLMScheduler(max_concurrency=32, initial_concurrency=16, decrease_cooldown=5.0)
+    for _ in range(3):
+        scheduler._in_flight += 1
+        scheduler._release("throttled")
+    assert scheduler.concurrency_limit == 8.0
+    clock.now += 5
+    scheduler._in_flight += 1
+    scheduler._release("throttled")
+    assert scheduler.concurrency_limit == 4.0
+
+
+def test_concurrency_never_drops_below_one(clock):
+    scheduler = LLMScheduler(initial_concurrency=1, decrease_cooldown=0)
+    scheduler._in_flight += 1
+    scheduler._release("throttled")
+    assert scheduler.concurrency_limit == 1.0
+
+
+def test_other_errors_leave_concurrency_unchanged(clock):
+    scheduler = LLMScheduler(initial_concurrency=8)
+    scheduler._in_flight += 1
+    scheduler._release("error")
+    assert scheduler.concurrency_limit == 8.0
+
+
+@pytest.mark.parametrize("exc, expected", [
+    (StatusError(429), (True, True, None)),
+    (StatusError(503), (True, False, None)),
+    (StatusError(400), (False, False, None)),
+    (StatusError(401), (False, False, None)),
+    (RateLimitError(), (True, True, None)),
+    (InternalServerError(), (True, False, None)),
+    (asyncio.TimeoutError(), (True, False, None)),
+    (ConnectionError(), (True, False, None)),
+    (RetryableError("retry", retry_after=2.5), (True, False, 2.5)),
+    (ValueError("bad prompt"), (False, False, None)),
+])
+def test_classify_error(exc, expected):
+    assert classify_error(exc) == expected
+
+
+def test_classify_error_reads_retry_after_headers():
+    assert classify_error(StatusError(429, {"retry-after": "7"}))[2] == 7.0
+    assert classify_error(StatusError(429, {"retry-after-ms": "1500"}))[2] == 1.5
+    assert classify_error(StatusError(429, {"retry-after": "soon"}))[2] is None
+
+
+def test_call_retries_throttled_attempts(clock):
+    scheduler = LLMScheduler(max_retries=2)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise StatusError(429)
+        return "ok"
+
+    assert scheduler.call(flaky) == "ok"
+    assert (scheduler.retries, scheduler.throttled, scheduler.failures) == (2, 2, 0)
+
+
+def test_call_does_not_retry_client_errors(clock):
+    scheduler = LLMScheduler(max_retries=3)
+
+    def rejected():
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        scheduler.call(rejected)
+    assert (scheduler.retries, scheduler.failures) == (0, 1)
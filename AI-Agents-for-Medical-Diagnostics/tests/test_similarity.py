@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from Utils.Similarity import (
+    NUM_PERM, NearDuplicateIndex, is_trivial_edit, lsh_bands, minhash_signature, normalize_report,
+    numeric_fingerprint
+)
+
+REPORT = (
+    "Patient: Michael Johnson, 29 years old. Seen on 2024-03-12 at 09:30. Presents with episodes of chest pain, "
+    "palpitations and shortness of breath lasting 10 to 20 minutes, often at work. ECG shows normal sinus rhythm "
+    "with no signs of ischemia. Blood pressure 128/82, heart rate 96. History of generalized anxiety; "
+    "takes sertraline 50 mg daily. Family history of hypertension. Denies alcohol or drug use."
+)
+
+
+def similarity(a, b):
+    return float(np.count_nonzero(minhash_signature(a) == minhash_signature(b))) / NUM_PERM
+
+
+def test_normalize_report_drops_case_punctuation_dates_and_times():
+    assert normalize_report("Seen on 2024-03-12 at 09:30: Chest PAIN!") == ["seen", "on", "at", "chest", "pain"]
+    assert normalize_report("Seen on March 12, 2024.") == ["seen", "on"]
+
+
+def test_numeric_fingerprint_ignores_dates_but_not_values():
+    assert numeric_fingerprint(REPORT) == numeric_fingerprint(REPORT.replace("2024-03-12", "2024-05-01"))
+    assert numeric_fingerprint(REPORT) != numeric_fingerprint(REPORT.replace("50 mg", "100 mg"))
+
+
+def test_signature_is_deterministic():
+    signature = minhash_signature(REPORT)
+    assert signature.dtype == np.uint32 and signature.shape == (NUM_PERM,)
+    assert np.array_equal(signature, minhash_signature(REPORT))
+
+
+def test_reformatted_copy_has_the_same_signature():
+    copy = "  " + REPORT.upper().replace(", ", " , ").replace("2024-03-12", "2024-04-02") + "\n"
+    assert similarity(REPORT, copy) == 1.0
+
+
+def test_similarity_falls_with_the_share_of_changed_text():
+    one_typo = REPORT.replace("palpitations", "palpitatoins")
+    rewritten = "Patient reports a pruritic rash on both forearms for two weeks, worse after gardening."
+    assert similarity(REPORT, one_typo) > 0.8
+    assert similarity(REPORT, rewritten) < 0.2
+
+
+def test_short_reports_still_get_a_signature():
+    assert minhash_signature("ok").shape == (NUM_PERM,)
+    assert minhash_signature("").shape == (NUM_PERM,)
+
+
+@pytest.mark.parametrize("threshold", [0.5, 0.8, 0.9, 0.95])
+def test_lsh_bands_divide_the_signature(threshold):
+    bands, rows = lsh_bands(threshold)
+    assert bands * rows == NUM_PERM
+    assert (1 / bands) ** (1 / rows) <= threshold
+
+
+def test_index_finds_near_duplicates_within_their_group():
+    index = NearDuplicateIndex(threshold=0.9)
+    index.add(1, minhash_signature(REPORT), group="fanout")
+    copy = minhash_signature(REPORT.replace("2024-03-12", "2024-04-02"))
+    assert index.query(copy, group="fanout") == (1, 1.0)
+    assert index.query(copy, group="panel") is None
+    assert index.query(minhash_signature("Itchy rash on both forearms for two weeks."), group="fanout") is None
+    assert len(index) == 1
+
+
+@pytest.mark.parametrize("edited", [
+    REPORT,
+    REPORT.upper(),
+    "  ".join(REPORT.split(" ")),
+    REPORT.replace(", ", " ; ").replace(".", " .\n"),
+])
+def test_formatting_changes_are_trivial(edited):
+    assert is_trivial_edit(REPORT, edited)
+
+
+@pytest.mark.parametrize("original, edited", [
+    # A single letter can change the finding or its location
+    ("chest pain on exertion", "chest rain on exertion"),
+    ("terminal ileum thickening", "terminal ilium thickening"),
+    ("weakness of the left arm", "weakness of the lift arm"),
+    ("palpitations", "palpitatoins"),
+    # Negations, values and dates are part of the report
+    ("no signs of ischemia", "signs of ischemia"),
+    ("sertraline 50 mg daily", "sertraline 100 mg daily"),
+    ("blood pressure 128/82", "blood pressure 182/82"),
+    ("seen on 2024-03-12", "seen on 2024-03-13"),
+    ("chest pain", "chest pain and fever"),
+])
+def test_any_changed_word_is_not_trivial(original, edited):
+    assert not is_trivial_edit(original, edited)